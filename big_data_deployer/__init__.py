@@ -1,5 +1,6 @@
 #!/usr/bin/env python2
 
 from package import PackageRegistry, PackageManager, get_package_registry
+from session import Session
 import packages
 
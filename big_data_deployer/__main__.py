@@ -4,7 +4,14 @@ from __future__ import print_function
 
 from . import *
 from . import preserve
+from . import remote
 from . import conda
+from . import executor
+from . import logs
+from . import metrics
+from . import purge
+from . import staging
+from . import status
 
 import argparse
 import os.path
@@ -16,13 +23,27 @@ class InvalidSettingError(Exception): pass
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Install and deploy Big Data frameworks", prog="big_data_deployer")
+    parser.add_argument("--use-agents", help="run remote commands through a deployer agent on each machine instead of a new ssh connection per command", action="store_true")
+    parser.add_argument("--command-timeout", metavar="SECONDS", help="abort remote commands that take longer than this (default: 1800, 0 to disable)", action="store", type=float)
+    parser.add_argument("--ssh-retries", metavar="N", help="retry remote commands up to N times if the connection fails (default: 2)", action="store", type=int)
+    parser.add_argument("--max-parallel", metavar="N", help="maximum number of concurrent remote commands (default: 64)", action="store", type=int)
+    parser.add_argument("--max-parallel-per-host", metavar="N", help="maximum number of concurrent remote commands per machine (default: 8)", action="store", type=int)
+    parser.add_argument("--straggler-policy", help="how to handle machines that take much longer than the median to complete a step (default: report)", action="store", choices=executor.STRAGGLER_POLICIES)
+    parser.add_argument("--straggler-factor", metavar="FACTOR", help="how many times the median duration of a step makes a machine a straggler (default: 3)", action="store", type=float)
+    parser.add_argument("--exclude-stragglers", help="leave slow and failed machines out of a deployment before starting its daemons", action="store_true")
+    parser.add_argument("--purge-mode", help="remove old deployment directories before deploying ('sync'), or move them to a trash directory that is emptied in the background ('async', default)", action="store", choices=purge.PURGE_MODES)
     subparsers = parser.add_subparsers(title="Big Data framework deployment commands")
 
     add_list_frameworks_subparser(subparsers)
     add_install_subparser(subparsers)
     add_deploy_subparser(subparsers)
+    add_teardown_subparser(subparsers)
     preserve.add_preserve_subparser(subparsers)
     conda.add_conda_subparser(subparsers)
+    metrics.add_collect_subparser(subparsers)
+    logs.add_collect_logs_subparser(subparsers)
+    staging.add_stage_data_subparser(subparsers)
+    status.add_status_subparser(subparsers)
 
     return parser.parse_args()
 
@@ -45,11 +66,22 @@ def add_deploy_subparser(parser):
     deploy_parser.add_argument("-s", "--settings", metavar="SETTINGS_FILE", help="read settings from a file, imported in order of appearance on the command line", action="append", dest="settings_files", default=[])
     deploy_parser.add_argument("--list-settings", help="list settings supported by specified framework and version", action="store_true")
     deploy_parser.add_argument("--preserve-id", help="preserve reservation id to use for deployment, or 'LAST' for the last reservation made by the user", action="store", default="LAST")
+    deploy_parser.add_argument("--skip-health-check", help="deploy to all machines without checking their health first", action="store_true")
+    deploy_parser.add_argument("--keep-unhealthy", help="report machines that are low on disk space or memory, or heavily loaded, but deploy to them anyway", action="store_true")
+    deploy_parser.add_argument("--first-machine-as-master", help="use the first machine of the reservation as master instead of the most suitable one", action="store_true")
     deploy_parser.add_argument("FRAMEWORK", help="name of the framework to deploy", action="store")
     deploy_parser.add_argument("VERSION", help="version of the framework to deploy", action="store")
     deploy_parser.add_argument("SETTINGS", help="settings as 'key=value' pairs specific to the framework, overrides values for same key from all settings files", nargs='*')
     deploy_parser.set_defaults(func=deploy_framework)
 
+def add_teardown_subparser(parser):
+    teardown_parser = parser.add_parser("teardown", help="stop a deployed Big Data framework")
+    teardown_parser.add_argument("-f", "--framework-dir", help="installation directory for Big Data frameworks", action="store", default=DEFAULT_FRAMEWORK_DIR)
+    teardown_parser.add_argument("--preserve-id", help="preserve reservation id the framework was deployed to, or 'LAST' for the last reservation made by the user", action="store", default="LAST")
+    teardown_parser.add_argument("--all", help="stop all frameworks deployed to the reservation", action="store_true")
+    teardown_parser.add_argument("FRAMEWORK", help="name of the framework to stop", action="store", nargs="?")
+    teardown_parser.set_defaults(func=teardown_framework)
+
 def list_frameworks(args):
     print("Supported frameworks:")
     if args.versions:
@@ -96,11 +128,39 @@ def deploy_framework(args):
             settings[key_value[0].strip()] = key_value[1].strip()
 
         # Deploy the framework
-        fm.deploy(args.FRAMEWORK, args.VERSION, reservation.reservation_id, machines, settings)
+        fm.deploy(args.FRAMEWORK, args.VERSION, reservation.reservation_id, machines, settings, health_check=not args.skip_health_check,
+            drop_unhealthy=not args.keep_unhealthy, select_master=not args.first_machine_as_master)
+
+def teardown_framework(args):
+    if args.all == (args.FRAMEWORK is not None):
+        sys.exit("Specify either a FRAMEWORK to tear down or --all.")
+    fm = PackageManager(get_package_registry(), args.framework_dir)
+    reservation = preserve.get_PreserveManager().fetch_reservation(args.preserve_id)
+    if args.all:
+        fm.teardown_all(reservation.reservation_id)
+    else:
+        fm.teardown(args.FRAMEWORK, reservation.reservation_id)
 
 def main():
     args = parse_arguments()
-    args.func(args)
+    executor_settings = [("timeout", args.command_timeout), ("retries", args.ssh_retries),
+        ("max_parallel", args.max_parallel), ("max_parallel_per_host", args.max_parallel_per_host),
+        ("straggler_policy", args.straggler_policy), ("straggler_factor", args.straggler_factor), ("exclude_stragglers", args.exclude_stragglers or None)]
+    executor_settings = dict((key, value) for key, value in executor_settings if value is not None)
+    if executor_settings:
+        executor.configure_executor(**executor_settings)
+    if args.purge_mode:
+        purge.set_purge_mode(args.purge_mode)
+    if args.use_agents:
+        remote.enable_agents()
+    try:
+        args.func(args)
+    except KeyboardInterrupt:
+        # Stop remote commands that are still running or queued before exiting
+        executor.get_executor().cancel_all()
+        raise
+    finally:
+        remote.disable_agents()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python2
+"""Deployer agent, started once per machine to execute commands, file writes, and probes on behalf of the deployer.
+
+The agent listens on a Unix socket and speaks a line-based JSON protocol. Every request carries an "id" and an
+"op"; requests are handled concurrently and answered with zero or more "output" messages followed by a single
+message with "done" set. Binary payloads (command output, file contents) are base64-encoded. This module must
+remain self-contained, as the machines run it straight from the deployer's directory with whichever Python they provide."""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import errno
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+_READ_SIZE = 64 * 1024
+
+class AgentServer:
+    def __init__(self, socket_path, idle_timeout=None):
+        self.__socket_path = socket_path
+        self.__idle_timeout = idle_timeout
+        self.__active_requests = 0
+        self.__last_activity = time.time()
+        self.__lock = threading.Lock()
+
+    @property
+    def socket_path(self):
+        return self.__socket_path
+
+    def serve_forever(self):
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server_socket.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server_socket.listen(16)
+        if self.__idle_timeout:
+            _start_daemon_thread(self.__exit_when_idle)
+        try:
+            while True:
+                connection, _ = server_socket.accept()
+                _start_daemon_thread(self.__serve_connection, connection)
+        finally:
+            server_socket.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def __exit_when_idle(self):
+        while True:
+            time.sleep(min(self.__idle_timeout, 10))
+            with self.__lock:
+                if self.__active_requests == 0 and time.time() - self.__last_activity > self.__idle_timeout:
+                    if os.path.exists(self.socket_path):
+                        os.remove(self.socket_path)
+                    os._exit(0)
+
+    def __serve_connection(self, connection):
+        send_lock = threading.Lock()
+        # Processes started by requests on this connection, by request id, so they can be cancelled
+        processes = {}
+        def send(message):
+            data = (json.dumps(message) + "\n").encode("utf-8")
+            with send_lock:
+                connection.sendall(data)
+        try:
+            for line in connection.makefile("rb"):
+                request = json.loads(line.decode("utf-8"))
+                with self.__lock:
+                    self.__active_requests += 1
+                    self.__last_activity = time.time()
+                _start_daemon_thread(self.__handle_request, request, send, processes)
+        except (socket.error, ValueError):
+            pass
+        finally:
+            connection.close()
+
+    def __handle_request(self, request, send, processes):
+        request_id = request.get("id")
+        try:
+            handler = _HANDLERS.get(request.get("op"))
+            if handler is None:
+                raise ValueError("Unknown operation: %s" % request.get("op"))
+            result = handler(request, lambda stream, data: send({"id": request_id, "output": stream, "data": _encode(data)}), processes)
+            response = {"id": request_id, "done": True}
+            response.update(result)
+            send(response)
+        except socket.error:
+            pass
+        except Exception as e:
+            try:
+                send({"id": request_id, "done": True, "error": "%s: %s" % (type(e).__name__, e)})
+            except socket.error:
+                pass
+        finally:
+            with self.__lock:
+                self.__active_requests -= 1
+                self.__last_activity = time.time()
+
+def _start_daemon_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+def _decode(data):
+    return base64.b64decode(data.encode("ascii"))
+
+# Mimic a non-interactive ssh session, which sources the user's bashrc (e.g., to set up Conda) before the command
+_COMMAND_PREFIX = "[ -f ~/.bashrc ] && . ~/.bashrc >/dev/null 2>&1 </dev/null; "
+
+def _kill_process_group(command_proc):
+    try:
+        os.killpg(command_proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def _execute(request, output_fn, processes):
+    stdin_data = _decode(request["stdin"]) if request.get("stdin") is not None else None
+    # Run every command in its own process group, so a timeout or cancellation also stops its children
+    with open(os.devnull, "rb") as devnull:
+        command_proc = subprocess.Popen(["bash", "-c", _COMMAND_PREFIX + request["command"]], cwd=os.path.expanduser("~"), preexec_fn=os.setsid,
+            stdin=subprocess.PIPE if stdin_data is not None else devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    processes[request["id"]] = command_proc
+    timed_out = []
+    if request.get("timeout"):
+        def expire():
+            timed_out.append(True)
+            _kill_process_group(command_proc)
+        timeout_timer = threading.Timer(request["timeout"], expire)
+        timeout_timer.daemon = True
+        timeout_timer.start()
+    def forward(stream_name, stream):
+        while True:
+            data = os.read(stream.fileno(), _READ_SIZE)
+            if not data:
+                break
+            output_fn(stream_name, data)
+    forwarders = [_start_daemon_thread(forward, "stdout", command_proc.stdout), _start_daemon_thread(forward, "stderr", command_proc.stderr)]
+    if stdin_data is not None:
+        try:
+            command_proc.stdin.write(stdin_data)
+            command_proc.stdin.close()
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+    for forwarder in forwarders:
+        forwarder.join()
+    exit_code = command_proc.wait()
+    processes.pop(request["id"], None)
+    if request.get("timeout"):
+        timeout_timer.cancel()
+    return {"exit_code": exit_code, "timed_out": bool(timed_out)}
+
+def _cancel(request, output_fn, processes):
+    command_proc = processes.get(request["target"])
+    if command_proc is not None:
+        _kill_process_group(command_proc)
+    return {"cancelled": command_proc is not None}
+
+def _write_file(request, output_fn, processes):
+    filename = request["path"]
+    file_dir = os.path.dirname(filename)
+    if file_dir and not os.path.isdir(file_dir):
+        try:
+            os.makedirs(file_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    with open(filename, "wb") as file_out:
+        file_out.write(_decode(request["content"]))
+    if request.get("mode") is not None:
+        os.chmod(filename, request["mode"])
+    return {}
+
+def _probe(request, output_fn, processes):
+    memory_kb = {}
+    with open("/proc/meminfo", "r") as meminfo_in:
+        for line in meminfo_in:
+            parts = line.split()
+            if len(parts) >= 2:
+                memory_kb[parts[0].rstrip(":")] = int(parts[1])
+    with open("/proc/loadavg", "r") as loadavg_in:
+        load_average = [float(value) for value in loadavg_in.read().split()[:3]]
+    return {
+        "hostname": socket.gethostname(),
+        "memory_mb": memory_kb.get("MemTotal", 0) // 1024,
+        "memory_available_mb": memory_kb.get("MemAvailable", memory_kb.get("MemFree", 0)) // 1024,
+        "cores": _cpu_count(),
+        "load_average": load_average
+    }
+
+def _cpu_count():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+def _ping(request, output_fn, processes):
+    return {"pid": os.getpid()}
+
+_HANDLERS = {
+    "exec": _execute,
+    "cancel": _cancel,
+    "write_file": _write_file,
+    "probe": _probe,
+    "ping": _ping
+}
+
+def _is_agent_running(socket_path):
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client_socket.close()
+
+def _daemonize():
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    with open(os.devnull, "r+b") as devnull:
+        for stream in (sys.stdin, sys.stdout, sys.stderr):
+            os.dup2(devnull.fileno(), stream.fileno())
+
+def main():
+    parser = argparse.ArgumentParser(description="Execute commands on behalf of the Big Data deployer")
+    parser.add_argument("--socket", help="path of the Unix socket to listen on", action="store", required=True)
+    parser.add_argument("--daemon", help="detach from the terminal after starting", action="store_true")
+    parser.add_argument("--idle-timeout", help="exit after this many seconds without requests", action="store", type=float, default=None)
+    args = parser.parse_args()
+
+    # Only one agent serves a socket; starting an agent when one is running is a no-op
+    if _is_agent_running(args.socket):
+        return
+    if args.daemon:
+        _daemonize()
+    AgentServer(args.socket, args.idle_timeout).serve_forever()
+
+if __name__ == "__main__":
+    main()
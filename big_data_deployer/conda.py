@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 
+from . import executor
 from . import util
 from . import preserve
 
@@ -34,10 +35,10 @@ class CondaEnv:
         util.execute_command(command_line, verbose=verbose, shell=True)
 
     def remote_command(self, machine, command_line, verbose=False):
+        # Arguments are interpreted by the remote shell, exactly as ssh would when given them separately
         if not isinstance(command_line, str):
-            command_line = " ".join([pipes.quote(arg) for arg in command_line])
-        command_line = "ssh %s conda activate %s \"&&\" %s" % (machine, pipes.quote(self.root), command_line)
-        util.execute_command(command_line, verbose=verbose, shell=True)
+            command_line = " ".join(command_line)
+        executor.run(machine, "conda activate %s && %s" % (pipes.quote(self.root), command_line), verbose=verbose)
 
     def create(self, python_version="3.7.10", pip_version=None, verbose=False, channels=["conda-forge"]):
         # Create the Conda environment
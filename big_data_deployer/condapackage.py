@@ -14,12 +14,18 @@ class CondaPackage(Package):
     def __init__(self, identifier, name):
         super(CondaPackage, self).__init__(identifier, name)
 
-    def deploy(self, package_dir, package_version, reservation_id, machines, settings, log_fn=util.log):
+    def deploy(self, package_dir, package_version, reservation_id, machines, settings, manifest, log_fn=util.log):
         conda_env = self.__get_or_create_conda_env(package_dir, reservation_id, log_fn=log_fn)
         self.__install_conda_package(conda_env, self, package_version, log_fn=log_fn)
-        self.deploy_installed(conda_env, package_version, machines, settings, log_fn=log_fn)
+        self.deploy_installed(conda_env, package_version, machines, settings, manifest, log_fn=log_fn)
 
-    def deploy_installed(self, conda, package_version, machines, settings, log_fn=util.log):
+    def deploy_installed(self, conda, package_version, machines, settings, manifest, log_fn=util.log):
+        raise NotImplementedError()
+
+    def teardown(self, package_dir, reservation_id, deployment, log_fn=util.log):
+        self.teardown_installed(get_conda_env(reservation_id, package_dir), self.version(deployment["version"]), deployment, log_fn=log_fn)
+
+    def teardown_installed(self, conda, package_version, deployment, log_fn=util.log):
         raise NotImplementedError()
 
     def __repr__(self):
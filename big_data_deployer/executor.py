@@ -0,0 +1,391 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from . import remote
+from . import util
+
+import threading
+import time
+
+_DEFAULT_MAX_PARALLEL = 64
+_DEFAULT_MAX_PARALLEL_PER_HOST = 8
+_DEFAULT_TIMEOUT = 30 * 60
+_DEFAULT_RETRIES = 2
+_DEFAULT_RETRY_BACKOFF = 1.0
+
+# What to do with a machine that takes much longer than the others to complete a step
+STRAGGLER_POLICY_REPORT = "report"
+STRAGGLER_POLICY_RETRY = "retry"
+STRAGGLER_POLICY_TIMEOUT = "timeout"
+STRAGGLER_POLICIES = [STRAGGLER_POLICY_REPORT, STRAGGLER_POLICY_RETRY, STRAGGLER_POLICY_TIMEOUT]
+_DEFAULT_STRAGGLER_POLICY = STRAGGLER_POLICY_REPORT
+_DEFAULT_STRAGGLER_FACTOR = 3.0
+# Steps shorter than this are never considered slow, as their latency is dominated by connection setup
+_STRAGGLER_MIN_DURATION = 10.0
+
+class StragglerError(Exception): pass
+
+class RemoteTask:
+    """Handle to a command scheduled on a RemoteExecutor."""
+    def __init__(self, machine, command_line, step=None):
+        self.__machine = machine
+        self.__command_line = command_line
+        self.__step = step
+        self.__cancel_event = threading.Event()
+        self.__done_event = threading.Event()
+        self.__error = None
+        self.__attempts = 0
+        self.__start_time = None
+        self.__end_time = None
+        self.__straggler = False
+        self.__restart_requested = False
+
+    @property
+    def machine(self):
+        return self.__machine
+
+    @property
+    def command_line(self):
+        return self.__command_line
+
+    @property
+    def step(self):
+        return self.__step
+
+    @property
+    def attempts(self):
+        return self.__attempts
+
+    @property
+    def duration(self):
+        """Time in seconds from the first attempt until completion, or None if the task has not completed."""
+        if self.__start_time is None or self.__end_time is None:
+            return None
+        return self.__end_time - self.__start_time
+
+    @property
+    def elapsed(self):
+        """Time in seconds since the first attempt started, or None if the task has not started."""
+        if self.__start_time is None:
+            return None
+        return (self.__end_time or time.time()) - self.__start_time
+
+    @property
+    def straggler(self):
+        return self.__straggler
+
+    @property
+    def error(self):
+        return self.__error
+
+    @property
+    def cancel_event(self):
+        return self.__cancel_event
+
+    def cancelled(self):
+        return self.__cancel_event.is_set()
+
+    def done(self):
+        return self.__done_event.is_set()
+
+    def cancel(self):
+        """Stops the command if it is running, or prevents it from starting if it is still queued."""
+        self.__cancel_event.set()
+
+    def wait(self, timeout=None):
+        """Waits for the task to complete. Returns False if it is still running after the timeout."""
+        # Wait in short intervals, as an unbounded wait cannot be interrupted in Python 2
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.__done_event.wait(0.5):
+            if deadline is not None and time.time() >= deadline:
+                return False
+        return True
+
+    def result(self):
+        """Waits for the task to complete and re-raises the error that made it fail, if any."""
+        self.wait()
+        if self.__error is not None:
+            raise self.__error
+
+    def _mark_straggler(self):
+        self.__straggler = True
+
+    def _request_restart(self):
+        self.__restart_requested = True
+        self.__cancel_event.set()
+
+    def _take_restart_request(self):
+        """Clears a pending restart request. Returns True if a restart was requested."""
+        if not self.__restart_requested:
+            return False
+        self.__restart_requested = False
+        self.__cancel_event.clear()
+        return True
+
+    def _start_attempt(self):
+        if self.__start_time is None:
+            self.__start_time = time.time()
+        self.__attempts += 1
+
+    def _finish(self, error=None):
+        self.__end_time = time.time()
+        self.__error = error
+        self.__done_event.set()
+
+class RemoteExecutor:
+    """Runs commands on remote machines in background threads, with limits on the number of concurrent commands
+    overall and per machine, a timeout per command, and retries with exponential backoff for failed connections.
+
+    Steps executed on multiple machines with run_all are monitored for stragglers: machines that take more than
+    straggler_factor times the median duration of the step. Stragglers are reported, restarted once, or aborted,
+    depending on the straggler policy. A straggler is only restarted once its first attempt has been stopped on the
+    machine, also when the machine is reached over plain ssh rather than through an agent. With exclude_stragglers set, aborted stragglers do not fail the step and
+    exclude_stragglers() leaves them out of the machines to deploy to."""
+    def __init__(self, max_parallel=_DEFAULT_MAX_PARALLEL, max_parallel_per_host=_DEFAULT_MAX_PARALLEL_PER_HOST, timeout=_DEFAULT_TIMEOUT,
+            retries=_DEFAULT_RETRIES, retry_backoff=_DEFAULT_RETRY_BACKOFF, straggler_policy=_DEFAULT_STRAGGLER_POLICY,
+            straggler_factor=_DEFAULT_STRAGGLER_FACTOR, exclude_stragglers=False, log_fn=util.log):
+        if straggler_policy not in STRAGGLER_POLICIES:
+            raise util.InvalidSetupError("Invalid straggler policy: '%s'. Expected one of '%s'." % (straggler_policy, "','".join(STRAGGLER_POLICIES)))
+        self.__max_parallel_per_host = max_parallel_per_host
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__retry_backoff = retry_backoff
+        self.__straggler_policy = straggler_policy
+        self.__straggler_factor = straggler_factor
+        self.__exclude_stragglers = exclude_stragglers
+        self.__log_fn = log_fn
+        self.__semaphore = threading.BoundedSemaphore(max_parallel)
+        self.__host_semaphores = {}
+        self.__lock = threading.Lock()
+        self.__active_tasks = set()
+        # Slow steps and failed commands by machine, as (step, seconds, median seconds, recovered) and (step, error) tuples
+        self.__slow_steps = {}
+        self.__failed_steps = {}
+
+    @property
+    def timeout(self):
+        return self.__timeout
+
+    @property
+    def retries(self):
+        return self.__retries
+
+    def submit(self, machine, command_line, step=None, verbose=False, timeout=None, retries=None):
+        """Schedules a shell command on a machine and returns a RemoteTask without waiting for it.
+
+        The timeout and number of retries default to those of the executor; a timeout of 0 disables it."""
+        task = RemoteTask(machine, command_line, step)
+        timeout = self.__timeout if timeout is None else timeout
+        retries = self.__retries if retries is None else retries
+        with self.__lock:
+            self.__active_tasks.add(task)
+        task_thread = threading.Thread(target=self.__run, args=(task, verbose, timeout, retries))
+        task_thread.daemon = True
+        task_thread.start()
+        return task
+
+    def run(self, machine, command_line, step=None, verbose=False, timeout=None, retries=None):
+        """Executes a shell command on a machine and waits for it, raising an error if it fails."""
+        self.submit(machine, command_line, step, verbose, timeout, retries).result()
+
+    def run_all(self, commands, step=None, verbose=False, timeout=None, retries=None, raise_errors=True):
+        """Executes a list of (machine, command_line) pairs concurrently and waits for all of them, handling stragglers.
+
+        Returns the completed tasks, in the order of the commands. If raise_errors is set and any command failed,
+        the first such error is re-raised after all commands have completed."""
+        tasks = [self.submit(machine, command_line, step, verbose, timeout, retries) for machine, command_line in commands]
+        self.__monitor_stragglers(tasks, step or "unnamed")
+        for task in tasks:
+            if not raise_errors or (isinstance(task.error, StragglerError) and self.__exclude_stragglers):
+                continue
+            task.result()
+        return tasks
+
+    @property
+    def slow_machines(self):
+        return sorted(self.__slow_steps.keys())
+
+    @property
+    def failed_machines(self):
+        return sorted(self.__failed_steps.keys())
+
+    def exclude_stragglers(self, machines, log_fn=util.log):
+        """Returns the given machines without those flagged as stragglers, if excluding stragglers is enabled.
+
+        Machines are never all excluded; if every machine is a straggler, none of them are left out."""
+        if not self.__exclude_stragglers:
+            return list(machines)
+        # Stragglers that completed the step quickly after being restarted are kept
+        stragglers = set(machine for machine, slow_steps in self.__slow_steps.items() if not all(recovered for _, _, _, recovered in slow_steps))
+        remaining = [machine for machine in machines if machine not in stragglers and machine not in self.__failed_steps]
+        excluded = [machine for machine in machines if machine not in remaining]
+        if not excluded:
+            return list(machines)
+        if not remaining:
+            log_fn(1, "All machines were flagged as slow or failed, not excluding any.")
+            return list(machines)
+        log_fn(1, "Excluding %d slow or failed machine(s): %s." % (len(excluded), ", ".join(excluded)))
+        return remaining
+
+    def start_operation(self, log_fn=util.log):
+        """Forgets the machines that were slow or failed during earlier operations, and logs retries and stragglers through log_fn.
+
+        Called at the start of every deployment and teardown, so a long-running process that deploys repeatedly
+        does not exclude or report a machine again for a step that failed during an earlier deployment."""
+        with self.__lock:
+            self.__slow_steps = {}
+            self.__failed_steps = {}
+            self.__log_fn = log_fn
+
+    def report(self, log_fn=util.log):
+        """Logs the machines that were slow or failed during any step."""
+        if self.__slow_steps:
+            log_fn(0, "Slow machines:")
+            for machine, slow_steps in sorted(self.__slow_steps.items()):
+                for step, seconds, median, recovered in slow_steps:
+                    log_fn(1, "%s: step \"%s\" took %.1f seconds (median: %.1f seconds)%s." % (machine, step, seconds, median, ", recovered after restart" if recovered else ""))
+        if self.__failed_steps:
+            log_fn(0, "Failed machines:")
+            for machine, failed_steps in sorted(self.__failed_steps.items()):
+                for step, error in failed_steps:
+                    log_fn(1, "%s: step \"%s\" failed: %s" % (machine, step, error))
+
+    def cancel_all(self):
+        with self.__lock:
+            active_tasks = list(self.__active_tasks)
+        for task in active_tasks:
+            task.cancel()
+
+    def __host_semaphore(self, machine):
+        with self.__lock:
+            if machine not in self.__host_semaphores:
+                self.__host_semaphores[machine] = threading.BoundedSemaphore(self.__max_parallel_per_host)
+            return self.__host_semaphores[machine]
+
+    def __monitor_stragglers(self, tasks, step):
+        """Waits for the tasks of a step, flagging and handling tasks that run much longer than the median."""
+        flagged = {}
+        while True:
+            running = [task for task in tasks if not task.done()]
+            if not running:
+                break
+            # Only judge running tasks once at least half of the machines completed the step
+            durations = [task.duration for task in tasks if task.done() and task.error is None]
+            if len(durations) >= max(2, len(tasks) // 2):
+                median = _median(durations)
+                threshold = max(_STRAGGLER_MIN_DURATION, self.__straggler_factor * median)
+                for task in running:
+                    if task not in flagged and task.elapsed is not None and task.elapsed > threshold:
+                        flagged[task] = (task.elapsed, median)
+                        self.__handle_straggler(task, step, median)
+            running[0].wait(0.5)
+
+        # Record stragglers with their full duration if they were left running
+        for task, (elapsed, median) in flagged.items():
+            if self.__straggler_policy == STRAGGLER_POLICY_REPORT:
+                self.__record_slow_step(task.machine, step, task.duration, median)
+            else:
+                recovered = self.__straggler_policy == STRAGGLER_POLICY_RETRY and task.error is None
+                self.__record_slow_step(task.machine, step, elapsed, median, recovered)
+        # Flag machines that completed the step slowly before enough machines had completed it to tell
+        durations = [task.duration for task in tasks if task.error is None]
+        if len(durations) >= 2:
+            median = _median(durations)
+            threshold = max(_STRAGGLER_MIN_DURATION, self.__straggler_factor * median)
+            for task in tasks:
+                if task not in flagged and task.error is None and task.duration > threshold:
+                    self.__record_slow_step(task.machine, step, task.duration, median)
+
+    def __handle_straggler(self, task, step, median):
+        if self.__straggler_policy == STRAGGLER_POLICY_RETRY:
+            self.__log_fn(2, "Machine \"%s\" is slow to complete step \"%s\" (%.1f seconds, median: %.1f seconds), restarting it..." % (task.machine, step, task.elapsed, median))
+            task._request_restart()
+        elif self.__straggler_policy == STRAGGLER_POLICY_TIMEOUT:
+            self.__log_fn(2, "Machine \"%s\" is slow to complete step \"%s\" (%.1f seconds, median: %.1f seconds), aborting it..." % (task.machine, step, task.elapsed, median))
+            task._mark_straggler()
+            task.cancel()
+        else:
+            self.__log_fn(2, "Machine \"%s\" is slow to complete step \"%s\" (%.1f seconds, median: %.1f seconds)." % (task.machine, step, task.elapsed, median))
+
+    def __record_slow_step(self, machine, step, seconds, median, recovered=False):
+        with self.__lock:
+            self.__slow_steps.setdefault(machine, []).append((step, seconds, median, recovered))
+
+    def __run(self, task, verbose, timeout, retries):
+        error = None
+        try:
+            with self.__semaphore:
+                with self.__host_semaphore(task.machine):
+                    self.__run_with_retries(task, verbose, timeout, retries)
+        except Exception as e:
+            error = e
+        with self.__lock:
+            self.__active_tasks.discard(task)
+            if error is not None:
+                self.__failed_steps.setdefault(task.machine, []).append((task.step or "unnamed", error))
+        task._finish(error)
+
+    def __run_with_retries(self, task, verbose, timeout, retries):
+        while True:
+            if task.cancelled():
+                raise remote.CommandCancelledError("Command was cancelled: %s" % task.command_line)
+            task._start_attempt()
+            try:
+                remote.execute(task.machine, task.command_line, verbose=verbose, timeout=timeout or None, cancel_event=task.cancel_event)
+                return
+            except remote.CommandCancelledError:
+                # remote.execute only raises once the cancelled command has stopped, so a restart never runs alongside it
+                if task._take_restart_request():
+                    continue
+                if task.straggler:
+                    raise StragglerError("Machine \"%s\" was aborted as a straggler: %s" % (task.machine, task.command_line))
+                raise
+            except (remote.SshConnectionError, remote.AgentError):
+                # Only retry failed connections; failed commands and timeouts would most likely fail again
+                if task.attempts > retries:
+                    raise
+            backoff = self.__retry_backoff * 2 ** (task.attempts - 1)
+            self.__log_fn(2, "Connection to machine \"%s\" failed, retrying in %.1f seconds..." % (task.machine, backoff))
+            task.cancel_event.wait(backoff)
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 == 1 else (values[middle - 1] + values[middle]) / 2.0
+
+def wait_for_all(tasks):
+    """Waits for all tasks to complete. If any task failed, the first such error is re-raised."""
+    for task in tasks:
+        task.wait()
+    for task in tasks:
+        task.result()
+
+__executor = None
+__executor_lock = threading.Lock()
+
+def get_executor():
+    global __executor
+    with __executor_lock:
+        if __executor is None:
+            __executor = RemoteExecutor()
+        return __executor
+
+def configure_executor(**kwargs):
+    """Replaces the shared executor by one created with the given RemoteExecutor arguments."""
+    global __executor
+    with __executor_lock:
+        __executor = RemoteExecutor(**kwargs)
+        return __executor
+
+def submit(machine, command_line, step=None, verbose=False, timeout=None, retries=None):
+    return get_executor().submit(machine, command_line, step, verbose, timeout, retries)
+
+def run(machine, command_line, step=None, verbose=False, timeout=None, retries=None):
+    get_executor().run(machine, command_line, step, verbose, timeout, retries)
+
+def run_all(commands, step=None, verbose=False, timeout=None, retries=None, raise_errors=True):
+    return get_executor().run_all(commands, step, verbose, timeout, retries, raise_errors)
+
+def exclude_stragglers(machines, log_fn=util.log):
+    return get_executor().exclude_stragglers(machines, log_fn)
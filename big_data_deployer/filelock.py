@@ -0,0 +1,172 @@
+#!/usr/bin/env python2
+
+from . import util
+
+import errno
+import json
+import os
+import socket
+import threading
+import time
+
+# A lock file that has not been refreshed for this long is considered abandoned, e.g., by a deployer that crashed on another machine
+_DEFAULT_STALE_AFTER = 60.0
+_DEFAULT_POLL_INTERVAL = 0.5
+
+class LockTimeoutError(Exception): pass
+
+class FileLock:
+    """Lock shared by deployer processes on all machines with access to the same file system, e.g., the framework directory.
+
+    The lock is held by exclusively creating a lock file that records its owner, and the owner refreshes the lock file
+    while it holds the lock. Waiting processes break the lock if its owner ran on the same machine and has exited, or
+    if the lock file has not been refreshed for stale_after seconds. Staleness is judged by changes to the lock file
+    as observed by the waiting process, so it does not depend on the clocks of different machines being in sync."""
+    def __init__(self, lock_file, stale_after=_DEFAULT_STALE_AFTER, poll_interval=_DEFAULT_POLL_INTERVAL, log_fn=util.log):
+        self.__lock_file = lock_file
+        self.__stale_after = stale_after
+        self.__poll_interval = poll_interval
+        self.__log_fn = log_fn
+        self.__owner = None
+        self.__heartbeat_stop = None
+        self.__heartbeat_thread = None
+
+    @property
+    def lock_file(self):
+        return self.__lock_file
+
+    @property
+    def is_held(self):
+        return self.__owner is not None
+
+    def acquire(self, timeout=None):
+        """Waits until the lock is acquired, or raises a LockTimeoutError after timeout seconds (default: wait indefinitely)."""
+        lock_dir = os.path.dirname(self.lock_file)
+        if not os.path.exists(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        owner = {"host": socket.gethostname(), "pid": os.getpid(), "token": "%s-%d-%f" % (socket.gethostname(), os.getpid(), time.time())}
+        deadline = None if timeout is None else time.time() + timeout
+        observed_state = None
+        observed_since = None
+        while True:
+            try:
+                lock_fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                with os.fdopen(lock_fd, "w") as lock_out:
+                    json.dump(owner, lock_out)
+                self.__owner = owner
+                self.__start_heartbeat()
+                return
+
+            # Find out who holds the lock and whether they are still alive
+            lock_owner, lock_mtime = _read_lock_file(self.lock_file)
+            if lock_mtime is None:
+                # Released in the meantime
+                continue
+            lock_state = (lock_owner.get("token"), lock_mtime)
+            if lock_state != observed_state:
+                if observed_state is None:
+                    self.__log_fn(0, "Waiting for %s to release lock \"%s\"..." % (_describe_owner(lock_owner), self.lock_file))
+                observed_state = lock_state
+                observed_since = time.time()
+            exited_locally = lock_owner.get("host") == owner["host"] and "pid" in lock_owner and not _is_process_alive(lock_owner["pid"])
+            if exited_locally or time.time() - observed_since > self.__stale_after:
+                self.__log_fn(1, "Breaking stale lock of %s." % _describe_owner(lock_owner))
+                self.__break(lock_owner.get("token"))
+                observed_state = None
+                continue
+            if deadline is not None and time.time() > deadline:
+                raise LockTimeoutError("Timed out after %.0f seconds waiting for %s to release lock \"%s\"." % (timeout, _describe_owner(lock_owner), self.lock_file))
+            time.sleep(self.__poll_interval)
+
+    def release(self):
+        if self.__owner is None:
+            return
+        self.__heartbeat_stop.set()
+        self.__heartbeat_thread.join()
+        lock_owner, _ = _read_lock_file(self.lock_file)
+        # Never remove a lock file that another process created after breaking this lock
+        if lock_owner.get("token") == self.__owner["token"]:
+            try:
+                os.remove(self.lock_file)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self.__owner = None
+
+    def __start_heartbeat(self):
+        self.__heartbeat_stop = threading.Event()
+        heartbeat_stop = self.__heartbeat_stop
+        def refresh_lock_file():
+            while not heartbeat_stop.wait(self.__stale_after / 4):
+                try:
+                    os.utime(self.lock_file, None)
+                except OSError:
+                    return
+        self.__heartbeat_thread = threading.Thread(target=refresh_lock_file)
+        self.__heartbeat_thread.daemon = True
+        self.__heartbeat_thread.start()
+
+    def __break(self, stale_token):
+        """Removes a stale lock file, unless another process replaced it after it was found to be stale."""
+        broken_file = "%s.broken-%s-%d" % (self.lock_file, socket.gethostname(), os.getpid())
+        try:
+            os.rename(self.lock_file, broken_file)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        broken_owner, _ = _read_lock_file(broken_file)
+        if broken_owner.get("token") != stale_token:
+            # Moved a live lock aside; restore it, unless the lock has been taken again already
+            try:
+                os.link(broken_file, self.lock_file)
+            except OSError:
+                pass
+        os.remove(broken_file)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __repr__(self):
+        return "FileLock{lock_file=%s,held=%s}" % (self.lock_file, self.is_held)
+
+def _read_lock_file(lock_file):
+    """Returns the owner recorded in a lock file and its modification time, or an empty owner and None if there is no lock file.
+
+    The owner may be empty while the lock file is being created."""
+    try:
+        lock_mtime = os.stat(lock_file).st_mtime
+        with open(lock_file, "r") as lock_in:
+            lock_contents = lock_in.read()
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            return {}, None
+        raise
+    try:
+        return json.loads(lock_contents), lock_mtime
+    except ValueError:
+        return {}, lock_mtime
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def _describe_owner(lock_owner):
+    if "pid" not in lock_owner:
+        return "another process"
+    return "process %d on \"%s\"" % (lock_owner["pid"], lock_owner.get("host", "unknown"))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from . import remote
+from . import util
+
+import re
+
+_PROBE_TIMEOUT = 30.0
+_MIN_LOCAL_FREE_MB = 2048
+_MIN_MEMORY_AVAILABLE_MB = 1024
+_MAX_LOAD_PER_CORE = 1.5
+
+# Processes of the user that were most likely left behind by an earlier deployment, by the framework running them
+_LEFTOVER_PROCESS_PATTERNS = {
+    "hadoop": re.compile(r"org\.apache\.hadoop"),
+    "spark": re.compile(r"org\.apache\.spark"),
+    "zookeeper": re.compile(r"org\.apache\.zookeeper"),
+    "kafka": re.compile(r"kafka\.Kafka"),
+    "postgresql": re.compile(r"postgres"),
+    "pgbouncer": re.compile(r"pgbouncer"),
+    "airflow": re.compile(r"airflow|redis-server"),
+    "influxdb": re.compile(r"influxd"),
+    "resource-monitor": re.compile(r"resource-monitor")
+}
+
+_PROBE_COMMAND = "; ".join([
+    "echo @df", "df -Pm /local 2>/dev/null | tail -n 1",
+    "echo @meminfo", "grep -E '^(MemTotal|MemAvailable):' /proc/meminfo",
+    "echo @loadavg", "cat /proc/loadavg",
+    "echo @nproc", "nproc",
+    "echo @numa", "ls -d /sys/devices/system/node/node[0-9]* 2>/dev/null | wc -l",
+    "echo @processes", "ps -u \"$USER\" -o args= 2>/dev/null",
+    "true"
+])
+
+class NodeHealth(object):
+    def __init__(self, machine, error=None, local_free_mb=None, memory_mb=None, memory_available_mb=None, load_average=None, cores=None, numa_nodes=None, leftover_processes=[]):
+        self.__machine = machine
+        self.__error = error
+        self.__local_free_mb = local_free_mb
+        self.__memory_mb = memory_mb
+        self.__memory_available_mb = memory_available_mb
+        self.__load_average = load_average
+        self.__cores = cores
+        self.__numa_nodes = numa_nodes
+        self.__leftover_processes = list(leftover_processes)
+
+    @property
+    def machine(self):
+        return self.__machine
+
+    @property
+    def reachable(self):
+        return self.__error is None
+
+    @property
+    def error(self):
+        return self.__error
+
+    @property
+    def local_free_mb(self):
+        return self.__local_free_mb
+
+    @property
+    def memory_mb(self):
+        return self.__memory_mb
+
+    @property
+    def memory_available_mb(self):
+        return self.__memory_available_mb
+
+    @property
+    def load_average(self):
+        return self.__load_average
+
+    @property
+    def cores(self):
+        return self.__cores
+
+    @property
+    def numa_nodes(self):
+        return self.__numa_nodes
+
+    @property
+    def load_per_core(self):
+        if self.__load_average is None or not self.__cores:
+            return None
+        return self.__load_average / self.__cores
+
+    @property
+    def leftover_processes(self):
+        return list(self.__leftover_processes)
+
+    def problems(self):
+        """Returns the reasons this machine is unfit to deploy to, or an empty list if it is healthy."""
+        if not self.reachable:
+            return ["unreachable (%s)" % self.__error]
+        problems = []
+        if self.__local_free_mb is not None and self.__local_free_mb < _MIN_LOCAL_FREE_MB:
+            problems.append("only %d MB free on /local" % self.__local_free_mb)
+        if self.__memory_available_mb is not None and self.__memory_available_mb < _MIN_MEMORY_AVAILABLE_MB:
+            problems.append("only %d MB of memory available" % self.__memory_available_mb)
+        if self.load_per_core is not None and self.load_per_core > _MAX_LOAD_PER_CORE:
+            problems.append("load average of %.1f on %d cores" % (self.__load_average, self.__cores))
+        return problems
+
+    def warnings(self):
+        """Returns issues that do not prevent deploying to this machine, but may interfere with it."""
+        if self.__leftover_processes:
+            return ["%d process(es) left from earlier deployments" % len(self.__leftover_processes)]
+        return []
+
+    def master_rank(self):
+        """Returns a sort key that orders machines from most to least suitable to host a master."""
+        return (len(self.__leftover_processes) > 0, self.load_per_core or 0.0, -(self.__memory_available_mb or 0), -(self.__local_free_mb or 0))
+
+    def __repr__(self):
+        return "NodeHealth{machine=%s,reachable=%s,local_free_mb=%s,memory_available_mb=%s,load_average=%s,cores=%s}" % (
+            self.machine, self.reachable, self.local_free_mb, self.memory_available_mb, self.load_average, self.cores)
+
+def _is_framework_process(process_args, frameworks=None):
+    """Returns whether a process belongs to any of the given frameworks, or to any known framework if none are given."""
+    frameworks = _LEFTOVER_PROCESS_PATTERNS.keys() if frameworks is None else frameworks
+    return any(_LEFTOVER_PROCESS_PATTERNS[framework].search(process_args) for framework in frameworks if framework in _LEFTOVER_PROCESS_PATTERNS)
+
+def _exclude_live_processes(node_health, live_frameworks):
+    """Returns the health of a machine without the processes of frameworks that are currently deployed on it."""
+    if not live_frameworks or not node_health.reachable:
+        return node_health
+    return NodeHealth(node_health.machine,
+        local_free_mb=node_health.local_free_mb,
+        memory_mb=node_health.memory_mb,
+        memory_available_mb=node_health.memory_available_mb,
+        load_average=node_health.load_average,
+        cores=node_health.cores,
+        numa_nodes=node_health.numa_nodes,
+        leftover_processes=[process_args for process_args in node_health.leftover_processes if not _is_framework_process(process_args, live_frameworks)])
+
+def _parse_probe_output(machine, probe_output):
+    sections = {}
+    section = None
+    for line in probe_output.split("\n"):
+        if line.startswith("@"):
+            section = line[1:].strip()
+            sections[section] = []
+        elif section is not None and line.strip():
+            sections[section].append(line.strip())
+    local_free_mb = None
+    for line in sections.get("df", []):
+        parts = line.split()
+        if len(parts) >= 4 and parts[3].isdigit():
+            local_free_mb = int(parts[3])
+    memory_kb = {}
+    for line in sections.get("meminfo", []):
+        parts = line.split()
+        if len(parts) >= 2 and parts[1].isdigit():
+            memory_kb[parts[0].rstrip(":")] = int(parts[1])
+    load_average = None
+    for line in sections.get("loadavg", []):
+        load_average = float(line.split()[0])
+    cores = None
+    for line in sections.get("nproc", []):
+        if line.isdigit():
+            cores = int(line)
+    numa_nodes = None
+    for line in sections.get("numa", []):
+        if line.isdigit() and int(line) > 0:
+            numa_nodes = int(line)
+    # The probe itself shows up in the process list, so skip any process mentioning its section markers
+    leftover_processes = [line for line in sections.get("processes", []) if _is_framework_process(line) and "@processes" not in line]
+    return NodeHealth(machine,
+        local_free_mb=local_free_mb,
+        memory_mb=memory_kb["MemTotal"] // 1024 if "MemTotal" in memory_kb else None,
+        memory_available_mb=memory_kb["MemAvailable"] // 1024 if "MemAvailable" in memory_kb else None,
+        load_average=load_average,
+        cores=cores,
+        numa_nodes=numa_nodes,
+        leftover_processes=leftover_processes)
+
+def probe_node(machine):
+    """Probes the free disk space on /local, memory, cores, load, and leftover processes of a machine."""
+    try:
+        probe_output = remote.execute_for_output(machine, _PROBE_COMMAND, timeout=_PROBE_TIMEOUT)
+        if "@nproc" not in probe_output:
+            return NodeHealth(machine, error="no response to probe")
+        return _parse_probe_output(machine, probe_output)
+    except (remote.CommandTimeoutError, remote.AgentError, OSError, ValueError) as e:
+        return NodeHealth(machine, error=str(e))
+
+__node_health_cache = {}
+
+def probe_nodes(machines, use_cache=False):
+    """Probes all machines in parallel and returns their health in the order of the machines.
+
+    With use_cache set, machines probed earlier in this process (e.g., by check_health) are not probed
+    again. This suits static properties such as memory and cores, not load or free disk space."""
+    unprobed = [machine for machine in machines if not use_cache or machine not in __node_health_cache]
+    for machine, node_health in zip(unprobed, util.run_in_parallel(probe_node, [(machine,) for machine in unprobed])):
+        __node_health_cache[machine] = node_health
+    return [__node_health_cache[machine] for machine in machines]
+
+def check_health(machines, drop_unhealthy=True, select_master=True, preferred_masters=[], live_deployments={}, log_fn=util.log):
+    """Probes all machines in parallel and returns the machines to deploy to, ordered by suitability as master.
+
+    If select_master is set, the first machine is the best master candidate among the healthy machines,
+    favoring machines in preferred_masters (e.g., masters of other deployments in the same reservation).
+    Remaining machines keep their original order. Unreachable machines are always dropped; other unhealthy
+    machines are dropped only if drop_unhealthy is set. Processes of the frameworks in live_deployments, a map
+    from framework to the machines it is deployed on, are expected and not counted as leftovers."""
+    log_fn(0, "Checking the health of %d machine(s)..." % len(machines))
+    live_frameworks_by_machine = {}
+    for framework, live_machines in live_deployments.items():
+        for machine in live_machines:
+            live_frameworks_by_machine.setdefault(machine, []).append(framework)
+    node_healths = [_exclude_live_processes(node_health, live_frameworks_by_machine.get(node_health.machine))
+        for node_health in probe_nodes(machines)]
+    healthy = []
+    unhealthy = []
+    for node_health in node_healths:
+        for warning in node_health.warnings():
+            log_fn(1, "Warning: machine \"%s\" has %s." % (node_health.machine, warning))
+        problems = node_health.problems()
+        if problems:
+            log_fn(1, "Machine \"%s\" is unhealthy: %s." % (node_health.machine, "; ".join(problems)))
+            if node_health.reachable and not drop_unhealthy:
+                unhealthy.append(node_health)
+        else:
+            healthy.append(node_health)
+    if not healthy and not unhealthy:
+        raise util.InvalidSetupError("None of the %d machine(s) is healthy enough to deploy to." % len(machines))
+    if len(healthy) + len(unhealthy) < len(machines):
+        log_fn(1, "Dropped %d machine(s) from the deployment." % (len(machines) - len(healthy) - len(unhealthy)))
+
+    # Prefer healthy machines; keep unhealthy machines, if any, at the end
+    candidates = healthy or unhealthy
+    ordered = healthy + unhealthy
+    if select_master:
+        preferred = [node_health for node_health in candidates if node_health.machine in preferred_masters]
+        master = min(preferred or candidates, key=lambda node_health: node_health.master_rank())
+        ordered.remove(master)
+        ordered.insert(0, master)
+        log_fn(1, "Selected \"%s\" as master (load per core: %.2f, available memory: %s MB, free on /local: %s MB)." % (
+            master.machine, master.load_per_core or 0.0, master.memory_available_mb, master.local_free_mb))
+    return [node_health.machine for node_health in ordered]
@@ -0,0 +1,100 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from . import util
+
+import socket
+
+INTERCONNECT_IB = "ib"
+INTERCONNECT_ETH = "eth"
+INTERCONNECT_AUTO = "auto"
+INTERCONNECTS = [INTERCONNECT_IB, INTERCONNECT_ETH, INTERCONNECT_AUTO]
+DEFAULT_INTERCONNECT = INTERCONNECT_AUTO
+
+SETTING_DESCRIPTION = "network to bind services and route traffic over: 'ib' (InfiniBand), 'eth' (Ethernet), or 'auto' (InfiniBand where available)"
+
+# Name of the file, generated in a framework's configuration directory, that maps each machine to its address
+ADDRESS_FILENAME = "interconnect-addresses"
+
+_IB_DOMAIN = "ib.cluster"
+_NETWORK_NAMES = {INTERCONNECT_IB: "InfiniBand", INTERCONNECT_ETH: "Ethernet"}
+
+class InterconnectAddress:
+    """Address of a machine on the interconnect selected for a deployment."""
+    def __init__(self, machine, interconnect, hostname, ip_address):
+        self.__machine = machine
+        self.__interconnect = interconnect
+        self.__hostname = hostname
+        self.__ip_address = ip_address
+
+    @property
+    def machine(self):
+        return self.__machine
+
+    @property
+    def interconnect(self):
+        return self.__interconnect
+
+    @property
+    def hostname(self):
+        return self.__hostname
+
+    @property
+    def ip_address(self):
+        return self.__ip_address
+
+    def __repr__(self):
+        return "InterconnectAddress{machine=%s,interconnect=%s,hostname=%s,ip_address=%s}" % (self.machine, self.interconnect, self.hostname, self.ip_address)
+
+def short_hostname(hostname):
+    """Returns the name of a machine without domain, e.g., "node301" for "node301.ib.cluster"."""
+    return hostname.split(".")[0]
+
+def interface_hostname(machine, interconnect):
+    """Returns the hostname of a machine's interface on the InfiniBand or Ethernet network."""
+    if interconnect == INTERCONNECT_IB:
+        return "%s.%s" % (short_hostname(machine), _IB_DOMAIN)
+    return short_hostname(machine)
+
+def parse_interconnect(value):
+    interconnect = str(value).lower()
+    if interconnect not in INTERCONNECTS:
+        raise util.InvalidSetupError("Invalid interconnect: '%s'. Expected one of '%s'." % (value, "','".join(INTERCONNECTS)))
+    return interconnect
+
+def _resolve_address(machine, interconnect):
+    candidates = [INTERCONNECT_IB, INTERCONNECT_ETH] if interconnect == INTERCONNECT_AUTO else [interconnect]
+    for candidate in candidates:
+        hostname = interface_hostname(machine, candidate)
+        try:
+            return InterconnectAddress(machine, candidate, hostname, socket.gethostbyname(hostname))
+        except socket.error:
+            pass
+    raise util.InvalidSetupError("Cannot resolve the address of machine \"%s\" on the %s network." % (machine, " or ".join([_NETWORK_NAMES[candidate] for candidate in candidates])))
+
+__address_cache = {}
+
+def resolve_addresses(machines, interconnect, log_fn=util.log):
+    """Resolves the address of every machine on the selected interconnect, concurrently, and returns them by machine.
+
+    With the "auto" interconnect, machines use InfiniBand if their InfiniBand hostname resolves, and Ethernet
+    otherwise. Addresses are resolved once and cached for the remainder of the process."""
+    unresolved = [machine for machine in machines if (machine, interconnect) not in __address_cache]
+    for machine, address in zip(unresolved, util.run_in_parallel(_resolve_address, [(machine, interconnect) for machine in unresolved])):
+        __address_cache[(machine, interconnect)] = address
+    addresses = dict((machine, __address_cache[(machine, interconnect)]) for machine in machines)
+    fallback_machines = sorted([machine for machine, address in addresses.items() if address.interconnect != INTERCONNECT_IB])
+    if interconnect == INTERCONNECT_AUTO and fallback_machines:
+        log_fn(0, "Machine(s) \"%s\" have no InfiniBand address, using Ethernet instead." % "\",\"".join(fallback_machines))
+    return addresses
+
+def address_file_contents(addresses):
+    """Returns the contents of an address file, listing the short hostname, IP address, and hostname of each machine.
+
+    Configuration scripts sourced on every machine (e.g., hadoop-env.sh) look up their own line with local_address_command."""
+    return "\n".join(["%s %s %s" % (short_hostname(machine), address.ip_address, address.hostname) for machine, address in sorted(addresses.items())]) + "\n"
+
+def local_address_command(address_file, field):
+    """Returns a shell command that prints the "ip_address" or "hostname" of the local machine from an address file."""
+    return "awk -v host=\"$(hostname -s)\" '$1 == host { print $%d }' \"%s\" 2>/dev/null" % ({"ip_address": 2, "hostname": 3}[field], address_file)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from . import health
+from . import util
+
+import re
+
+ROLE_MASTER = "master"
+ROLE_WORKER = "worker"
+ROLE_BROKER = "broker"
+ROLE_COORDINATOR = "coordinator"
+ROLE_AUXILIARY = "auxiliary"
+
+GC_G1 = "g1"
+GC_PARALLEL = "parallel"
+GCS = [GC_G1, GC_PARALLEL]
+
+class _RoleDefaults:
+    """Sizing rules for the daemons of a role: the share of a machine's memory and cores they may use, and whether they favor short pauses."""
+    def __init__(self, memory_fraction, min_heap_mb, max_heap_mb, gc_thread_fraction, low_latency, pretouch):
+        self.memory_fraction = memory_fraction
+        self.min_heap_mb = min_heap_mb
+        self.max_heap_mb = max_heap_mb
+        self.gc_thread_fraction = gc_thread_fraction
+        self.low_latency = low_latency
+        self.pretouch = pretouch
+
+_ROLE_DEFAULTS = {
+    # Masters (e.g., namenode, resourcemanager) keep all cluster metadata in their heap
+    ROLE_MASTER: _RoleDefaults(0.25, 1024, 31 * 1024, 1.0, True, True),
+    # Worker daemons (e.g., datanode) share their machine with the containers and executors doing the actual work
+    ROLE_WORKER: _RoleDefaults(0.03, 512, 4 * 1024, 0.25, False, False),
+    # Brokers rely on the page cache rather than their heap
+    ROLE_BROKER: _RoleDefaults(0.25, 1024, 6 * 1024, 0.5, True, True),
+    ROLE_COORDINATOR: _RoleDefaults(0.1, 512, 4 * 1024, 0.5, True, True),
+    # Auxiliary masters (e.g., the secondary namenode and Spark's standalone master) hold little state and share a machine with other masters
+    ROLE_AUXILIARY: _RoleDefaults(0.0, 1024, 1024, 0.25, False, False)
+}
+
+# Heaps below 32 GB can use compressed object pointers
+_MAX_HEAP_MB = 31 * 1024
+# The heaps of all daemons on a machine, including those of other deployments, together use at most this share of its memory
+_MACHINE_HEAP_FRACTION = 0.5
+# Small heaps collect fastest with the throughput collector, unless a daemon needs short pauses
+_G1_MIN_HEAP_MB = 4 * 1024
+_G1_MAX_PAUSE_MS = 200
+# Assumed for machines that could not be probed
+_FALLBACK_CORES = 2
+
+_HEAP_PATTERN = re.compile(r"^(\d+)([mMgG]?)$")
+
+class JvmProfile:
+    """JVM options of a daemon, derived from the hardware of the machines it runs on and its role."""
+    def __init__(self, daemon, role, heap_mb, gc, gc_threads, numa, pretouch, extra_opts=""):
+        self.__daemon = daemon
+        self.__role = role
+        self.__heap_mb = heap_mb
+        self.__gc = gc
+        self.__gc_threads = gc_threads
+        self.__numa = numa
+        self.__pretouch = pretouch
+        self.__extra_opts = extra_opts
+
+    @property
+    def daemon(self):
+        return self.__daemon
+
+    @property
+    def role(self):
+        return self.__role
+
+    @property
+    def heap_mb(self):
+        return self.__heap_mb
+
+    @property
+    def gc(self):
+        return self.__gc
+
+    @property
+    def gc_threads(self):
+        return self.__gc_threads
+
+    @property
+    def numa(self):
+        return self.__numa
+
+    @property
+    def pretouch(self):
+        return self.__pretouch
+
+    @property
+    def extra_opts(self):
+        return self.__extra_opts
+
+    def heap_opts(self):
+        """Returns the heap size flags. Pre-touched heaps are committed in full at startup."""
+        if self.__pretouch:
+            return "-Xms%dm -Xmx%dm" % (self.__heap_mb, self.__heap_mb)
+        return "-Xmx%dm" % self.__heap_mb
+
+    def performance_opts(self):
+        """Returns the garbage collection, NUMA, and pre-touch flags, followed by any user-specified options."""
+        opts = []
+        if self.__gc == GC_G1:
+            opts += ["-XX:+UseG1GC", "-XX:MaxGCPauseMillis=%d" % _G1_MAX_PAUSE_MS, "-XX:ParallelGCThreads=%d" % self.__gc_threads,
+                "-XX:ConcGCThreads=%d" % max(1, (self.__gc_threads + 2) // 4)]
+            if self.__numa:
+                opts.append("-XX:+UseNUMAInterleaving")
+        else:
+            opts += ["-XX:+UseParallelGC", "-XX:ParallelGCThreads=%d" % self.__gc_threads]
+            if self.__numa:
+                opts.append("-XX:+UseNUMA")
+        if self.__pretouch:
+            opts.append("-XX:+AlwaysPreTouch")
+        if self.__extra_opts:
+            opts.append(self.__extra_opts)
+        return " ".join(opts)
+
+    def java_opts(self):
+        return "%s %s" % (self.heap_opts(), self.performance_opts())
+
+    def __repr__(self):
+        return "JvmProfile{daemon=%s,role=%s,heap_mb=%d,gc=%s,gc_threads=%d,numa=%s,pretouch=%s}" % (
+            self.daemon, self.role, self.heap_mb, self.gc, self.gc_threads, self.numa, self.pretouch)
+
+def _default_gc_threads(cores):
+    """Returns the number of parallel GC threads the JVM itself would pick for a number of cores."""
+    return cores if cores <= 8 else 8 + (cores - 8) * 5 // 8
+
+def _default_heap_mb(defaults, memory_mb):
+    """Returns the heap size of a daemon alone on a machine with the given memory (0 if unknown)."""
+    heap_mb = int(memory_mb * defaults.memory_fraction)
+    return max(defaults.min_heap_mb, min(defaults.max_heap_mb, _MAX_HEAP_MB, heap_mb - heap_mb % 64))
+
+def parse_heap_mb(value):
+    """Parses a heap size in megabytes, or with an "m" or "g" suffix, e.g., "4096", "4096m", or "4g"."""
+    match = _HEAP_PATTERN.match(str(value).strip())
+    if not match:
+        raise util.InvalidSetupError("Invalid heap size: '%s'. Expected a number of megabytes, optionally followed by 'm' or 'g'." % value)
+    return int(match.group(1)) * (1024 if match.group(2).lower() == "g" else 1)
+
+def supported_settings(daemons):
+    """Returns the deployment settings that override the JVM profiles of the given daemons, with their descriptions."""
+    settings = []
+    for daemon in daemons:
+        settings += [
+            ("%s_heap" % daemon, "heap size of the %s JVM, e.g., '4g' (default: derived from the machine's memory)" % daemon),
+            ("%s_gc" % daemon, "garbage collector of the %s JVM: '%s' (default: derived from the heap size)" % (daemon, "' or '".join(GCS))),
+            ("%s_java_opts" % daemon, "additional options for the %s JVM" % daemon)
+        ]
+    return settings
+
+def pop_overrides(settings, daemons):
+    """Removes the JVM settings of the given daemons from the deployment settings and returns them by daemon."""
+    overrides = {}
+    for daemon in daemons:
+        daemon_overrides = {}
+        heap = settings.pop("%s_heap" % daemon, None)
+        if heap is not None:
+            daemon_overrides["heap_mb"] = parse_heap_mb(heap)
+        gc = settings.pop("%s_gc" % daemon, None)
+        if gc is not None:
+            if str(gc).lower() not in GCS:
+                raise util.InvalidSetupError("Invalid value for JVM setting '%s_gc': '%s'. Expected one of '%s'." % (daemon, gc, "','".join(GCS)))
+            daemon_overrides["gc"] = str(gc).lower()
+        java_opts = settings.pop("%s_java_opts" % daemon, None)
+        if java_opts is not None:
+            daemon_overrides["extra_opts"] = str(java_opts)
+        overrides[daemon] = daemon_overrides
+    return overrides
+
+def compute_profile(daemon, role, node_healths, overrides={}, heap_mb=None, pretouch=None):
+    """Computes the JVM profile of a daemon running on the given machines, sized for the smallest of them.
+
+    Configuration files are shared by all machines of a deployment, so a daemon running on several machines
+    gets a single profile. Overrides may replace the computed "heap_mb" and "gc" and add "extra_opts". The
+    heap size and whether to pre-touch it are computed as if the daemon ran alone, unless they are given."""
+    defaults = _ROLE_DEFAULTS[role]
+    memory_mb = min([node_health.memory_mb for node_health in node_healths if node_health.memory_mb] or [0])
+    cores = min([node_health.cores for node_health in node_healths if node_health.cores] or [_FALLBACK_CORES])
+    numa_nodes = min([node_health.numa_nodes for node_health in node_healths if node_health.numa_nodes] or [1])
+
+    if heap_mb is None:
+        heap_mb = overrides.get("heap_mb")
+    if heap_mb is None:
+        heap_mb = _default_heap_mb(defaults, memory_mb)
+    gc = overrides.get("gc")
+    if gc is None:
+        gc = GC_G1 if defaults.low_latency or heap_mb >= _G1_MIN_HEAP_MB else GC_PARALLEL
+    gc_threads = max(1, int(_default_gc_threads(cores) * defaults.gc_thread_fraction))
+    if pretouch is None:
+        # Pre-touching a heap that does not fit in memory would push the machine into swap
+        pretouch = defaults.pretouch and memory_mb > 0 and heap_mb <= int(memory_mb * _MACHINE_HEAP_FRACTION)
+    return JvmProfile(daemon, role, heap_mb, gc, gc_threads, numa_nodes > 1, pretouch, overrides.get("extra_opts", ""))
+
+def _size_heaps(daemon_roles, daemon_machines, memory_mb, overrides, reserved_heaps, log_fn):
+    """Returns the heap size of every daemon, scaling down the computed heaps of daemons that share a machine to fit its budget."""
+    machine_heaps = dict((machine, {}) for machine in memory_mb)
+    for daemon, role in daemon_roles.items():
+        for machine in daemon_machines[daemon]:
+            machine_heaps[machine][daemon] = overrides.get(daemon, {}).get("heap_mb") or _default_heap_mb(_ROLE_DEFAULTS[role], memory_mb[machine])
+    for machine, heaps in sorted(machine_heaps.items()):
+        if not memory_mb[machine]:
+            continue
+        budget_mb = int(memory_mb[machine] * _MACHINE_HEAP_FRACTION) - reserved_heaps.get(machine, {}).get("heap_mb", 0)
+        computed = [daemon for daemon in heaps if "heap_mb" not in overrides.get(daemon, {})]
+        available_mb = budget_mb - sum([heap_mb * daemon_machines[daemon].count(machine) for daemon, heap_mb in heaps.items() if daemon not in computed])
+        computed_mb = sum([heaps[daemon] * daemon_machines[daemon].count(machine) for daemon in computed])
+        if computed_mb <= available_mb:
+            continue
+        scale = max(0.0, float(available_mb) / computed_mb)
+        for daemon in computed:
+            heap_mb = int(heaps[daemon] * scale)
+            heaps[daemon] = max(_ROLE_DEFAULTS[daemon_roles[daemon]].min_heap_mb, heap_mb - heap_mb % 64)
+        log_fn(0, "Scaled down the heaps of %s on machine \"%s\", where all JVM heaps share %d MB." % (", ".join(sorted(computed)), machine,
+            int(memory_mb[machine] * _MACHINE_HEAP_FRACTION)))
+    heaps_mb = {}
+    for daemon, role in daemon_roles.items():
+        default_heap_mb = overrides.get(daemon, {}).get("heap_mb") or _default_heap_mb(_ROLE_DEFAULTS[role], 0)
+        heaps_mb[daemon] = min([machine_heaps[machine][daemon] for machine in daemon_machines[daemon]] or [default_heap_mb])
+    return heaps_mb
+
+def compute_profiles(daemon_roles, daemon_machines, overrides={}, reserved_heaps={}, log_fn=util.log):
+    """Computes the JVM profiles of several daemons and returns them by daemon.
+
+    daemon_roles maps each daemon to its role, and daemon_machines to the machines it runs on (listing a machine once
+    for every instance of the daemon on it, e.g., for several Spark workers on a machine). Machines are
+    probed once per process, reusing the results of the health check where available. All heaps on a machine,
+    including the reserved_heaps of other deployments (see reserved_heaps()), share half of its memory: computed
+    heaps are scaled down to fit, and heaps are pre-touched only as long as all pre-touched heaps fit."""
+    machines = sorted(set([machine for machines in daemon_machines.values() for machine in machines]))
+    node_healths = dict(zip(machines, health.probe_nodes(machines, use_cache=True)))
+    unprobed = [machine for machine in machines if node_healths[machine].memory_mb is None]
+    if unprobed:
+        log_fn(0, "Could not determine the hardware of machine(s) \"%s\", using minimal JVM heap sizes." % "\",\"".join(unprobed))
+    memory_mb = dict((machine, node_healths[machine].memory_mb or 0) for machine in machines)
+    heaps_mb = _size_heaps(daemon_roles, daemon_machines, memory_mb, overrides, reserved_heaps, log_fn)
+
+    # Pre-touch the largest heaps first, as long as all pre-touched heaps on each of their machines fit in its budget
+    pretouched_mb = dict((machine, reserved_heaps.get(machine, {}).get("pretouched_mb", 0)) for machine in machines)
+    pretouch = {}
+    for daemon in sorted(daemon_roles, key=lambda daemon: (-heaps_mb[daemon], daemon)):
+        pretouch[daemon] = _ROLE_DEFAULTS[daemon_roles[daemon]].pretouch and len(daemon_machines[daemon]) > 0 and all([memory_mb[machine] > 0 and
+            pretouched_mb[machine] + heaps_mb[daemon] * daemon_machines[daemon].count(machine) <= int(memory_mb[machine] * _MACHINE_HEAP_FRACTION)
+            for machine in set(daemon_machines[daemon])])
+        if pretouch[daemon]:
+            for machine in daemon_machines[daemon]:
+                pretouched_mb[machine] += heaps_mb[daemon]
+
+    profiles = {}
+    for daemon, role in sorted(daemon_roles.items()):
+        profile = compute_profile(daemon, role, [node_healths[machine] for machine in daemon_machines[daemon]], overrides.get(daemon, {}),
+            heap_mb=heaps_mb[daemon], pretouch=pretouch[daemon])
+        log_fn(0, "JVM profile of %s: %d MB heap, %s GC with %d thread(s)%s%s." % (daemon, profile.heap_mb, profile.gc, profile.gc_threads,
+            ", NUMA-aware" if profile.numa else "", ", pre-touched" if profile.pretouch else ""))
+        profiles[daemon] = profile
+    return profiles
+
+def machine_heaps(profiles, daemon_machines):
+    """Returns the total size of the heaps of the given profiles on every machine, and how much of it is pre-touched.
+
+    Packages record these in the "jvm_heaps" property of their deployment, so later deployments can size their heaps around them."""
+    heaps = {}
+    for daemon, profile in profiles.items():
+        for machine in daemon_machines[daemon]:
+            machine_heap = heaps.setdefault(machine, {"heap_mb": 0, "pretouched_mb": 0})
+            machine_heap["heap_mb"] += profile.heap_mb
+            if profile.pretouch:
+                machine_heap["pretouched_mb"] += profile.heap_mb
+    return heaps
+
+def reserved_heaps(manifest, package_identifier):
+    """Returns the heaps recorded by the deployments of all packages but the given one (which is being redeployed), by machine."""
+    reserved = {}
+    for identifier, deployment in manifest.deployments.items():
+        if identifier == package_identifier:
+            continue
+        for machine, machine_heap in deployment["properties"].get("jvm_heaps", {}).items():
+            reserved_heap = reserved.setdefault(machine, {"heap_mb": 0, "pretouched_mb": 0})
+            reserved_heap["heap_mb"] += machine_heap["heap_mb"]
+            reserved_heap["pretouched_mb"] += machine_heap["pretouched_mb"]
+    return reserved
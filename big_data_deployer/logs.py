@@ -0,0 +1,168 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from . import util
+from . import preserve
+from . import remote
+from .manifest import get_deployment_manifest
+from .package import get_package_registry
+
+import json
+import os
+import re
+import subprocess
+import tarfile
+import threading
+import time
+
+_FETCH_TIMEOUT = 30 * 60
+_APPLICATION_ID_PATTERNS = [
+    re.compile(r"application_\d+_\d+"),
+    re.compile(r"app-\d{14}-\d{4}")
+]
+_CONTAINER_ID_PATTERN = re.compile(r"container_(?:e\d+_)?(\d+_\d+)_\d+_\d+")
+
+class BandwidthLimiter:
+    """Token bucket shared by all concurrent transfers to cap their combined bandwidth."""
+    def __init__(self, bytes_per_second):
+        self.__bytes_per_second = float(bytes_per_second)
+        self.__available = 0.0
+        self.__last_update = time.time()
+        self.__lock = threading.Lock()
+
+    def consume(self, num_bytes):
+        """Blocks until num_bytes may be transferred without exceeding the bandwidth cap."""
+        with self.__lock:
+            now = time.time()
+            self.__available = min(self.__bytes_per_second, self.__available + (now - self.__last_update) * self.__bytes_per_second)
+            self.__last_update = now
+            self.__available -= num_bytes
+            deficit = -self.__available
+        if deficit > 0:
+            time.sleep(deficit / self.__bytes_per_second)
+
+def _fetch_logs(machine, paths, archive_file, bandwidth_limiter):
+    """Streams the given log paths from a machine as a compressed archive. Returns the number of bytes transferred."""
+    archive_dir = os.path.dirname(archive_file)
+    if not os.path.exists(archive_dir):
+        os.makedirs(archive_dir)
+    # Paths are left unquoted so the remote shell expands wildcards; missing paths are skipped by tar
+    tar_command = "cd && tar -czf - --ignore-failed-read %s 2>/dev/null" % " ".join(paths)
+    transferred = [0]
+    with open(archive_file, "wb") as archive_out:
+        def write_chunk(chunk):
+            if bandwidth_limiter:
+                bandwidth_limiter.consume(len(chunk))
+            archive_out.write(chunk)
+            transferred[0] += len(chunk)
+        remote.execute_streaming(machine, tar_command, write_chunk, timeout=_FETCH_TIMEOUT)
+    return transferred[0]
+
+def _try_fetch_logs(machine, paths, archive_file, bandwidth_limiter):
+    """Fetches the logs of a machine, returning the error instead of raising it if the fetch fails."""
+    try:
+        return _fetch_logs(machine, paths, archive_file, bandwidth_limiter), None
+    except (subprocess.CalledProcessError, remote.CommandTimeoutError, remote.AgentError, EnvironmentError) as e:
+        if os.path.exists(archive_file):
+            os.remove(archive_file)
+        return None, e
+
+def _application_ids(member_name):
+    application_ids = set()
+    for pattern in _APPLICATION_ID_PATTERNS:
+        application_ids.update(pattern.findall(member_name))
+    for container_match in _CONTAINER_ID_PATTERN.finditer(member_name):
+        application_ids.add("application_%s" % container_match.group(1))
+    return application_ids
+
+def _index_archive(archive_file):
+    """Lists the files in an archive and the application ids found in their paths."""
+    members = []
+    application_ids = set()
+    with tarfile.open(archive_file, "r:gz") as archive_tar:
+        for member in archive_tar:
+            if member.isfile():
+                members.append(member.name)
+                application_ids.update(_application_ids(member.name))
+    return members, sorted(application_ids)
+
+def collect_logs(manifest, archive_dir, frameworks=None, bandwidth_limit=None, package_registry=None, log_fn=util.log):
+    """Fetches the logs of all deployed frameworks from all machines concurrently into an indexed archive directory.
+
+    The bandwidth limit, in bytes per second, applies to all transfers combined. Transfers that fail or time out
+    are logged and listed under "failed" in the index. Returns the index, which is also written to "index.json"
+    in the archive directory."""
+    package_registry = package_registry or get_package_registry()
+    deployments = manifest.deployments
+    if frameworks:
+        unknown_frameworks = [framework for framework in frameworks if framework not in deployments]
+        if unknown_frameworks:
+            raise util.InvalidSetupError("No deployment has been recorded for framework(s): '%s'" % "','".join(unknown_frameworks))
+        deployments = dict((framework, deployments[framework]) for framework in frameworks)
+
+    # Group log paths by machine and framework, so every machine is contacted once per framework
+    transfers = []
+    for framework, deployment in sorted(deployments.items()):
+        paths_by_machine = {}
+        for path, machines in package_registry.package(framework).get_log_locations(deployment):
+            for machine in machines:
+                paths_by_machine.setdefault(machine, []).append(path)
+        for machine, paths in sorted(paths_by_machine.items()):
+            transfers.append((machine, framework, paths, os.path.join(archive_dir, machine, "%s.tar.gz" % framework)))
+    log_fn(0, "Collecting logs of %d framework(s) in %d transfer(s)..." % (len(deployments), len(transfers)))
+
+    # Fetch all archives concurrently
+    bandwidth_limiter = BandwidthLimiter(bandwidth_limit) if bandwidth_limit else None
+    start_time = time.time()
+    results = util.run_in_parallel(_try_fetch_logs, [(machine, paths, archive_file, bandwidth_limiter) for machine, _, paths, archive_file in transfers])
+    elapsed = max(time.time() - start_time, 1e-3)
+    log_fn(1, "Transferred %.1f MB in %.1f seconds." % (sum(archive_bytes or 0 for archive_bytes, _ in results) / 1e6, elapsed))
+
+    # Index the archives by host, framework, and application id
+    log_fn(0, "Indexing log archives...")
+    index = {"archives": [], "applications": {}, "failed": []}
+    for (machine, framework, paths, archive_file), (archive_bytes, error) in zip(transfers, results):
+        if error is None:
+            try:
+                members, application_ids = _index_archive(archive_file)
+            except (tarfile.TarError, EOFError, IOError) as e:
+                error = e
+        if error is not None:
+            log_fn(1, "Failed to collect logs of %s from \"%s\": %s" % (framework, machine, error))
+            index["failed"].append({"host": machine, "framework": framework, "error": str(error)})
+            continue
+        relative_archive_file = os.path.relpath(archive_file, archive_dir)
+        index["archives"].append({
+            "host": machine,
+            "framework": framework,
+            "file": relative_archive_file,
+            "bytes": archive_bytes,
+            "members": members,
+            "applications": application_ids
+        })
+        for application_id in application_ids:
+            index["applications"].setdefault(application_id, []).append(relative_archive_file)
+    with open(os.path.join(archive_dir, "index.json"), "w") as index_out:
+        json.dump(index, index_out, indent=2, sort_keys=True, separators=(",", ": "))
+    log_fn(1, "Indexed %d archive(s) with logs of %d application(s)." % (len(index["archives"]), len(index["applications"])))
+    if index["failed"]:
+        log_fn(1, "Failed to collect %d archive(s); see \"failed\" in the index." % len(index["failed"]))
+    return index
+
+def add_collect_logs_subparser(parser):
+    collect_logs_parser = parser.add_parser("collect-logs", help="collect logs of deployed frameworks from all machines into a per-reservation archive")
+    collect_logs_parser.add_argument("-f", "--framework-dir", help="installation directory for Big Data frameworks", action="store", default=util.DEFAULT_FRAMEWORK_DIR)
+    collect_logs_parser.add_argument("--preserve-id", help="preserve reservation id to collect logs from, or 'LAST' for the last reservation made by the user", action="store", default="LAST")
+    collect_logs_parser.add_argument("-o", "--output", help="directory to write the archive to (default: FRAMEWORK_DIR/logs/reservation-ID)", action="store")
+    collect_logs_parser.add_argument("--bandwidth-limit", metavar="MBPS", help="maximum combined transfer rate in MB/s (default: unlimited)", action="store", type=float)
+    collect_logs_parser.add_argument("FRAMEWORK", help="framework to collect logs of (default: all deployed frameworks)", nargs="*")
+    collect_logs_parser.set_defaults(func=__collect_logs)
+
+def __collect_logs(args):
+    reservation = preserve.get_PreserveManager().fetch_reservation(args.preserve_id)
+    manifest = get_deployment_manifest(args.framework_dir, reservation.reservation_id)
+    archive_dir = args.output or os.path.join(args.framework_dir, "logs", "reservation-%s" % reservation.reservation_id)
+    bandwidth_limit = args.bandwidth_limit * 1e6 if args.bandwidth_limit else None
+    collect_logs(manifest, archive_dir, frameworks=args.FRAMEWORK, bandwidth_limit=bandwidth_limit)
+    print("Logs archived in \"%s\"." % archive_dir)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+
+import json
+import os
+import tempfile
+import time
+
+class DeploymentManifest:
+    """Records which packages are deployed in a reservation, on which machines, and which services they offer."""
+    def __init__(self, manifest_file):
+        self.__manifest_file = manifest_file
+        self.__deployments = _read_deployments(manifest_file)
+        self.__changed_deployments = set()
+
+    @property
+    def manifest_file(self):
+        return self.__manifest_file
+
+    @property
+    def deployments(self):
+        return self.__deployments.copy()
+
+    def deployment(self, package_identifier):
+        """Returns the recorded deployment of a package, or None if the package has not been deployed."""
+        return self.__deployments.get(package_identifier)
+
+    def record_deployment(self, package_identifier, version, master, machines, services={}, properties={}):
+        """Records the deployment of a package, replacing any previous deployment of the same package.
+
+        Services map a service name to the "host" and "port" it listens on. Properties hold any
+        additional information other packages may need to integrate with this deployment."""
+        self.__deployments[package_identifier] = {
+            "version": version,
+            "master": master,
+            "machines": list(machines),
+            "services": dict(services),
+            "properties": dict(properties),
+            "deployed_at": time.time()
+        }
+        self.__changed_deployments.add(package_identifier)
+
+    def update_deployment(self, package_identifier, **fields):
+        """Adds or replaces fields of a recorded deployment, e.g., the settings and timings recorded by the package manager."""
+        self.__deployments[package_identifier].update(fields)
+        self.__changed_deployments.add(package_identifier)
+
+    def remove_deployment(self, package_identifier):
+        if package_identifier in self.__deployments:
+            del self.__deployments[package_identifier]
+            self.__changed_deployments.add(package_identifier)
+
+    def save(self):
+        """Writes changed deployments to the manifest file, preserving deployments recorded concurrently by other processes."""
+        deployments = _read_deployments(self.manifest_file)
+        for package_identifier in self.__changed_deployments:
+            if package_identifier in self.__deployments:
+                deployments[package_identifier] = self.__deployments[package_identifier]
+            else:
+                deployments.pop(package_identifier, None)
+        manifest_dir = os.path.dirname(self.manifest_file)
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        # Write to a temporary file first, so readers never observe a partially written manifest
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=manifest_dir, prefix=".manifest-")
+        with os.fdopen(tmp_fd, "w") as manifest_out:
+            json.dump({"deployments": deployments}, manifest_out, indent=2, sort_keys=True, separators=(",", ": "))
+        os.rename(tmp_file, self.manifest_file)
+        self.__deployments = deployments
+        self.__changed_deployments = set()
+
+def _read_deployments(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r") as manifest_in:
+        return json.load(manifest_in).get("deployments", {})
+
+def get_deployment_manifest(package_dir, reservation_id):
+    return DeploymentManifest(os.path.join(package_dir, "deployments", "reservation-%s.json" % str(reservation_id)))
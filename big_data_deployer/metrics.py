@@ -0,0 +1,245 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from . import util
+from . import preserve
+from . import remote
+from .manifest import get_deployment_manifest
+
+import array
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+# Metrics store layout: magic, index length (uint64), JSON index, padding to 8 bytes, then per-series
+# arrays of little-endian float64 timestamps and values. Array offsets are relative to the data section.
+_STORE_MAGIC = b"BDDMETR1"
+_STORE_HEADER = struct.Struct("<8sQ")
+_VALUE_SIZE = 8
+
+_VALUE_SEPARATOR = re.compile(r"[\s,;]+")
+
+_FETCH_TIMEOUT = 10 * 60
+
+class InvalidMetricsStoreError(Exception): pass
+
+class MetricsStore:
+    """Read-only view of a merged metrics file. Series are memory-mapped, so slicing only reads the requested range."""
+    def __init__(self, store_file):
+        self.__store_file = store_file
+        with open(store_file, "rb") as store_in:
+            self.__mmap = mmap.mmap(store_in.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_length = _STORE_HEADER.unpack_from(self.__mmap, 0)
+        if magic != _STORE_MAGIC:
+            raise InvalidMetricsStoreError("File \"%s\" is not a metrics store." % store_file)
+        index_start = _STORE_HEADER.size
+        self.__index = json.loads(self.__mmap[index_start:index_start + index_length].decode("utf-8"))
+        self.__data_start = _align(index_start + index_length)
+
+    @property
+    def store_file(self):
+        return self.__store_file
+
+    @property
+    def hosts(self):
+        return sorted(self.__index["series"].keys())
+
+    def metrics(self, host):
+        return sorted(self.__series_by_host(host).keys())
+
+    def time_range(self, host, metric):
+        """Returns the first and last timestamp of a series, or None if the series is empty."""
+        series = self.__series(host, metric)
+        if series["count"] == 0:
+            return None
+        return (self.__read_value(series["timestamps_offset"], 0), self.__read_value(series["timestamps_offset"], series["count"] - 1))
+
+    def slice(self, host, metric, start_time=None, end_time=None):
+        """Returns the timestamps and values of a series within [start_time, end_time] as two arrays of doubles."""
+        series = self.__series(host, metric)
+        first = 0 if start_time is None else self.__search(series, start_time, bisect.bisect_left)
+        last = series["count"] if end_time is None else self.__search(series, end_time, bisect.bisect_right)
+        last = max(first, last)
+        return (self.__read_array(series["timestamps_offset"], first, last), self.__read_array(series["values_offset"], first, last))
+
+    def close(self):
+        self.__mmap.close()
+
+    def __series_by_host(self, host):
+        if host not in self.__index["series"]:
+            raise KeyError("No metrics have been collected for host %s." % host)
+        return self.__index["series"][host]
+
+    def __series(self, host, metric):
+        series_by_metric = self.__series_by_host(host)
+        if metric not in series_by_metric:
+            raise KeyError("Metric %s has not been collected for host %s." % (metric, host))
+        return series_by_metric[metric]
+
+    def __read_value(self, offset, position):
+        return struct.unpack_from("<d", self.__mmap, self.__data_start + offset + position * _VALUE_SIZE)[0]
+
+    def __read_array(self, offset, first, last):
+        start = self.__data_start + offset + first * _VALUE_SIZE
+        values = array.array("d")
+        _array_frombytes(values, self.__mmap[start:start + (last - first) * _VALUE_SIZE])
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+    def __search(self, series, timestamp, bisect_fn):
+        # Binary search directly on the memory-mapped timestamps
+        read_value = self.__read_value
+        class TimestampView(object):
+            def __len__(self):
+                return series["count"]
+            def __getitem__(self, position):
+                return read_value(series["timestamps_offset"], position)
+        return bisect_fn(TimestampView(), timestamp)
+
+def _align(offset):
+    return (offset + _VALUE_SIZE - 1) // _VALUE_SIZE * _VALUE_SIZE
+
+def _array_frombytes(values, data):
+    if hasattr(values, "frombytes"):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+
+def _array_tobytes(values):
+    if sys.byteorder != "little":
+        values = array.array("d", values)
+        values.byteswap()
+    return values.tobytes() if hasattr(values, "tobytes") else values.tostring()
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def _parse_metric_file(metric_name, content):
+    """Parses a metric file with one sample per line: a timestamp followed by one or more values.
+
+    An optional non-numeric header line names the value columns. Returns a map from metric name to a
+    list of (timestamp, value) samples; files with multiple value columns yield one metric per column."""
+    column_names = None
+    samples_by_column = {}
+    for line in content.splitlines():
+        fields = [field for field in _VALUE_SEPARATOR.split(line.strip()) if field]
+        if not fields or fields[0].startswith("#"):
+            continue
+        numbers = [_parse_float(field) for field in fields]
+        if None in numbers:
+            if column_names is None and not samples_by_column:
+                column_names = fields[1:]
+            continue
+        for column, value in enumerate(numbers[1:]):
+            samples_by_column.setdefault(column, []).append((numbers[0], value))
+    samples_by_metric = {}
+    for column, samples in samples_by_column.items():
+        if len(samples_by_column) == 1 and (not column_names or len(column_names) <= 1):
+            name = metric_name
+        elif column_names and column < len(column_names):
+            name = "%s.%s" % (metric_name, column_names[column])
+        else:
+            name = "%s.%d" % (metric_name, column)
+        samples_by_metric[name] = sorted(samples)
+    return samples_by_metric
+
+def _remote_metrics_dir():
+    return "/local/%s/resource-monitor/metrics" % os.environ["USER"]
+
+def _fetch_host_metrics(machine):
+    """Fetches the metrics directory of a machine as a compressed archive and parses it."""
+    with tempfile.TemporaryFile() as metrics_archive:
+        remote.execute_to_file(machine, "tar -C %s -czf - ." % _remote_metrics_dir(), metrics_archive, timeout=_FETCH_TIMEOUT)
+        metrics_archive.seek(0)
+        samples_by_metric = {}
+        with tarfile.open(fileobj=metrics_archive, mode="r|gz") as metrics_tar:
+            for member in metrics_tar:
+                if not member.isfile():
+                    continue
+                metric_name = os.path.splitext(os.path.normpath(member.name))[0]
+                content = metrics_tar.extractfile(member).read().decode("utf-8", "replace")
+                samples_by_metric.update(_parse_metric_file(metric_name, content))
+    return samples_by_metric
+
+def _try_fetch_host_metrics(machine):
+    """Fetches the metrics of a machine, returning the error instead of raising it if the fetch fails."""
+    try:
+        return _fetch_host_metrics(machine), None
+    except (subprocess.CalledProcessError, remote.CommandTimeoutError, remote.AgentError, tarfile.TarError, EnvironmentError) as e:
+        return None, e
+
+def write_metrics_store(store_file, samples_by_host):
+    """Writes samples, given as a map from host to metric to sorted (timestamp, value) pairs, to a metrics store."""
+    index = {"series": {}}
+    data_blocks = []
+    data_offset = 0
+    for host in sorted(samples_by_host):
+        index["series"][host] = {}
+        for metric in sorted(samples_by_host[host]):
+            samples = samples_by_host[host][metric]
+            timestamps = array.array("d", [sample[0] for sample in samples])
+            values = array.array("d", [sample[1] for sample in samples])
+            index["series"][host][metric] = {
+                "count": len(samples),
+                "timestamps_offset": data_offset,
+                "values_offset": data_offset + len(samples) * _VALUE_SIZE
+            }
+            data_blocks.append(timestamps)
+            data_blocks.append(values)
+            data_offset += 2 * len(samples) * _VALUE_SIZE
+    index_bytes = json.dumps(index, sort_keys=True).encode("utf-8")
+    store_dir = os.path.dirname(os.path.abspath(store_file))
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    tmp_fd, tmp_file = tempfile.mkstemp(dir=store_dir, prefix=".metrics-")
+    with os.fdopen(tmp_fd, "wb") as store_out:
+        store_out.write(_STORE_HEADER.pack(_STORE_MAGIC, len(index_bytes)))
+        store_out.write(index_bytes)
+        store_out.write(b"\0" * (_align(_STORE_HEADER.size + len(index_bytes)) - _STORE_HEADER.size - len(index_bytes)))
+        for block in data_blocks:
+            store_out.write(_array_tobytes(block))
+    os.rename(tmp_file, store_file)
+
+def collect_metrics(machines, store_file, log_fn=util.log):
+    """Fetches resource-monitor metrics from all machines in parallel and merges them into a single metrics store.
+
+    Machines whose metrics cannot be fetched are logged and left out of the store."""
+    log_fn(0, "Collecting metrics from %d machine(s)..." % len(machines))
+    results = util.run_in_parallel(_try_fetch_host_metrics, [(machine,) for machine in machines])
+    samples_by_host = {}
+    for machine, (samples_by_metric, error) in zip(machines, results):
+        if error is not None:
+            log_fn(1, "Failed to collect metrics from \"%s\", skipping it: %s" % (machine, error))
+            continue
+        samples_by_host[machine] = samples_by_metric
+        log_fn(1, "Collected %d metric(s) from \"%s\"." % (len(samples_by_metric), machine))
+    log_fn(0, "Writing metrics to \"%s\"..." % store_file)
+    write_metrics_store(store_file, samples_by_host)
+    return MetricsStore(store_file)
+
+def add_collect_subparser(parser):
+    collect_parser = parser.add_parser("collect", help="collect resource-monitor metrics from all machines into a single file")
+    collect_parser.add_argument("-f", "--framework-dir", help="installation directory for Big Data frameworks", action="store", default=util.DEFAULT_FRAMEWORK_DIR)
+    collect_parser.add_argument("--preserve-id", help="preserve reservation id to collect metrics from, or 'LAST' for the last reservation made by the user", action="store", default="LAST")
+    collect_parser.add_argument("-o", "--output", help="file to write the merged metrics to (default: FRAMEWORK_DIR/metrics/reservation-ID.metrics)", action="store")
+    collect_parser.set_defaults(func=__collect)
+
+def __collect(args):
+    reservation = preserve.get_PreserveManager().fetch_reservation(args.preserve_id)
+    deployment = get_deployment_manifest(args.framework_dir, reservation.reservation_id).deployment("resource-monitor")
+    machines = deployment["machines"] if deployment else reservation.assigned_machines
+    store_file = args.output or os.path.join(args.framework_dir, "metrics", "reservation-%s.metrics" % reservation.reservation_id)
+    metrics_store = collect_metrics(machines, store_file)
+    metrics_store.close()
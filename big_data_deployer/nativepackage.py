@@ -1,8 +1,10 @@
 #!/usr/bin/env python2
 
+from . import filelock
 from . import util
-from .package import Package, PackageVersion
+from .package import DownloadFailedError, InstallFailedError, MissingArchiveError, Package, PackageVersion
 
+import glob
 import os.path
 import shutil
 import tarfile
@@ -13,12 +15,24 @@ class NativePackage(Package):
     def __init__(self, identifier, name):
         super(NativePackage, self).__init__(identifier, name)
 
-    def deploy(self, package_dir, package_version, reservation_id, machines, settings, log_fn=util.log):
-        _try_download_native_package(package_dir, self, package_version, log_fn=log_fn)
-        _try_install_native_package(package_dir, self, package_version, log_fn=log_fn)
-        self.deploy_installed(_install_dir(package_dir, self, package_version), package_version, machines, settings, log_fn=log_fn)
+    def deploy(self, package_dir, package_version, reservation_id, machines, settings, manifest, log_fn=util.log):
+        if _check_if_installed(package_dir, self, package_version):
+            log_fn(0, "Found installation of %s version %s at \"%s\"." % (self.name, package_version.version, _install_dir(package_dir, self, package_version)))
+        else:
+            # Concurrent deployments of the same version wait for a single download and installation
+            with filelock.FileLock(_lock_file(package_dir, self, package_version), log_fn=log_fn):
+                _try_download_native_package(package_dir, self, package_version, log_fn=log_fn)
+                _try_install_native_package(package_dir, self, package_version, log_fn=log_fn)
+        self.deploy_installed(_install_dir(package_dir, self, package_version), package_version, machines, settings, manifest, log_fn=log_fn)
+
+    def deploy_installed(self, install_dir, package_version, machines, settings, manifest, log_fn=util.log):
+        raise NotImplementedError()
+
+    def teardown(self, package_dir, reservation_id, deployment, log_fn=util.log):
+        package_version = self.version(deployment["version"])
+        self.teardown_installed(_install_dir(package_dir, self, package_version), package_version, deployment, log_fn=log_fn)
 
-    def deploy_installed(self, install_dir, package_version, machines, settings, log_fn=util.log):
+    def teardown_installed(self, install_dir, package_version, deployment, log_fn=util.log):
         raise NotImplementedError()
 
     def __repr__(self):
@@ -61,8 +75,19 @@ def _check_if_archive_present(package_dir, package, package_version):
 def _install_dir(package_dir, package, package_version):
     return os.path.join(package_dir, package.version_identifier(package_version.version))
 
+# File marking a complete installation, created before the installation is moved into place
+_INSTALLED_MARKER = ".bdd-installed"
+
+def _check_if_installed(package_dir, package, package_version):
+    """Checks if an installation is present and complete."""
+    return os.path.isfile(os.path.join(_install_dir(package_dir, package, package_version), _INSTALLED_MARKER))
+
+def _lock_file(package_dir, package, package_version):
+    """Returns the lock file that serializes downloading and installing a package version."""
+    return os.path.join(package_dir, ".locks", "%s.lock" % package.version_identifier(package_version.version))
+
 def _try_download_native_package(package_dir, package, package_version, log_fn=util.log):
-    """Fetches a Big Data package distribution."""
+    """Fetches a Big Data package distribution. Must be called while holding the lock of the package version."""
     log_fn(0, "Obtaining %s version %s distribution..." % (package.name, package_version.version))
 
     # Check if a previous download of the package already exists
@@ -80,48 +105,67 @@ def _try_download_native_package(package_dir, package, package_version, log_fn=u
             except Exception as e:
                 raise DownloadFailedError("Cannot create directory \"%s\" to store the %s archive due to an unknown error: %s." % (_archive_dir(package_dir), package.name, e))
 
-    # Download the package distribution
+    # Download the package distribution to a temporary file, which only replaces the archive once complete,
+    # after removing partial downloads left behind by deployers that were interrupted
+    for partial_download_file in glob.glob(os.path.join(_archive_dir(package_dir), ".%s-*.part" % os.path.basename(archive_file))):
+        os.remove(partial_download_file)
     dist_url = package_version.archive_url
     log_fn(1, "Downloading %s version %s from \"%s\"..." % (package.name, package_version.version, dist_url))
+    download_fd, download_file = tempfile.mkstemp(dir=_archive_dir(package_dir), prefix=".%s-" % os.path.basename(archive_file), suffix=".part")
     try:
-        with open(archive_file, "wb") as archive_stream:
+        with os.fdopen(download_fd, "wb") as archive_stream:
             download_stream = urllib2.urlopen(dist_url, timeout=1000)
             shutil.copyfileobj(download_stream, archive_stream)
-            log_fn(2, "Download complete.")
+        os.chmod(download_file, 0o644)
+        os.rename(download_file, archive_file)
+        log_fn(2, "Download complete.")
     except urllib2.HTTPError as e:
         raise DownloadFailedError("Failed to download %s from \"%s\" with HTTP status %d." % (package.name, dist_url, e.getcode()))
     except Exception as e:
         raise DownloadFailedError("Failed to download %s from \"%s\" with unknown error: %s." % (package.name, dist_url, e))
+    finally:
+        if os.path.exists(download_file):
+            os.remove(download_file)
 
 def _try_install_native_package(package_dir, package, package_version, log_fn=util.log):
-    """Installs a Big Data package distribution."""
+    """Installs a Big Data package distribution. Must be called while holding the lock of the package version."""
     log_fn(0, "Installing %s version %s..." % (package.name, package_version.version))
 
     # Check if a previous installation of the package already exists
     # If so, either remove for a forced reinstall, or return
     log_fn(1, "Checking if previous installation of %s version %s is present..." % (package.name, package_version.version))
     target_dir = _install_dir(package_dir, package, package_version)
-    if os.path.exists(target_dir):
+    if _check_if_installed(package_dir, package, package_version):
         log_fn(2, "Found previous installation of %s." % package.name)
         return
+    elif os.path.exists(target_dir):
+        # Installations are moved into place only once complete, so this one predates the completion marker
+        log_fn(2, "Found previous installation of %s without completion marker, marking it as complete." % package.name)
+        open(os.path.join(target_dir, _INSTALLED_MARKER), "w").close()
+        return
     else:
         log_fn(2, "Found no previous installation of %s." % package.name)
 
     # Check if the archive file is already present
     if not _check_if_archive_present(package_dir, package, package_version):
-        raise MissingArchiveError("Archive for %s version %s is not present in \"%s\"." % (package.name, version, _archive_dir(package_dir)))
+        raise MissingArchiveError("Archive for %s version %s is not present in \"%s\"." % (package.name, package_version.version, _archive_dir(package_dir)))
 
-    # Extract the distribution to a temporary directory
+    # Extract the distribution to a temporary directory next to the installation, so it can be renamed into place at once,
+    # after removing partial extractions left behind by deployers that were interrupted
+    for partial_extract_dir in glob.glob(os.path.join(package_dir, ".%s-*" % os.path.basename(target_dir))):
+        shutil.rmtree(partial_extract_dir, ignore_errors=True)
     log_fn(1, "Extracting %s version %s archive..." % (package.name, package_version.version))
     try:
-        extract_tmp_dir = tempfile.mkdtemp()
+        extract_tmp_dir = tempfile.mkdtemp(dir=package_dir, prefix=".%s-" % os.path.basename(target_dir))
     except Exception as e:
         raise InstallFailedError("Failed to create temporary directory to extract %s with unknown error: %s." % (package.name, e))
     try:
         with tarfile.open(_archive_file(package_dir, package, package_version)) as archive_tar:
             archive_tar.extractall(extract_tmp_dir)
         log_fn(2, "Extraction to temporary directory complete. Moving to package directory...")
-        shutil.move(os.path.join(extract_tmp_dir, package_version.archive_root_dir), target_dir)
+        extracted_dir = os.path.join(extract_tmp_dir, package_version.archive_root_dir)
+        open(os.path.join(extracted_dir, _INSTALLED_MARKER), "w").close()
+        os.rename(extracted_dir, target_dir)
         log_fn(3, "Move complete.")
     except Exception as e:
         raise InstallFailedError("Failed to extract %s archive \"%s\" with unknown error: %s." % (package.name, _archive_file(package_dir, package, package_version), e))
@@ -1,10 +1,20 @@
 #!/usr/bin/env python2
 
+from . import health
+from . import purge
+from . import status
 from . import util
+from .executor import get_executor
+from .manifest import get_deployment_manifest
+
+import re
+import time
 
 class DownloadFailedError(Exception): pass
 class MissingArchiveError(Exception): pass
 class InstallFailedError(Exception): pass
+class DeployFailedError(Exception): pass
+class TeardownFailedError(Exception): pass
 
 class Package(object):
     def __init__(self, identifier, name):
@@ -36,12 +46,22 @@ class Package(object):
     def add_version(self, package_version):
         self.__versions[package_version.version] = package_version
 
-    def deploy(self, package_version, reservation_id, machines, settings, log_fn=util.log):
+    def deploy(self, package_dir, package_version, reservation_id, machines, settings, manifest, log_fn=util.log):
+        raise NotImplementedError()
+
+    def teardown(self, package_dir, reservation_id, deployment, log_fn=util.log):
         raise NotImplementedError()
 
     def get_supported_deployment_settings(self, package_version):
         return []
 
+    def get_log_locations(self, deployment):
+        """Returns where a recorded deployment of this package keeps its logs.
+
+        Each location is a (path, machines) tuple. Paths may contain shell wildcards and are either absolute
+        or relative to the user's home directory."""
+        return []
+
     def __repr__(self):
         return "Package{identifier=%s,name=%s}" % (self.identifier, self.name)
 
@@ -56,6 +76,28 @@ class PackageVersion(object):
     def __repr__(self):
         return self.version
 
+def parse_version(version):
+    """Returns the numeric components of a version number for comparison, e.g., (3, 2, 2) for "3.2.2"."""
+    return tuple([int(part) for part in re.findall(r"\d+", version)])
+
+def select_template_dir(version, template_dirs):
+    """Selects the configuration templates for a package version by version range.
+
+    Template directories are given as (first version, template directory) pairs; the directory with the
+    latest first version up to and including the given version is selected."""
+    return select_template_dirs(version, template_dirs)[0]
+
+def select_template_dirs(version, template_dirs):
+    """Returns the template directories of all version ranges up to and including a package version, latest first.
+
+    Packages whose templates change little between versions keep only the changed templates in the directory of
+    a later version range, and take any other template from the directory of the latest earlier range that has it."""
+    candidates = [(parse_version(first_version), template_dir) for first_version, template_dir in template_dirs
+        if parse_version(first_version) <= parse_version(version)]
+    if not candidates:
+        raise KeyError("No configuration templates support version %s." % version)
+    return [template_dir for _, template_dir in sorted(candidates, reverse=True)]
+
 class PackageRegistry:
     def __init__(self):
         self.__packages = {}
@@ -90,13 +132,86 @@ class PackageManager:
     def package_dir(self):
         return self.__package_dir
 
-    def deploy(self, package_identifier, version, reservation_id, machines, settings, log_fn=util.log):
-        """Deploys a Big Data package distribution."""
+    def deploy(self, package_identifier, version, reservation_id, machines, settings, health_check=True, drop_unhealthy=True, select_master=True, log_fn=util.log):
+        """Deploys a Big Data package distribution and returns the deployment as recorded in the manifest.
+
+        Unless health_check is disabled, machines are probed first to drop unhealthy machines and to order
+        them so that the package's master (its first machine) is the most suitable one."""
         package = self.package_registry.package(package_identifier)
         package_version = package.version(version)
         log_fn(0, "Deploying %s version %s to cluster of %d machine(s)..." % (package.name, version, len(machines)))
-
-        package.deploy(self.package_dir, package_version, reservation_id, machines, settings, log_fn=util.create_log_fn(1, log_fn))
+        get_executor().start_operation(log_fn=log_fn)
+
+        # Packages consume the settings they support, so keep a copy to record in the manifest
+        requested_settings = dict(settings)
+        started_at = time.time()
+        manifest = get_deployment_manifest(self.package_dir, reservation_id)
+        if health_check:
+            # Co-locate masters of packages in the same reservation where possible, e.g., Spark with the HDFS namenode
+            preferred_masters = [deployment["master"] for deployment in manifest.deployments.values() if deployment["master"]]
+            # Processes of the other packages deployed in the reservation are not leftovers; those of an earlier
+            # deployment of this package are, as it is about to be replaced
+            live_deployments = dict((identifier, deployment["machines"]) for identifier, deployment in manifest.deployments.items() if identifier != package_identifier)
+            machines = health.check_health(machines, drop_unhealthy=drop_unhealthy, select_master=select_master,
+                preferred_masters=preferred_masters, live_deployments=live_deployments, log_fn=util.create_log_fn(1, log_fn))
+        health_checked_at = time.time()
+        try:
+            package.deploy(self.package_dir, package_version, reservation_id, machines, settings, manifest, log_fn=util.create_log_fn(1, log_fn))
+        finally:
+            get_executor().report(log_fn=util.create_log_fn(1, log_fn))
+        finished_at = time.time()
+
+        # Record the processes behind the services, so status and diagnostics can point at them
+        deployment = manifest.deployment(package_identifier)
+        services = dict((name, dict(service)) for name, service in deployment["services"].items())
+        for name, pid in status.find_service_pids(services).items():
+            services[name]["pid"] = pid
+        manifest.update_deployment(package_identifier, services=services, settings=requested_settings, timings={
+            "started_at": started_at,
+            "finished_at": finished_at,
+            "health_check": health_checked_at - started_at,
+            "deploy": finished_at - health_checked_at,
+            "total": finished_at - started_at
+        })
+        manifest.save()
+        return manifest.deployment(package_identifier)
+
+    def teardown(self, package_identifier, reservation_id, log_fn=util.log):
+        """Stops all daemons of a deployed Big Data package and removes it from the deployment manifest. Returns the removed deployment."""
+        package = self.package_registry.package(package_identifier)
+        manifest = get_deployment_manifest(self.package_dir, reservation_id)
+        deployment = manifest.deployment(package_identifier)
+        if deployment is None:
+            raise KeyError("No deployment of %s has been recorded for reservation %s." % (package.name, reservation_id))
+        log_fn(0, "Tearing down %s version %s on %d machine(s)..." % (package.name, deployment["version"], len(deployment["machines"])))
+        get_executor().start_operation(log_fn=log_fn)
+
+        package.teardown(self.package_dir, reservation_id, deployment, log_fn=util.create_log_fn(1, log_fn))
+
+        # Finish deleting directories that earlier deployments moved to the trash
+        get_executor().run_all([(machine, purge.reap_trash_command()) for machine in deployment["machines"]], step="reap")
+
+        # Verify that all services have released their ports
+        services = sorted(deployment["services"].items())
+        if services:
+            log_fn(1, "Waiting for %d service(s) to release their ports..." % len(services))
+            released = util.run_in_parallel(util.wait_for_port_closed, [(service["host"], service["port"]) for _, service in services])
+            still_open = ["%s (%s:%s)" % (name, service["host"], service["port"]) for (name, service), is_released in zip(services, released) if not is_released]
+            if still_open:
+                raise TeardownFailedError("Services of %s are still listening after teardown: %s." % (package.name, ", ".join(still_open)))
+            log_fn(2, "All ports released.")
+
+        manifest.remove_deployment(package_identifier)
+        manifest.save()
+        log_fn(1, "%s has been torn down." % package.name)
+        return deployment
+
+    def teardown_all(self, reservation_id, log_fn=util.log):
+        """Tears down all deployed Big Data packages, most recently deployed first. Returns the removed deployments by package."""
+        deployments = get_deployment_manifest(self.package_dir, reservation_id).deployments
+        for package_identifier, _ in sorted(deployments.items(), key=lambda item: item[1].get("deployed_at", 0), reverse=True):
+            self.teardown(package_identifier, reservation_id, log_fn=log_fn)
+        return deployments
 
     def get_supported_deployment_settings(self, package_identifier, version):
         """Retrieves a list of supported deployment settings and their descriptions for a given Big Data package and version."""
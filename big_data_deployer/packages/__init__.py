@@ -5,6 +5,7 @@ import airflow
 import hadoop
 import influxdb
 import kafka
+import pgbouncer
 import postgresql
 import resource_monitor
 import spark
@@ -4,6 +4,9 @@ from __future__ import print_function
 
 from ..package import PackageRegistry, get_package_registry
 from ..condapackage import CondaPackage, CondaPackageVersion
+from .. import executor
+from .. import purge
+from .. import remote
 from .. import util
 
 import fnmatch
@@ -12,11 +15,34 @@ import os
 import re
 
 _SETTING_WEBSERVER_PORT = "webserver_port"
+_SETTING_EXECUTOR = "executor"
+_SETTING_PARALLELISM = "parallelism"
+_SETTING_DAG_CONCURRENCY = "dag_concurrency"
+_SETTING_WORKER_CONCURRENCY = "worker_concurrency"
+_SETTING_BROKER_PORT = "broker_port"
 _ALL_SETTINGS = [
-    (_SETTING_WEBSERVER_PORT, "port the webserver will listen on")
+    (_SETTING_WEBSERVER_PORT, "port the webserver will listen on"),
+    (_SETTING_EXECUTOR, "executor to run tasks with: 'LocalExecutor' on the master only, or 'CeleryExecutor' with workers on all other machines"),
+    (_SETTING_PARALLELISM, "maximum number of task instances running concurrently"),
+    (_SETTING_DAG_CONCURRENCY, "maximum number of task instances running concurrently per DAG"),
+    (_SETTING_WORKER_CONCURRENCY, "number of tasks per Celery worker, or 'auto' to use the number of cores of each worker machine"),
+    (_SETTING_BROKER_PORT, "port the Redis broker for Celery will listen on")
 ]
 
+_EXECUTOR_LOCAL = "LocalExecutor"
+_EXECUTOR_CELERY = "CeleryExecutor"
+
 _DEFAULT_WEBSERVER_PORT = 10800
+_DEFAULT_EXECUTOR = _EXECUTOR_LOCAL
+_DEFAULT_PARALLELISM = 32
+_DEFAULT_DAG_CONCURRENCY = 16
+_DEFAULT_WORKER_CONCURRENCY = "auto"
+_DEFAULT_BROKER_PORT = 6379
+_DEFAULT_DATABASE_PORT = 5432
+
+# Additional packages required to run Airflow with the CeleryExecutor
+_CELERY_CONDA_PACKAGES = ["redis"]
+_CELERY_PIP_EXTRAS = "celery,redis"
 
 class AirflowPackageVersion(CondaPackageVersion):
     def __init__(self, version, conda_packages = [], conda_channels = [], pip_packages = [], template_dir = ""):
@@ -31,28 +57,70 @@ class AirflowPackage(CondaPackage):
     def __init__(self):
         super(AirflowPackage, self).__init__("airflow", "Airflow")
 
-    def deploy_installed(self, conda_env, package_version, machines, settings, log_fn=util.log):
-        """Deploys Airflow to a given master node."""
+    def deploy_installed(self, conda_env, package_version, machines, settings, manifest, log_fn=util.log):
+        """Deploys Airflow to a given master node, and optionally Celery workers to all other nodes."""
         if len(machines) < 1:
             raise util.InvalidSetupError("Airflow requires at least one machine to run on.")
 
         # Extract settings
         webserver_port = settings.pop(_SETTING_WEBSERVER_PORT, _DEFAULT_WEBSERVER_PORT)
+        airflow_executor = settings.pop(_SETTING_EXECUTOR, _DEFAULT_EXECUTOR)
+        parallelism = settings.pop(_SETTING_PARALLELISM, _DEFAULT_PARALLELISM)
+        dag_concurrency = settings.pop(_SETTING_DAG_CONCURRENCY, _DEFAULT_DAG_CONCURRENCY)
+        worker_concurrency = str(settings.pop(_SETTING_WORKER_CONCURRENCY, _DEFAULT_WORKER_CONCURRENCY))
+        broker_port = settings.pop(_SETTING_BROKER_PORT, _DEFAULT_BROKER_PORT)
         if len(settings) > 0:
             raise util.InvalidSetupError("Found unknown settings for Airflow: '%s'" % "','".join(settings.keys()))
-
-        # Select master node to run Airflow on
+        if airflow_executor not in [_EXECUTOR_LOCAL, _EXECUTOR_CELERY]:
+            raise util.InvalidSetupError("Unsupported Airflow executor '%s'. Expected '%s' or '%s'." % (airflow_executor, _EXECUTOR_LOCAL, _EXECUTOR_CELERY))
+        if worker_concurrency != "auto" and not worker_concurrency.isdigit():
+            raise util.InvalidSetupError("Invalid value for Airflow setting '%s': '%s'. Expected a number or 'auto'." % (_SETTING_WORKER_CONCURRENCY, worker_concurrency))
+        use_celery = airflow_executor == _EXECUTOR_CELERY
+        if use_celery and len(machines) < 2:
+            raise util.InvalidSetupError("Airflow with the %s requires at least two machines: a master and at least one worker." % _EXECUTOR_CELERY)
+
+        # Select master node to run Airflow on, and worker nodes for Celery
         master = machines[0]
-        log_fn(0, "Deploying Airflow on machine \"%s\"..." % master)
+        workers = machines[1:] if use_celery else []
+        if use_celery:
+            log_fn(0, "Deploying Airflow on machine \"%s\", with %d Celery workers..." % (master, len(workers)))
+        else:
+            log_fn(0, "Deploying Airflow on machine \"%s\"..." % master)
+
+        # Install the dependencies of the Celery executor, unless an earlier deployment in this reservation installed them
+        if use_celery:
+            log_fn(1, "Installing Celery executor dependencies...")
+            redis_installed = os.path.exists(os.path.join(conda_env.root, "bin", "redis-server"))
+            celery_installed = os.path.exists(os.path.join(conda_env.root, "bin", "celery"))
+            if not redis_installed:
+                conda_env.install(_CELERY_CONDA_PACKAGES)
+            if not celery_installed:
+                conda_env.pip_install(["apache-airflow[%s]==%s" % (_CELERY_PIP_EXTRAS, package_version.version)])
+            log_fn(2, "Dependencies already installed." if redis_installed and celery_installed else "Dependencies installed.")
+
+        # Connect to the metadata database through PgBouncer if it has been deployed
+        postgresql_deployment = manifest.deployment("postgresql")
+        pgbouncer_deployment = manifest.deployment("pgbouncer")
+        if postgresql_deployment:
+            postgresql_service = postgresql_deployment["services"]["postgresql"]
+            postgresql_host, postgresql_port = postgresql_service["host"], postgresql_service["port"]
+        else:
+            postgresql_host, postgresql_port = master, _DEFAULT_DATABASE_PORT
+        if pgbouncer_deployment:
+            pgbouncer_service = pgbouncer_deployment["services"]["pgbouncer"]
+            database_host, database_port = pgbouncer_service["host"], pgbouncer_service["port"]
+            log_fn(1, "Connecting to PostgreSQL through PgBouncer at \"%s:%s\"." % (database_host, database_port))
+        else:
+            database_host, database_port = postgresql_host, postgresql_port
 
         # Define directories for Airflow files (data, metadata, config files)
         airflow_home = "/local/%s/airflow" % os.environ["USER"]
         airflow_dag_dir = os.path.abspath(os.path.join(conda_env.root, "var", "airflow", "dags"))
 
         # Clean up previous Airflow deployments
-        log_fn(1, "Removing old environment on the Airflow machine...")
-        util.execute_command_quietly(["ssh", master, 'rm -rf "%s"' % airflow_home])
-        util.execute_command_quietly(["ssh", master, 'rm -rf "%s"' % airflow_dag_dir])
+        log_fn(1, "Removing old environment on the Airflow machines...")
+        executor.run_all([(machine, purge.purge_directory_command(airflow_home)) for machine in [master] + workers], step="purge")
+        executor.run(master, 'rm -rf "%s"' % airflow_dag_dir)
         log_fn(2, "Old environment removed.")
 
         # Generate configuration files using the included templates
@@ -69,7 +137,13 @@ class AirflowPackage(CondaPackage):
             "__HOST__": master,
             "__CONDA_ROOT__": conda_env.root,
             "__AIRFLOW_HOME__": airflow_home,
-            "__AIRFLOW_DAGS__": airflow_dag_dir
+            "__AIRFLOW_DAGS__": airflow_dag_dir,
+            "__EXECUTOR__": airflow_executor,
+            "__PARALLELISM__": str(parallelism),
+            "__DAG_CONCURRENCY__": str(dag_concurrency),
+            "__BROKER_PORT__": str(broker_port),
+            "__DATABASE_HOST__": database_host,
+            "__DATABASE_PORT__": str(database_port)
         }
         substitutions_pattern = re.compile("|".join([re.escape(k) for k in substitutions.keys()]))
         # - Iterate over template files and apply substitutions
@@ -82,13 +156,13 @@ class AirflowPackage(CondaPackage):
             with open(template_file_src, "r") as template_in:
                 for line in template_in:
                     file_content.append(substitutions_pattern.sub(lambda m: substitutions[m.group(0)], line.rstrip()))
-            util.write_remote_file(master, template_file_dst, "\n".join(file_content), os.stat(template_file_src).st_mode & 0o777)
+            util.run_in_parallel(remote.write_file, [(machine, template_file_dst, "\n".join(file_content), os.stat(template_file_src).st_mode & 0o777) for machine in [master] + workers])
         log_fn(2, "Configuration files generated.")
 
         # Create PostgreSQL user and database
         log_fn(1, "Creating PostgreSQL user and database for Airflow...")
-        conda_env.remote_command(master, ["createuser", "airflow"])
-        conda_env.remote_command(master, ["createdb", "--owner=airflow", "airflow"])
+        conda_env.remote_command(master, ["createuser", "-h", postgresql_host, "-p", str(postgresql_port), "airflow"])
+        conda_env.remote_command(master, ["createdb", "-h", postgresql_host, "-p", str(postgresql_port), "--owner=airflow", "airflow"])
         log_fn(2, "PostgreSQL integration initialized.")
 
         # Initialize Airflow
@@ -96,18 +170,63 @@ class AirflowPackage(CondaPackage):
         conda_env.remote_command(master, ["AIRFLOW_HOME=\"%s\"" % airflow_home, "airflow", "db", "init"])
         conda_env.remote_command(master, ["AIRFLOW_HOME=\"%s\"" % airflow_home, "airflow", "users", "create",
           "-u", os.environ["USER"], "-p", os.environ["USER"], "-f", "Default", "-l", "User", "-r", "Admin", "-e", "%s@localhost" % os.environ["USER"]])
-        util.execute_command_quietly(["ssh", master, 'mkdir -p "%s"' % airflow_dag_dir])
+        executor.run(master, 'mkdir -p "%s"' % airflow_dag_dir)
         log_fn(2, "Airflow database initialized.")
 
+        # Start the Celery broker
+        if use_celery:
+            log_fn(1, "Starting Redis broker for Celery...")
+            redis_dir = os.path.join(airflow_home, "redis")
+            executor.run(master, 'mkdir -p "%s"' % redis_dir)
+            conda_env.remote_command(master, ["redis-server", "--daemonize", "yes", "--bind", master, "--port", str(broker_port),
+                "--protected-mode", "no", "--save", "\"\"", "--dir", redis_dir,
+                "--pidfile", os.path.join(redis_dir, "redis.pid"), "--logfile", os.path.join(redis_dir, "redis.log")])
+            log_fn(2, "Redis is now listening on \"%s:%s\"." % (master, broker_port))
+
         # Start Airflow
         log_fn(1, "Starting Airflow daemons...")
         conda_env.remote_command(master, ["AIRFLOW_HOME=\"%s\"" % airflow_home, "airflow", "webserver", "-H", master, "-p", str(webserver_port), "-D"])
         conda_env.remote_command(master, ["AIRFLOW_HOME=\"%s\"" % airflow_home, "airflow", "scheduler", "-D"])
 
+        # Start Celery workers on all other machines
+        if use_celery:
+            log_fn(1, "Starting Celery workers...")
+            if worker_concurrency == "auto":
+                log_fn(2, "Determining the number of cores per worker...")
+                worker_concurrencies = [resources.cores for resources in util.run_in_parallel(remote.probe_host_resources, [(worker,) for worker in workers])]
+            else:
+                worker_concurrencies = [int(worker_concurrency)] * len(workers)
+            util.run_in_parallel(conda_env.remote_command, [(worker, ["AIRFLOW_HOME=\"%s\"" % airflow_home, "airflow", "celery", "worker",
+                "--concurrency", str(concurrency), "-D"]) for worker, concurrency in zip(workers, worker_concurrencies)])
+            log_fn(2, "Started %d Celery workers with a total concurrency of %d." % (len(workers), sum(worker_concurrencies)))
+
+        # Record the deployment
+        services = {"webserver": {"host": master, "port": int(webserver_port)}}
+        if use_celery:
+            services["broker"] = {"host": master, "port": int(broker_port)}
+        manifest.record_deployment(self.identifier, package_version.version, master, [master] + workers, services=services,
+            properties={"home": airflow_home, "executor": airflow_executor, "log_dir": os.path.join(conda_env.root, "var", "log", "airflow")})
+
         log_fn(1, 'Airflow is now listening on "%s:%s".' % (master, webserver_port))
 
     def get_supported_deployment_settings(self, framework_version):
         return _ALL_SETTINGS
 
+    def teardown_installed(self, conda_env, package_version, deployment, log_fn=util.log):
+        """Stops the Airflow daemons, Celery workers, and the Redis broker on all machines concurrently."""
+        airflow_home = deployment["properties"]["home"]
+        stop_command = util.stop_pidfile_processes_command(["%s/*.pid" % airflow_home, "%s/redis/redis.pid" % airflow_home])
+        log_fn(0, "Stopping Airflow daemons on %d machine(s)..." % len(deployment["machines"]))
+        executor.run_all([(machine, stop_command) for machine in deployment["machines"]])
+        log_fn(1, "Airflow daemons stopped.")
+
+    def get_log_locations(self, deployment):
+        airflow_home = deployment["properties"]["home"]
+        return [
+            (deployment["properties"]["log_dir"], [deployment["master"]]),
+            ("%s/airflow-*" % airflow_home, deployment["machines"]),
+            ("%s/redis/redis.log" % airflow_home, [deployment["master"]])
+        ]
+
 get_package_registry().register_package(AirflowPackage())
 get_package_registry().package("airflow").add_version(AirflowPackageVersion("2.0.1", conda_packages=["sqlalchemy=1.3.23", "psycopg2=2.8.6"], pip_packages=["apache-airflow==2.0.1"], template_dir="2.x"))
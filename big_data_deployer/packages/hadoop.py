@@ -2,13 +2,23 @@
 
 from __future__ import print_function
 
-from ..package import PackageRegistry, get_package_registry
+from ..package import DeployFailedError, PackageRegistry, get_package_registry, parse_version, select_template_dir
 from ..nativepackage import NativePackage, NativePackageVersion
+from .. import executor
+from .. import filelock
+from .. import health
+from .. import interconnect
+from .. import jvm
+from .. import purge
+from .. import remote
 from .. import util
 
 import glob
+import json
+import math
 import os.path
 import re
+import time
 
 _SETTING_JAVA_HOME = "java_home"
 _SETTING_HDFS_ENABLE = "hdfs_enable"
@@ -17,15 +27,25 @@ _SETTING_YARN_MB = "yarn_memory_mb"
 _SETTING_YARN_CORES = "yarn_cores"
 _SETTING_LOG_AGGREGATION = "log_aggregation"
 _SETTING_USERLOGS_DIR = "userlogs_dir"
+_SETTING_HDFS_KEEP_DATA = "hdfs_keep_data"
+_SETTING_DAEMON_STARTUP = "daemon_startup"
+_SETTING_INTERCONNECT = "interconnect"
+_SETTING_HDFS_EC_POLICY = "hdfs_ec_policy"
+_SETTING_HDFS_SHORT_CIRCUIT_READS = "hdfs_short_circuit_reads"
 _ALL_SETTINGS = [
     (_SETTING_JAVA_HOME, "value of JAVA_HOME to deploy Hadoop with"),
     (_SETTING_HDFS_ENABLE, "deploy Hadoop's HDFS"),
     (_SETTING_YARN_ENABLE, "deploy Hadoop's YARN"),
-    (_SETTING_YARN_MB, "memory available per node to YARN in MB"),
-    (_SETTING_YARN_CORES, "cores available per node to YARN"),
+    (_SETTING_YARN_MB, "memory available per node to YARN in MB, or 'auto' to let YARN detect it (Hadoop 3 only, and its default)"),
+    (_SETTING_YARN_CORES, "cores available per node to YARN, or 'auto' to let YARN detect them (Hadoop 3 only, and its default)"),
     (_SETTING_LOG_AGGREGATION, "enable YARN log aggregation"),
-    (_SETTING_USERLOGS_DIR, "directory to store YARN application logs")
-]
+    (_SETTING_USERLOGS_DIR, "directory to store YARN application logs"),
+    (_SETTING_HDFS_KEEP_DATA, "restart HDFS on the data of the previous deployment to the same machines instead of formatting a new file system"),
+    (_SETTING_DAEMON_STARTUP, "start worker daemons from the deployer on all workers concurrently ('parallel') or through Hadoop's start-dfs.sh and start-yarn.sh ('scripts')"),
+    (_SETTING_INTERCONNECT, interconnect.SETTING_DESCRIPTION),
+    (_SETTING_HDFS_EC_POLICY, "erasure coding policy to store HDFS files with instead of replication, e.g., 'RS-6-3-1024k' (Hadoop 3 only)"),
+    (_SETTING_HDFS_SHORT_CIRCUIT_READS, "let clients read blocks on their own machine directly from disk; requires the native Hadoop library (Hadoop 3 only)")
+] + jvm.supported_settings(["namenode", "secondarynamenode", "datanode", "resourcemanager", "nodemanager"])
 
 _DEFAULT_HDFS_ENABLE = True
 _DEFAULT_YARN_ENABLE = True
@@ -33,11 +53,51 @@ _DEFAULT_YARN_MB = 4096
 _DEFAULT_YARN_CORES = 8
 _DEFAULT_LOG_AGGREGATION = False
 _DEFAULT_USERLOGS_DIR = "${yarn.log.dir}/userlogs"
+_DEFAULT_HDFS_KEEP_DATA = False
+_DEFAULT_DAEMON_STARTUP = "parallel"
+_DEFAULT_HDFS_EC_POLICY = ""
+_DEFAULT_HDFS_SHORT_CIRCUIT_READS = True
+
+# Configuration templates by the first Hadoop version they support
+_TEMPLATE_DIRS = [("2.6.0", "2.6.x"), ("3.0.0", "3.x")]
+_YARN_AUTO = "auto"
+# Erasure coding policy names, e.g., "RS-6-3-1024k" for Reed-Solomon with 6 data and 3 parity blocks per 1 MB cell
+_EC_POLICY_PATTERN = re.compile(r"^(RS|RS-LEGACY|XOR)-(\d+)-(\d+)-(\d+)k$", re.IGNORECASE)
+
+_DAEMON_STARTUP_MODES = ["parallel", "scripts"]
+# Data transfer, IPC, and HTTP ports of datanodes, which changed in Hadoop 3
+_DATANODE_PORTS = {"2": (50010, 50020, 50075), "3": (9866, 9867, 9864)}
+_NODEMANAGER_WEBUI_PORT = 8042
+_MASTER_DAEMONS = ["namenode", "secondarynamenode", "resourcemanager"]
+_WORKER_DAEMONS = ["datanode", "nodemanager"]
+
+# Directory with the libraries on the classpath of YARN daemons, relative to HADOOP_HOME
+_YARN_LIB_DIR = os.path.join("share", "hadoop", "yarn", "lib")
+_AUX_SERVICES_LOCK_FILENAME = ".aux-services.lock"
+_AUX_SERVICES_PATTERN = re.compile(r"(<name>yarn\.nodemanager\.aux-services</name>\s*<value>)([^<]*)(</value>)")
+_AUX_SERVICE_CLASS_PROPERTY = """\t<property>
+\t\t<name>yarn.nodemanager.aux-services.%s.class</name>
+\t\t<value>%s</value>
+\t</property>
+"""
+# Hadoop 3 loads the jar of an auxiliary service in its own class loader; Hadoop 2 only has the daemons' classpath
+_AUX_SERVICE_CLASSPATH_PROPERTY = """\t<property>
+\t\t<name>yarn.nodemanager.aux-services.%s.classpath</name>
+\t\t<value>%s</value>
+\t</property>
+"""
+_AUX_SERVICE_CLASSPATH_PROPERTY_PATTERN = r"\t<property>\s*<name>yarn\.nodemanager\.aux-services\.%s\.classpath</name>.*?</property>\n"
+_AUX_SERVICE_CLASSPATH_EXPORT = 'export YARN_USER_CLASSPATH="${YARN_USER_CLASSPATH:+$YARN_USER_CLASSPATH:}%s" # aux-service %s\n'
+_AUX_SERVICE_CLASSPATH_EXPORT_PATTERN = r"export YARN_USER_CLASSPATH=.* # aux-service %s\n"
+
+# Describes the cluster that wrote the HDFS data on the namenode machine, to verify that a later deployment can reuse it
+_HDFS_LAYOUT_FILENAME = "hdfs-layout.json"
+_HDFS_LAYOUT_KEYS = ["version", "master", "workers", "cluster_id"]
 
 class HadoopPackageVersion(NativePackageVersion):
-    def __init__(self, version, archive_url, archive_extension, archive_root_dir, template_dir):
+    def __init__(self, version, archive_url, archive_extension, archive_root_dir):
         super(HadoopPackageVersion, self).__init__(version, archive_url, archive_extension, archive_root_dir)
-        self.__template_dir = template_dir
+        self.__template_dir = select_template_dir(version, _TEMPLATE_DIRS)
 
     @property
     def template_dir(self):
@@ -47,7 +107,7 @@ class HadoopPackage(NativePackage):
     def __init__(self):
         super(HadoopPackage, self).__init__("hadoop", "Hadoop")
 
-    def deploy_installed(self, hadoop_home, package_version, machines, settings, log_fn=util.log):
+    def deploy_installed(self, hadoop_home, package_version, machines, settings, manifest, log_fn=util.log):
         """Deploys Hadoop to a given set of workers and a master node."""
         if len(machines) < 2:
             raise util.InvalidSetupError("Hadoop requires at least two machines: a master and at least one worker.")
@@ -57,36 +117,134 @@ class HadoopPackage(NativePackage):
         hdfs_enable = hdfs_enable_str in ['true', 't', 'yes', 'y', '1']
         yarn_enable_str = str(settings.pop(_SETTING_YARN_ENABLE, _DEFAULT_YARN_ENABLE)).lower()
         yarn_enable = yarn_enable_str in ['true', 't', 'yes', 'y', '1']
-        yarn_mb = settings.pop(_SETTING_YARN_MB, _DEFAULT_YARN_MB)
-        yarn_cores = settings.pop(_SETTING_YARN_CORES, _DEFAULT_YARN_CORES)
+        is_hadoop_3 = parse_version(package_version.version) >= (3,)
+        yarn_mb = str(settings.pop(_SETTING_YARN_MB, _YARN_AUTO if is_hadoop_3 else _DEFAULT_YARN_MB)).lower()
+        yarn_cores = str(settings.pop(_SETTING_YARN_CORES, _YARN_AUTO if is_hadoop_3 else _DEFAULT_YARN_CORES)).lower()
         java_home = settings.pop(_SETTING_JAVA_HOME)
         log_aggregation_str = str(settings.pop(_SETTING_LOG_AGGREGATION, _DEFAULT_LOG_AGGREGATION)).lower()
         log_aggregation = log_aggregation_str in ['true', 't', 'yes', 'y', '1']
         userlogs_dir = settings.pop(_SETTING_USERLOGS_DIR, _DEFAULT_USERLOGS_DIR)
+        hdfs_keep_data_str = str(settings.pop(_SETTING_HDFS_KEEP_DATA, _DEFAULT_HDFS_KEEP_DATA)).lower()
+        hdfs_keep_data = hdfs_keep_data_str in ['true', 't', 'yes', 'y', '1']
+        daemon_startup = str(settings.pop(_SETTING_DAEMON_STARTUP, _DEFAULT_DAEMON_STARTUP)).lower()
+        network = interconnect.parse_interconnect(settings.pop(_SETTING_INTERCONNECT, interconnect.DEFAULT_INTERCONNECT))
+        hdfs_ec_policy = str(settings.pop(_SETTING_HDFS_EC_POLICY, _DEFAULT_HDFS_EC_POLICY))
+        hdfs_short_circuit_reads_str = str(settings.pop(_SETTING_HDFS_SHORT_CIRCUIT_READS, _DEFAULT_HDFS_SHORT_CIRCUIT_READS)).lower()
+        hdfs_short_circuit_reads = hdfs_short_circuit_reads_str in ['true', 't', 'yes', 'y', '1']
+        jvm_overrides = jvm.pop_overrides(settings, _MASTER_DAEMONS + _WORKER_DAEMONS)
         if len(settings) > 0:
             raise util.InvalidSetupError("Found unknown settings for Hadoop: '%s'" % "','".join(settings.keys()))
+        for setting, value in [(_SETTING_YARN_MB, yarn_mb), (_SETTING_YARN_CORES, yarn_cores)]:
+            if value == _YARN_AUTO and not is_hadoop_3:
+                raise util.InvalidSetupError("Hadoop setting '%s' can only be '%s' for Hadoop 3 and later." % (setting, _YARN_AUTO))
+            if value != _YARN_AUTO and not value.isdigit():
+                raise util.InvalidSetupError("Invalid value for Hadoop setting '%s': '%s'. Expected a number or '%s'." % (setting, value, _YARN_AUTO))
+        ec_policy_match = _EC_POLICY_PATTERN.match(hdfs_ec_policy)
+        if hdfs_ec_policy and not is_hadoop_3:
+            raise util.InvalidSetupError("Hadoop setting '%s' requires Hadoop 3 or later." % _SETTING_HDFS_EC_POLICY)
+        if hdfs_ec_policy and not ec_policy_match:
+            raise util.InvalidSetupError("Invalid value for Hadoop setting '%s': '%s'. Expected a policy name such as 'RS-6-3-1024k'." % (_SETTING_HDFS_EC_POLICY, hdfs_ec_policy))
+        if ec_policy_match:
+            # Policy names are case sensitive
+            hdfs_ec_policy = "%s-%s-%s-%sk" % (ec_policy_match.group(1).upper(), ec_policy_match.group(2), ec_policy_match.group(3), ec_policy_match.group(4))
+        if daemon_startup not in _DAEMON_STARTUP_MODES:
+            raise util.InvalidSetupError("Invalid value for Hadoop setting '%s': '%s'. Expected one of '%s'." % (_SETTING_DAEMON_STARTUP, daemon_startup, "','".join(_DAEMON_STARTUP_MODES)))
         if not hdfs_enable and not yarn_enable:
             raise util.InvalidSetupError("At least one of HDFS and YARN must be deployed.")
 
+        # Ensure that HADOOP_HOME is an absolute path
+        hadoop_home = os.path.realpath(hadoop_home)
+        local_hadoop_dir = "/local/%s/hadoop/" % os.environ["USER"]
+
+        # Look for HDFS data to keep; it determines the master, as the namenode metadata lives there
+        hdfs_cluster_id = None
+        if hdfs_enable and hdfs_keep_data:
+            log_fn(0, "Looking for HDFS data of a previous deployment...")
+            hdfs_layout = _find_hdfs_layout(package_version, machines, local_hadoop_dir)
+            if hdfs_layout is None:
+                log_fn(1, "No HDFS data found, a new file system will be formatted.")
+            else:
+                hdfs_cluster_id = hdfs_layout["cluster_id"]
+                machines = [hdfs_layout["master"]] + [machine for machine in machines if machine != hdfs_layout["master"]]
+                log_fn(1, "Found HDFS cluster \"%s\" with namenode \"%s\" and %d datanodes." % (hdfs_cluster_id, hdfs_layout["master"], len(hdfs_layout["workers"])))
+
         # Select master and workers
         master = machines[0]
         workers = machines[1:]
         log_fn(0, "Deploying Hadoop master \"%s\", with %d workers." % (master, len(workers)))
+        if ec_policy_match and len(workers) < int(ec_policy_match.group(2)) + int(ec_policy_match.group(3)):
+            raise util.InvalidSetupError("Erasure coding policy '%s' requires at least %d datanodes." % (hdfs_ec_policy, int(ec_policy_match.group(2)) + int(ec_policy_match.group(3))))
 
-        # Ensure that HADOOP_HOME is an absolute path
-        hadoop_home = os.path.realpath(hadoop_home)
+        if hdfs_cluster_id is None:
+            # Clean up previous Hadoop deployments
+            log_fn(1, "Creating a clean environment on the master and workers...")
+            log_fn(2, "Purging \"%s\" on master and workers..." % local_hadoop_dir)
+            executor.run_all([(machine, purge.purge_directory_command(local_hadoop_dir)) for machine in [master] + workers], step="purge")
+            log_fn(2, "Creating directory structure on master and workers...")
+            executor.run_all([(master, 'mkdir -p "%s"' % local_hadoop_dir)] +
+                [(worker, 'mkdir -p "%s/tmp" "%s/datanode"' % (local_hadoop_dir, local_hadoop_dir)) for worker in workers], step="mkdir")
+            log_fn(2, "Clean environment set up.")
+
+            # Leave out workers that were too slow to set up, if requested
+            workers = executor.exclude_stragglers(workers, log_fn=util.create_log_fn(1, log_fn))
+        else:
+            # Stop daemons still running from the previous deployment, so they pick up the new configuration
+            log_fn(1, "Stopping Hadoop daemons of the previous deployment...")
+            executor.run_all([(master, _daemons_command(hadoop_home, package_version, ["resourcemanager", "namenode", "secondarynamenode"], "stop"))] +
+                [(worker, _daemons_command(hadoop_home, package_version, ["nodemanager", "datanode"], "stop")) for worker in workers], step="stop")
+            log_fn(2, "Daemons stopped.")
+
+        # Resolve the addresses to bind and advertise services on
+        addresses = interconnect.resolve_addresses([master] + workers, network, log_fn=util.create_log_fn(1, log_fn))
+        master_hostname = addresses[master].hostname
+
+        # Size the JVM of every daemon for the machines it runs on
+        log_fn(1, "Computing JVM profiles...")
+        daemon_roles = dict([(daemon, jvm.ROLE_MASTER) for daemon in _MASTER_DAEMONS] + [(daemon, jvm.ROLE_WORKER) for daemon in _WORKER_DAEMONS])
+        daemon_roles["secondarynamenode"] = jvm.ROLE_AUXILIARY
+        daemon_machines = dict([(daemon, [master]) for daemon in _MASTER_DAEMONS] + [(daemon, workers or [master]) for daemon in _WORKER_DAEMONS])
+        jvm_profiles = jvm.compute_profiles(daemon_roles, daemon_machines, jvm_overrides, reserved_heaps=jvm.reserved_heaps(manifest, self.identifier),
+            log_fn=util.create_log_fn(2, log_fn))
+
+        # Scale the number of RPC and transfer threads with the number of datanodes
+        datanode_count = max(len(workers), 1)
+        namenode_handler_count = max(10, int(20 * math.log(datanode_count)))
+        datanode_max_transfer_threads = min(16384, max(4096, 128 * datanode_count))
+        # Containers are at most as large as the smallest worker; the resourcemanager caps this at the largest nodemanager
+        worker_healths = health.probe_nodes(workers or [master], use_cache=True)
+        worker_memory_mb = min([node_health.memory_mb for node_health in worker_healths if node_health.memory_mb] or [_DEFAULT_YARN_MB])
+        worker_cores = min([node_health.cores for node_health in worker_healths if node_health.cores] or [_DEFAULT_YARN_CORES])
+        yarn_max_allocation_mb = worker_memory_mb if yarn_mb == _YARN_AUTO else int(yarn_mb)
+        yarn_max_allocation_cores = worker_cores if yarn_cores == _YARN_AUTO else int(yarn_cores)
 
         # Generate configuration files using the included templates
         template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "conf", "hadoop", package_version.template_dir)
         config_dir = os.path.join(hadoop_home, "etc", "hadoop")
+        address_file = os.path.join(config_dir, interconnect.ADDRESS_FILENAME)
+        datanode_ports = _DATANODE_PORTS[package_version.version[0]]
         substitutions = {
             "__USER__": os.environ["USER"],
-            "__MASTER__": master,
-            "__YARN_MB__": str(yarn_mb),
-            "__YARN_CORES__": str(yarn_cores),
+            "__MASTER__": master_hostname,
+            "__LOCAL_IP_COMMAND__": interconnect.local_address_command(address_file, "ip_address"),
+            "__DATANODE_PORT__": str(datanode_ports[0]),
+            "__DATANODE_IPC_PORT__": str(datanode_ports[1]),
+            "__DATANODE_HTTP_PORT__": str(datanode_ports[2]),
+            "__YARN_MB__": "-1" if yarn_mb == _YARN_AUTO else yarn_mb,
+            "__YARN_CORES__": "-1" if yarn_cores == _YARN_AUTO else yarn_cores,
+            "__YARN_MAX_ALLOCATION_MB__": str(yarn_max_allocation_mb),
+            "__YARN_MAX_ALLOCATION_CORES__": str(yarn_max_allocation_cores),
+            "__OPPORTUNISTIC_QUEUE_LENGTH__": str(yarn_max_allocation_cores),
+            "__RESOURCE_TRACKER_THREAD_COUNT__": str(max(50, datanode_count)),
+            "__NAMENODE_HANDLER_COUNT__": str(namenode_handler_count),
+            "__DATANODE_MAX_TRANSFER_THREADS__": str(datanode_max_transfer_threads),
+            "__HADOOP_HOME__": hadoop_home,
+            # Without a socket path, datanodes start without short-circuit reads rather than fail
+            "__DOMAIN_SOCKET_PATH__": os.path.join(local_hadoop_dir, "dn_socket") if hdfs_short_circuit_reads else "",
             "__LOG_AGGREGATION__": "true" if log_aggregation else "false",
             "__USERLOGS_DIR__": userlogs_dir
         }
+        for daemon, jvm_profile in jvm_profiles.items():
+            substitutions["__%s_JAVA_OPTS__" % daemon.upper()] = jvm_profile.java_opts()
         if java_home:
             substitutions["${JAVA_HOME}"] = java_home
         substitutions_pattern = re.compile("|".join([re.escape(k) for k in substitutions.keys()]))
@@ -98,6 +256,9 @@ class HadoopPackage(NativePackage):
             with open(template_file, "r") as template_in, open(os.path.join(config_dir, template_filename), "w") as config_out:
                 for line in template_in:
                     print(substitutions_pattern.sub(lambda m: substitutions[m.group(0)], line.rstrip()), file=config_out)
+        log_fn(2, "Generating file \"%s\"..." % interconnect.ADDRESS_FILENAME)
+        with open(address_file, "w") as address_out:
+            address_out.write(interconnect.address_file_contents(addresses))
         log_fn(2, "Generating file \"masters\"...")
         with open(os.path.join(config_dir, "masters"), "w") as masters_file:
             print(master, file=masters_file)
@@ -113,40 +274,248 @@ class HadoopPackage(NativePackage):
                     print(worker, file=workers_file)
         log_fn(2, "Configuration files generated.")
 
-        # Clean up previous Hadoop deployments
-        log_fn(1, "Creating a clean environment on the master and workers...")
-        local_hadoop_dir = "/local/%s/hadoop/" % substitutions["__USER__"]
-        log_fn(2, "Purging \"%s\" on master..." % local_hadoop_dir)
-        util.execute_command_quietly(["ssh", master, 'rm -rf "%s"' % local_hadoop_dir])
-        log_fn(2, "Purging \"%s\" on workers..." % local_hadoop_dir)
-        for worker in workers:
-            util.execute_command_quietly(['ssh', worker, 'rm -rf "%s"' % local_hadoop_dir])
-        log_fn(2, "Creating directory structure on master...")
-        util.execute_command_quietly(['ssh', master, 'mkdir -p "%s"' % local_hadoop_dir])
-        log_fn(2, "Creating directory structure on workers...")
-        for worker in workers:
-            util.execute_command_quietly(['ssh', worker, 'mkdir -p "%s/tmp" "%s/datanode"' % (local_hadoop_dir, local_hadoop_dir)])
-        log_fn(2, "Clean environment set up.")
-
         # Start HDFS
         if hdfs_enable:
             log_fn(1, "Deploying HDFS...")
-            log_fn(2, "Formatting namenode...")
-            util.execute_command_quietly(['ssh', master, '"%s/bin/hadoop" namenode -format' % hadoop_home])
+            if hdfs_cluster_id is None:
+                log_fn(2, "Formatting namenode...")
+                executor.run(master, '"%s/bin/hadoop" namenode -format' % hadoop_home)
+                hdfs_cluster_id = remote.execute_for_output(master, _CLUSTER_ID_COMMAND % os.path.join(local_hadoop_dir, "namenode")).strip()
+                remote.write_file(master, os.path.join(local_hadoop_dir, _HDFS_LAYOUT_FILENAME),
+                    json.dumps({"version": package_version.version, "cluster_id": hdfs_cluster_id, "master": master, "workers": workers}))
+            else:
+                log_fn(2, "Keeping existing namenode metadata and datanode blocks.")
             log_fn(2, "Starting HDFS...")
-            util.execute_command_quietly(['ssh', master, '"%s/sbin/start-dfs.sh"' % hadoop_home])
+            if daemon_startup == "parallel":
+                _start_daemons(hadoop_home, package_version, master, ["namenode", "secondarynamenode"], workers, ["datanode"], log_fn=util.create_log_fn(3, log_fn))
+            else:
+                executor.run(master, '"%s/sbin/start-dfs.sh"' % hadoop_home)
+            if hdfs_ec_policy:
+                log_fn(2, "Setting erasure coding policy \"%s\" on the root directory..." % hdfs_ec_policy)
+                hdfs = '"%s/bin/hdfs"' % hadoop_home
+                executor.run(master, '%s dfsadmin -safemode wait && %s ec -enablePolicy -policy %s && %s ec -setPolicy -path / -policy %s' % (
+                    hdfs, hdfs, hdfs_ec_policy, hdfs, hdfs_ec_policy))
 
         # Start YARN
         if yarn_enable:
             log_fn(1, "Deploying YARN...")
-            util.execute_command_quietly(['ssh', master, '"%s/sbin/start-yarn.sh"' % hadoop_home])
+            if daemon_startup == "parallel":
+                _start_daemons(hadoop_home, package_version, master, ["resourcemanager"], workers, ["nodemanager"], log_fn=util.create_log_fn(2, log_fn))
+            else:
+                executor.run(master, '"%s/sbin/start-yarn.sh"' % hadoop_home)
+
+        # Record the deployment
+        services = {}
+        if hdfs_enable:
+            services["namenode"] = {"host": master_hostname, "port": 9000}
+            for worker in workers:
+                services["datanode@%s" % interconnect.short_hostname(worker)] = {"host": addresses[worker].hostname, "port": datanode_ports[0]}
+        if yarn_enable:
+            services["resourcemanager"] = {"host": master_hostname, "port": 8030}
+            for worker in workers:
+                services["nodemanager@%s" % interconnect.short_hostname(worker)] = {"host": addresses[worker].hostname, "port": _NODEMANAGER_WEBUI_PORT}
+        manifest.record_deployment(self.identifier, package_version.version, master, [master] + workers, services=services,
+            properties={"home": hadoop_home, "hdfs_enable": hdfs_enable, "yarn_enable": yarn_enable, "userlogs_dir": userlogs_dir, "hdfs_cluster_id": hdfs_cluster_id, "interconnect": network,
+                "jvm_heaps": jvm.machine_heaps(jvm_profiles, daemon_machines)})
 
         log_fn(1, "Hadoop cluster deployed.")
 
+    def teardown_installed(self, hadoop_home, package_version, deployment, log_fn=util.log):
+        """Stops the HDFS and YARN daemons on all machines concurrently."""
+        hadoop_home = os.path.realpath(hadoop_home)
+        master = deployment["master"]
+        workers = [machine for machine in deployment["machines"] if machine != master]
+        master_daemons = []
+        worker_daemons = []
+        if deployment["properties"]["yarn_enable"]:
+            master_daemons.append("resourcemanager")
+            worker_daemons.append("nodemanager")
+        if deployment["properties"]["hdfs_enable"]:
+            master_daemons.extend(["namenode", "secondarynamenode"])
+            worker_daemons.append("datanode")
+        log_fn(0, "Stopping Hadoop daemons on master \"%s\" and %d workers..." % (master, len(workers)))
+        executor.run_all([(master, _daemons_command(hadoop_home, package_version, master_daemons, "stop"))] +
+            [(worker, _daemons_command(hadoop_home, package_version, worker_daemons, "stop")) for worker in workers])
+        log_fn(1, "Hadoop daemons stopped.")
+
     def get_supported_deployment_settings(self, package_version):
         return _ALL_SETTINGS
 
+    def get_log_locations(self, deployment):
+        hadoop_log_dir = os.path.join(deployment["properties"]["home"], "logs")
+        log_locations = [(hadoop_log_dir, [deployment["master"]])]
+        userlogs_dir = deployment["properties"]["userlogs_dir"].replace("${yarn.log.dir}", hadoop_log_dir)
+        if not userlogs_dir.startswith(hadoop_log_dir):
+            log_locations.append((userlogs_dir, deployment["machines"]))
+        return log_locations
+
+def _daemon_command(hadoop_home, package_version, daemon, action):
+    """Returns a shell command to start or stop a single Hadoop daemon on the local machine."""
+    is_yarn_daemon = daemon in ["resourcemanager", "nodemanager"]
+    if package_version.version.startswith("2"):
+        return '"%s/sbin/%s" %s %s' % (hadoop_home, "yarn-daemon.sh" if is_yarn_daemon else "hadoop-daemon.sh", action, daemon)
+    else:
+        return '"%s/bin/%s" --daemon %s %s' % (hadoop_home, "yarn" if is_yarn_daemon else "hdfs", action, daemon)
+
+def _daemons_command(hadoop_home, package_version, daemons, action):
+    """Returns a shell command to start or stop several Hadoop daemons on the local machine, one after the other.
+
+    Starting stops at the first daemon that fails to start, so the command fails; stopping continues regardless."""
+    separator = " && " if action == "start" else "; "
+    return separator.join([_daemon_command(hadoop_home, package_version, daemon, action) for daemon in daemons])
+
+def _start_daemons(hadoop_home, package_version, master, master_daemons, workers, worker_daemons, log_fn=util.log):
+    """Starts daemons on the master, then on all workers concurrently, and reports the workers on which they failed to start."""
+    log_fn(0, "Starting %s on master..." % ", ".join(master_daemons))
+    executor.run(master, _daemons_command(hadoop_home, package_version, master_daemons, "start"))
+    log_fn(0, "Starting %s on %d workers..." % (", ".join(worker_daemons), len(workers)))
+    start_time = time.time()
+    tasks = executor.run_all([(worker, _daemons_command(hadoop_home, package_version, worker_daemons, "start")) for worker in workers],
+        step="start %s" % ", ".join(worker_daemons), raise_errors=False)
+    failed_tasks = [task for task in tasks if task.error is not None]
+    log_fn(1, "Started on %d of %d workers in %.1f seconds." % (len(tasks) - len(failed_tasks), len(tasks), time.time() - start_time))
+    for task in failed_tasks:
+        log_fn(1, "Failed to start on \"%s\": %s" % (task.machine, task.error))
+    if failed_tasks:
+        raise DeployFailedError("Failed to start %s on worker(s) \"%s\"." % (", ".join(worker_daemons), "\",\"".join([task.machine for task in failed_tasks])))
+
+def add_yarn_aux_service(manifest, name, class_name, jar_file, port, replaces_pattern=None, log_fn=util.log):
+    """Adds an auxiliary service, e.g., Spark's external shuffle service, to the nodemanagers of the deployed YARN cluster.
+
+    The service's jar is loaded from where it is, through the classpath of the service in "yarn-site.xml" on Hadoop 3
+    or YARN's user classpath in "hadoop-env.sh" on Hadoop 2, so it is not left behind in the Hadoop installation once
+    Hadoop is redeployed. Jars matching replaces_pattern in YARN's library directory, e.g., copies installed by hand,
+    are removed so they cannot shadow it. All nodemanagers are restarted to load the service. The port it listens on
+    is recorded as a service of the Hadoop deployment, so it is checked and awaited like the nodemanagers themselves.
+    Nothing is restarted if the same jar is already in use. The Hadoop installation is locked while it is changed,
+    as other deployments may share it."""
+    deployment = manifest.deployment("hadoop")
+    hadoop_home = deployment["properties"]["home"]
+    package_version = get_package_registry().package("hadoop").version(deployment["version"])
+    # A Hadoop deployment without workers runs its worker daemons on the master
+    workers = [machine for machine in deployment["machines"] if machine != deployment["master"]] or [deployment["master"]]
+    jar_file = os.path.abspath(jar_file)
+    aux_services = dict(deployment["properties"].get("aux_services", {}))
+    if aux_services.get(name) == jar_file:
+        log_fn(0, "YARN auxiliary service \"%s\" is already running on %d nodemanagers." % (name, len(workers)))
+        return
+
+    log_fn(0, "Adding YARN auxiliary service \"%s\" to %d nodemanagers..." % (name, len(workers)))
+    with filelock.FileLock(os.path.join(hadoop_home, _AUX_SERVICES_LOCK_FILENAME), log_fn=util.create_log_fn(1, log_fn)):
+        if replaces_pattern:
+            for old_jar_file in glob.glob(os.path.join(hadoop_home, _YARN_LIB_DIR, replaces_pattern)):
+                log_fn(1, "Removing \"%s\" from YARN's libraries..." % os.path.basename(old_jar_file))
+                os.remove(old_jar_file)
+        config_dir = os.path.join(hadoop_home, "etc", "hadoop")
+        yarn_site_file = os.path.join(config_dir, "yarn-site.xml")
+        with open(yarn_site_file, "r") as yarn_site_in:
+            yarn_site = yarn_site_in.read()
+        aux_services_match = _AUX_SERVICES_PATTERN.search(yarn_site)
+        if not aux_services_match:
+            raise DeployFailedError("Cannot find the auxiliary services of the nodemanagers in \"%s\"." % yarn_site_file)
+        enabled_services = [service for service in aux_services_match.group(2).split(",") if service]
+        if name not in enabled_services:
+            log_fn(1, "Enabling the service in \"yarn-site.xml\"...")
+            yarn_site = _AUX_SERVICES_PATTERN.sub(lambda m: m.group(1) + ",".join(enabled_services + [name]) + m.group(3), yarn_site)
+            yarn_site = yarn_site.replace("</configuration>", _AUX_SERVICE_CLASS_PROPERTY % (name, class_name) + "</configuration>")
+        if package_version.version.startswith("2"):
+            log_fn(1, "Adding \"%s\" to YARN's classpath in \"hadoop-env.sh\"..." % os.path.basename(jar_file))
+            hadoop_env_file = os.path.join(config_dir, "hadoop-env.sh")
+            with open(hadoop_env_file, "r") as hadoop_env_in:
+                hadoop_env = hadoop_env_in.read()
+            hadoop_env = re.sub(_AUX_SERVICE_CLASSPATH_EXPORT_PATTERN % re.escape(name), "", hadoop_env)
+            with open(hadoop_env_file, "w") as hadoop_env_out:
+                hadoop_env_out.write(hadoop_env + _AUX_SERVICE_CLASSPATH_EXPORT % (jar_file, name))
+        else:
+            log_fn(1, "Setting the classpath of the service in \"yarn-site.xml\"...")
+            yarn_site = re.sub(_AUX_SERVICE_CLASSPATH_PROPERTY_PATTERN % re.escape(name), "", yarn_site, flags=re.DOTALL)
+            yarn_site = yarn_site.replace("</configuration>", _AUX_SERVICE_CLASSPATH_PROPERTY % (name, jar_file) + "</configuration>")
+        with open(yarn_site_file, "w") as yarn_site_out:
+            yarn_site_out.write(yarn_site)
+        log_fn(1, "Restarting nodemanagers...")
+        restart_command = "%s; %s" % (_daemon_command(hadoop_home, package_version, "nodemanager", "stop"), _daemon_command(hadoop_home, package_version, "nodemanager", "start"))
+        executor.run_all([(worker, restart_command) for worker in workers], step="restart nodemanager")
+
+    services = dict(deployment["services"])
+    for worker in workers:
+        nodemanager_service = services.get("nodemanager@%s" % interconnect.short_hostname(worker), {"host": worker})
+        services["%s@%s" % (name, interconnect.short_hostname(worker))] = {"host": nodemanager_service["host"], "port": port}
+    aux_services[name] = jar_file
+    properties = dict(deployment["properties"])
+    properties["aux_services"] = aux_services
+    manifest.update_deployment("hadoop", services=services, properties=properties)
+    log_fn(1, "Auxiliary service \"%s\" added." % name)
+
+# Prints the cluster ID recorded in the VERSION file of a namenode or datanode storage directory, if any
+_CLUSTER_ID_COMMAND = 'sed -n "s/^clusterID=//p" "%s/current/VERSION" 2>/dev/null; true'
+
+def _parse_hdfs_layout(machine, layout_file, layout_json):
+    """Parses the HDFS layout recorded on a machine, raising an InvalidSetupError if it is corrupt or incomplete."""
+    try:
+        layout = json.loads(layout_json)
+    except ValueError as e:
+        raise util.InvalidSetupError("The HDFS layout file \"%s\" on machine \"%s\" is corrupt: %s. Remove it or deploy without %s to format a new file system." %
+            (layout_file, machine, e, _SETTING_HDFS_KEEP_DATA))
+    missing_keys = [key for key in _HDFS_LAYOUT_KEYS if not isinstance(layout, dict) or key not in layout]
+    if missing_keys:
+        raise util.InvalidSetupError("The HDFS layout file \"%s\" on machine \"%s\" is missing '%s'. Remove it or deploy without %s to format a new file system." %
+            (layout_file, machine, "','".join(missing_keys), _SETTING_HDFS_KEEP_DATA))
+    return layout
+
+def _find_hdfs_layout(package_version, machines, local_hadoop_dir):
+    """Finds the layout of the HDFS cluster whose data is stored on the given machines.
+
+    Returns None if none of the machines holds any HDFS data. Raises an InvalidSetupError if the data cannot be
+    reused by this deployment, i.e., if it was written by another Hadoop version or by a cluster of other machines."""
+    namenode_dir = os.path.join(local_hadoop_dir, "namenode")
+    datanode_dir = os.path.join(local_hadoop_dir, "tmp", "dfs", "data")
+    layout_file = os.path.join(local_hadoop_dir, _HDFS_LAYOUT_FILENAME)
+    probe_command = 'echo @layout; cat "%s" 2>/dev/null; echo; echo @namenode; %s; echo @datanode; %s' % (
+        layout_file, _CLUSTER_ID_COMMAND % namenode_dir, _CLUSTER_ID_COMMAND % datanode_dir)
+    probe_outputs = util.run_in_parallel(remote.execute_for_output, [(machine, probe_command) for machine in machines])
+    layouts = {}
+    namenode_ids = {}
+    datanode_ids = {}
+    for machine, probe_output in zip(machines, probe_outputs):
+        section = None
+        for line in probe_output.split("\n"):
+            line = line.strip()
+            if line.startswith("@"):
+                section = line[1:]
+            elif line and section == "layout":
+                layouts[machine] = _parse_hdfs_layout(machine, layout_file, line)
+            elif line and section == "namenode":
+                namenode_ids[machine] = line
+            elif line and section == "datanode":
+                datanode_ids[machine] = line
+
+    if not layouts and not namenode_ids and not datanode_ids:
+        return None
+    if not layouts:
+        raise util.InvalidSetupError("Found HDFS data on machine(s) \"%s\", but no record of the cluster that wrote it. Deploy without %s to format a new file system." %
+            ("\",\"".join(sorted(set(namenode_ids) | set(datanode_ids))), _SETTING_HDFS_KEEP_DATA))
+    if len(layouts) > 1:
+        raise util.InvalidSetupError("Found HDFS namenode data of different clusters on machines \"%s\"." % "\",\"".join(sorted(layouts)))
+    master, layout = list(layouts.items())[0]
+    if layout["version"] != package_version.version:
+        raise util.InvalidSetupError("The HDFS data on machine \"%s\" was written by Hadoop %s; reusing it with Hadoop %s is not supported." %
+            (master, layout["version"], package_version.version))
+    if layout["master"] != master or namenode_ids.get(master) != layout["cluster_id"]:
+        raise util.InvalidSetupError("The namenode metadata on machine \"%s\" does not belong to HDFS cluster \"%s\"." % (master, layout["cluster_id"]))
+    missing_workers = [worker for worker in layout["workers"] if worker not in machines]
+    if missing_workers:
+        raise util.InvalidSetupError("The HDFS data is stored on machine(s) \"%s\", which are not part of this deployment." % "\",\"".join(missing_workers))
+    new_workers = [machine for machine in machines if machine != master and machine not in layout["workers"]]
+    if new_workers:
+        raise util.InvalidSetupError("Machine(s) \"%s\" were not part of HDFS cluster \"%s\"; %s requires deploying to the same machines as before." %
+            ("\",\"".join(new_workers), layout["cluster_id"], _SETTING_HDFS_KEEP_DATA))
+    mismatched_workers = [worker for worker in layout["workers"] if datanode_ids.get(worker) != layout["cluster_id"]]
+    if mismatched_workers:
+        raise util.InvalidSetupError("The datanode data on machine(s) \"%s\" is missing or does not belong to HDFS cluster \"%s\"." %
+            ("\",\"".join(mismatched_workers), layout["cluster_id"]))
+    return layout
+
 get_package_registry().register_package(HadoopPackage())
-get_package_registry().package("hadoop").add_version(HadoopPackageVersion("2.6.0", "https://archive.apache.org/dist/hadoop/core/hadoop-2.6.0/hadoop-2.6.0.tar.gz", "tar.gz", "hadoop-2.6.0", "2.6.x"))
-get_package_registry().package("hadoop").add_version(HadoopPackageVersion("2.7.7", "https://archive.apache.org/dist/hadoop/core/hadoop-2.7.7/hadoop-2.7.7.tar.gz", "tar.gz", "hadoop-2.7.7", "2.6.x"))
-get_package_registry().package("hadoop").add_version(HadoopPackageVersion("3.2.2", "https://archive.apache.org/dist/hadoop/core/hadoop-3.2.2/hadoop-3.2.2.tar.gz", "tar.gz", "hadoop-3.2.2", "2.6.x"))
+get_package_registry().package("hadoop").add_version(HadoopPackageVersion("2.6.0", "https://archive.apache.org/dist/hadoop/core/hadoop-2.6.0/hadoop-2.6.0.tar.gz", "tar.gz", "hadoop-2.6.0"))
+get_package_registry().package("hadoop").add_version(HadoopPackageVersion("2.7.7", "https://archive.apache.org/dist/hadoop/core/hadoop-2.7.7/hadoop-2.7.7.tar.gz", "tar.gz", "hadoop-2.7.7"))
+get_package_registry().package("hadoop").add_version(HadoopPackageVersion("3.2.2", "https://archive.apache.org/dist/hadoop/core/hadoop-3.2.2/hadoop-3.2.2.tar.gz", "tar.gz", "hadoop-3.2.2"))
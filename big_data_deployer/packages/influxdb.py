@@ -4,6 +4,8 @@ from __future__ import print_function
 
 from ..package import PackageRegistry, get_package_registry
 from ..nativepackage import NativePackage, NativePackageVersion
+from .. import executor
+from .. import purge
 from .. import util
 
 import fnmatch
@@ -34,7 +36,7 @@ class InfluxDBPackage(NativePackage):
     def __init__(self):
         super(InfluxDBPackage, self).__init__("influxdb", "InfluxDB")
 
-    def deploy_installed(self, influxdb_home, package_version, machines, settings, log_fn=util.log):
+    def deploy_installed(self, influxdb_home, package_version, machines, settings, manifest, log_fn=util.log):
         """Deploys InfluxDB to a given master node."""
         if len(machines) < 1:
             raise util.InvalidSetupError("InfluxDB requires at least one machine to run on.")
@@ -89,19 +91,33 @@ class InfluxDBPackage(NativePackage):
         log_fn(1, "Creating a clean environment on the InfluxDB machine...")
         local_influxdb_dir = "/local/%s/influxdb/" % substitutions["__USER__"]
         log_fn(2, "Purging \"%s\"..." % local_influxdb_dir)
-        util.execute_command_quietly(["ssh", master, 'rm -rf "%s"' % local_influxdb_dir])
+        executor.run(master, purge.purge_directory_command(local_influxdb_dir))
         log_fn(2, "Creating directory structure...")
-        util.execute_command_quietly(['ssh', master, 'mkdir -p "%s"' % local_influxdb_dir])
+        executor.run(master, 'mkdir -p "%s"' % local_influxdb_dir)
         log_fn(2, "Clean environment set up.")
 
         # Start InfluxDB
         log_fn(1, "Starting InfluxDB daemon...")
-        util.execute_command_quietly(['ssh', master, '"%s/sbin/start-influxdb"' % influxdb_home])
+        executor.run(master, '"%s/sbin/start-influxdb"' % influxdb_home)
+
+        # Record the deployment
+        manifest.record_deployment(self.identifier, package_version.version, master, [master],
+            services={"http": {"host": master, "port": int(http_port)}, "rpc": {"host": master, "port": int(rpc_port)}},
+            properties={"home": influxdb_home})
 
         log_fn(1, 'InfluxDB is now listening on "%s:%s" (HTTP) and "%s:%s" (RPC).' % (master, http_port, master, rpc_port))
 
     def get_supported_deployment_settings(self, package_version):
         return _ALL_SETTINGS
 
+    def teardown_installed(self, influxdb_home, package_version, deployment, log_fn=util.log):
+        log_fn(0, "Stopping InfluxDB on \"%s\"..." % deployment["master"])
+        executor.run(deployment["master"], util.stop_pidfile_processes_command(["/local/%s/influxdb/influxdb.pid" % os.environ["USER"]]))
+        log_fn(1, "InfluxDB stopped.")
+
+    def get_log_locations(self, deployment):
+        local_influxdb_dir = "/local/%s/influxdb" % os.environ["USER"]
+        return [("%s/std*" % local_influxdb_dir, [deployment["master"]]), ("%s/influxd.log*" % local_influxdb_dir, [deployment["master"]])]
+
 get_package_registry().register_package(InfluxDBPackage())
 get_package_registry().package("influxdb").add_version(InfluxDBPackageVersion("1.7.3", "https://dl.influxdata.com/influxdb/releases/influxdb-1.7.3_linux_amd64.tar.gz", "tar.gz", "influxdb-1.7.3-1", "1.7.x"))
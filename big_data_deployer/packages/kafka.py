@@ -4,6 +4,10 @@ from __future__ import print_function
 
 from ..package import PackageRegistry, get_package_registry
 from ..nativepackage import NativePackage, NativePackageVersion
+from .. import executor
+from .. import interconnect
+from .. import jvm
+from .. import purge
 from .. import util
 
 import fnmatch
@@ -13,10 +17,12 @@ import re
 
 _SETTING_PORT = "port"
 _SETTING_ZOOKEEPER_URL = "zookeeper_url"
+_SETTING_INTERCONNECT = "interconnect"
 _ALL_SETTINGS = [
     (_SETTING_PORT, "port to bind Kafka to"),
-    (_SETTING_ZOOKEEPER_URL, "URL of Zookeeper instance to connect to")
-]
+    (_SETTING_ZOOKEEPER_URL, "URL of Zookeeper instance to connect to"),
+    (_SETTING_INTERCONNECT, interconnect.SETTING_DESCRIPTION)
+] + jvm.supported_settings(["broker"])
 
 _DEFAULT_PORT = 9092
 _DEFAULT_ZOOKEEPER_URL = "127.0.0.1:2181"
@@ -34,7 +40,7 @@ class KafkaPackage(NativePackage):
     def __init__(self):
         super(KafkaPackage, self).__init__("kafka", "Kafka")
 
-    def deploy_installed(self, kafka_home, package_version, machines, settings, log_fn=util.log):
+    def deploy_installed(self, kafka_home, package_version, machines, settings, manifest, log_fn=util.log):
         """Deploys Kafka to a given master node."""
         if len(machines) < 1:
             raise util.InvalidSetupError("Kafka requires at least one machine to run on.")
@@ -42,12 +48,19 @@ class KafkaPackage(NativePackage):
         # Extract settings
         port = settings.pop(_SETTING_PORT, _DEFAULT_PORT)
         zookeeper_url = settings.pop(_SETTING_ZOOKEEPER_URL, _DEFAULT_ZOOKEEPER_URL)
+        network = interconnect.parse_interconnect(settings.pop(_SETTING_INTERCONNECT, interconnect.DEFAULT_INTERCONNECT))
+        jvm_overrides = jvm.pop_overrides(settings, ["broker"])
         if len(settings) > 0:
             raise util.InvalidSetupError("Found unknown settings for Kafka: '%s'" % "','".join(settings.keys()))
 
         # Select master node to run Kafka on
         master = machines[0]
         log_fn(0, "Selected Kafka machine \"%s\"." % master)
+        address = interconnect.resolve_addresses([master], network, log_fn=util.create_log_fn(1, log_fn))[master]
+        log_fn(1, "Computing JVM profile...")
+        jvm_profiles = jvm.compute_profiles({"broker": jvm.ROLE_BROKER}, {"broker": [master]}, jvm_overrides,
+            reserved_heaps=jvm.reserved_heaps(manifest, self.identifier), log_fn=util.create_log_fn(2, log_fn))
+        jvm_profile = jvm_profiles["broker"]
 
         # Ensure that KAFKA_HOME is an absolute path
         kafka_home = os.path.realpath(kafka_home)
@@ -63,7 +76,8 @@ class KafkaPackage(NativePackage):
         # - Generate a list of variables to substitute
         substitutions = {
             "__USER__": os.environ["USER"],
-            "__HOST__": master,
+            "__HOST__": address.hostname,
+            "__BIND_ADDRESS__": address.ip_address,
             "__HOME_DIR__": kafka_home,
             "__DATA_DIR__": "/local/%s/kafka" % os.environ["USER"],
             "__PORT__": str(port),
@@ -89,20 +103,34 @@ class KafkaPackage(NativePackage):
         log_fn(1, "Creating a clean environment on the Kafka machine...")
         local_kafka_dir = "/local/%s/kafka/" % substitutions["__USER__"]
         log_fn(2, "Purging \"%s\"..." % local_kafka_dir)
-        util.execute_command_quietly(["ssh", master, 'rm -rf "%s"' % local_kafka_dir])
+        executor.run(master, purge.purge_directory_command(local_kafka_dir))
         log_fn(2, "Creating directory structure...")
-        util.execute_command_quietly(['ssh', master, 'mkdir -p "%s"' % local_kafka_dir])
+        executor.run(master, 'mkdir -p "%s"' % local_kafka_dir)
         log_fn(2, "Clean environment set up.")
 
         # Start Kafka
         log_fn(1, "Starting Kafka broker...")
-        util.execute_command_quietly(['ssh', master, '"%s/bin/kafka-server-start.sh"' % kafka_home, '-daemon', '"%s/config/server.properties"' % kafka_home])
+        # Kafka's own performance options select G1 as well, so these replace rather than extend them
+        executor.run(master, 'KAFKA_HEAP_OPTS="%s" KAFKA_JVM_PERFORMANCE_OPTS="-server %s -Djava.awt.headless=true" "%s/bin/kafka-server-start.sh" -daemon "%s/config/server.properties"' % (
+            jvm_profile.heap_opts(), jvm_profile.performance_opts(), kafka_home, kafka_home))
 
-        log_fn(1, 'Kafka is now listening on "%s:%s".' % (master, port))
+        # Record the deployment
+        manifest.record_deployment(self.identifier, package_version.version, master, [master],
+            services={"broker": {"host": address.hostname, "port": int(port)}}, properties={"home": kafka_home, "interconnect": network, "jvm_heaps": jvm.machine_heaps(jvm_profiles, {"broker": [master]})})
+
+        log_fn(1, 'Kafka is now listening on "%s:%s".' % (address.hostname, port))
 
     def get_supported_deployment_settings(self, package_version):
         return _ALL_SETTINGS
 
+    def teardown_installed(self, kafka_home, package_version, deployment, log_fn=util.log):
+        log_fn(0, "Stopping Kafka broker on \"%s\"..." % deployment["master"])
+        executor.run(deployment["master"], '"%s/bin/kafka-server-stop.sh" || true' % os.path.realpath(kafka_home))
+        log_fn(1, "Kafka broker stopped.")
+
+    def get_log_locations(self, deployment):
+        return [(os.path.join(deployment["properties"]["home"], "logs"), [deployment["master"]])]
+
 get_package_registry().register_package(KafkaPackage())
 get_package_registry().package("kafka").add_version(KafkaPackageVersion("2.13-2.7.0", "https://www.apache.org/dyn/mirrors/mirrors.cgi?action=download&filename=/kafka/2.7.0/kafka_2.13-2.7.0.tgz", "tar.gz", "kafka_2.13-2.7.0", "2.7.x"))
 
@@ -0,0 +1,155 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from ..package import PackageRegistry, get_package_registry
+from ..condapackage import CondaPackage, CondaPackageVersion
+from .. import executor
+from .. import purge
+from .. import remote
+from .. import util
+
+import fnmatch
+import glob
+import os
+import re
+
+_SETTING_PORT = "port"
+_SETTING_POOL_MODE = "pool_mode"
+_SETTING_DEFAULT_POOL_SIZE = "default_pool_size"
+_SETTING_MAX_CLIENT_CONN = "max_client_conn"
+_ALL_SETTINGS = [
+    (_SETTING_PORT, "port PgBouncer will listen on"),
+    (_SETTING_POOL_MODE, "when server connections are returned to the pool: 'transaction', 'session', or 'statement'"),
+    (_SETTING_DEFAULT_POOL_SIZE, "server connections per database and user pair, or 'auto' to derive it from PostgreSQL's max_connections"),
+    (_SETTING_MAX_CLIENT_CONN, "maximum number of client connections, or 'auto' to derive it from PostgreSQL's max_connections")
+]
+
+_DEFAULT_PORT = 6432
+_DEFAULT_POOL_MODE = "transaction"
+_DEFAULT_DEFAULT_POOL_SIZE = "auto"
+_DEFAULT_MAX_CLIENT_CONN = "auto"
+
+_POOL_MODES = ["transaction", "session", "statement"]
+# Server connections left to superusers (PostgreSQL's superuser_reserved_connections) and direct clients
+_RESERVED_SERVER_CONNECTIONS = 3 + 10
+_CLIENT_CONNECTIONS_PER_SERVER_CONNECTION = 10
+
+class PgBouncerPackageVersion(CondaPackageVersion):
+    def __init__(self, version, conda_packages = [], conda_channels = [], pip_packages = [], template_dir = ""):
+        super(PgBouncerPackageVersion, self).__init__(version, conda_packages, conda_channels, pip_packages)
+        self.__template_dir = template_dir
+
+    @property
+    def template_dir(self):
+        return self.__template_dir
+
+class PgBouncerPackage(CondaPackage):
+    def __init__(self):
+        super(PgBouncerPackage, self).__init__("pgbouncer", "PgBouncer")
+
+    def deploy_installed(self, conda_env, package_version, machines, settings, manifest, log_fn=util.log):
+        """Deploys PgBouncer next to a previously deployed PostgreSQL server."""
+        postgresql_deployment = manifest.deployment("postgresql")
+        if not postgresql_deployment:
+            raise util.InvalidSetupError("PgBouncer requires PostgreSQL to be deployed in the same reservation first.")
+
+        # Extract settings
+        port = settings.pop(_SETTING_PORT, _DEFAULT_PORT)
+        pool_mode = str(settings.pop(_SETTING_POOL_MODE, _DEFAULT_POOL_MODE)).lower()
+        default_pool_size = str(settings.pop(_SETTING_DEFAULT_POOL_SIZE, _DEFAULT_DEFAULT_POOL_SIZE))
+        max_client_conn = str(settings.pop(_SETTING_MAX_CLIENT_CONN, _DEFAULT_MAX_CLIENT_CONN))
+        if len(settings) > 0:
+            raise util.InvalidSetupError("Found unknown settings for PgBouncer: '%s'" % "','".join(settings.keys()))
+        if pool_mode not in _POOL_MODES:
+            raise util.InvalidSetupError("Invalid value for PgBouncer setting '%s': '%s'. Expected one of '%s'." % (_SETTING_POOL_MODE, pool_mode, "','".join(_POOL_MODES)))
+        for setting_name, value in [(_SETTING_DEFAULT_POOL_SIZE, default_pool_size), (_SETTING_MAX_CLIENT_CONN, max_client_conn)]:
+            if value != "auto" and not value.isdigit():
+                raise util.InvalidSetupError("Invalid value for PgBouncer setting '%s': '%s'. Expected a number or 'auto'." % (setting_name, value))
+
+        # Run PgBouncer on the PostgreSQL machine, so server connections are local
+        postgresql_service = postgresql_deployment["services"]["postgresql"]
+        master = postgresql_service["host"]
+        log_fn(0, "Deploying PgBouncer on machine \"%s\"..." % master)
+
+        # Size the connection pools to the capacity of the PostgreSQL server
+        log_fn(1, "Determining connection pool sizes...")
+        max_connections = int(postgresql_deployment["properties"]["max_connections"])
+        server_connections = max(1, max_connections - _RESERVED_SERVER_CONNECTIONS)
+        if default_pool_size == "auto":
+            default_pool_size = max(1, server_connections * 3 // 4)
+        default_pool_size = int(default_pool_size)
+        reserve_pool_size = max(0, server_connections - default_pool_size)
+        if max_client_conn == "auto":
+            max_client_conn = max_connections * _CLIENT_CONNECTIONS_PER_SERVER_CONNECTION
+        max_client_conn = int(max_client_conn)
+        log_fn(2, "Pooling up to %d client connections over %d (+%d reserve) server connections." % (max_client_conn, default_pool_size, reserve_pool_size))
+
+        # Define root directory of PgBouncer files (config files, logs)
+        pgbouncer_data_root = "/local/%s/pgbouncer" % os.environ["USER"]
+
+        # Clean up previous PgBouncer deployments
+        log_fn(1, "Removing old environment on the PgBouncer machine...")
+        executor.run(master, purge.purge_directory_command(pgbouncer_data_root))
+        log_fn(2, "Old environment removed.")
+
+        # Generate configuration files using the included templates
+        log_fn(1, "Generating configuration files...")
+        # - Find template files
+        template_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "conf", "pgbouncer", package_version.template_dir))
+        template_files = []
+        for template_subdir, _, filenames in os.walk(template_dir):
+            for filename in fnmatch.filter(filenames, "*.template"):
+                template_files.append(os.path.join(os.path.relpath(template_subdir, template_dir), filename))
+        # - Generate a list of variables to substitute
+        substitutions = {
+            "__USER__": os.environ["USER"],
+            "__DATA_DIR__": pgbouncer_data_root,
+            "__PORT__": str(port),
+            "__POSTGRESQL_HOST__": "127.0.0.1",
+            "__POSTGRESQL_PORT__": str(postgresql_service["port"]),
+            "__POOL_MODE__": pool_mode,
+            "__MAX_CLIENT_CONN__": str(max_client_conn),
+            "__DEFAULT_POOL_SIZE__": str(default_pool_size),
+            "__MIN_POOL_SIZE__": str(min(default_pool_size, 10)),
+            "__RESERVE_POOL_SIZE__": str(reserve_pool_size),
+            "__MAX_DB_CONNECTIONS__": str(server_connections)
+        }
+        substitutions_pattern = re.compile("|".join([re.escape(k) for k in substitutions.keys()]))
+        # - Iterate over template files and apply substitutions
+        for rel_template_file_src in template_files:
+            rel_template_file_dst = rel_template_file_src[:-len(".template")]
+            template_file_src = os.path.join(template_dir, rel_template_file_src)
+            template_file_dst = os.path.join(pgbouncer_data_root, rel_template_file_dst)
+            log_fn(2, "Generating file \"<pgbouncer_root>/%s\"..." % rel_template_file_dst)
+            file_content = []
+            with open(template_file_src, "r") as template_in:
+                for line in template_in:
+                    file_content.append(substitutions_pattern.sub(lambda m: substitutions[m.group(0)], line.rstrip()))
+            remote.write_file(master, template_file_dst, "\n".join(file_content), os.stat(template_file_src).st_mode & 0o777)
+        log_fn(2, "Configuration files generated.")
+
+        # Start PgBouncer
+        log_fn(1, "Starting PgBouncer daemon...")
+        conda_env.remote_command(master, ["pgbouncer", "-d", os.path.join(pgbouncer_data_root, "pgbouncer.ini")])
+
+        # Record the deployment
+        manifest.record_deployment(self.identifier, package_version.version, master, [master],
+            services={"pgbouncer": {"host": master, "port": int(port)}},
+            properties={"data_dir": pgbouncer_data_root, "pool_mode": pool_mode, "default_pool_size": default_pool_size})
+
+        log_fn(1, 'PgBouncer is now listening on "%s:%s".' % (master, port))
+
+    def get_supported_deployment_settings(self, framework_version):
+        return _ALL_SETTINGS
+
+    def teardown_installed(self, conda_env, package_version, deployment, log_fn=util.log):
+        log_fn(0, "Stopping PgBouncer on \"%s\"..." % deployment["master"])
+        executor.run(deployment["master"], util.stop_pidfile_processes_command([os.path.join(deployment["properties"]["data_dir"], "pgbouncer.pid")]))
+        log_fn(1, "PgBouncer stopped.")
+
+    def get_log_locations(self, deployment):
+        return [(os.path.join(deployment["properties"]["data_dir"], "pgbouncer.log"), [deployment["master"]])]
+
+get_package_registry().register_package(PgBouncerPackage())
+get_package_registry().package("pgbouncer").add_version(PgBouncerPackageVersion("1.15.0", conda_packages=["pgbouncer=1.15.0"], conda_channels=[], template_dir="1.x"))
@@ -4,16 +4,64 @@ from __future__ import print_function
 
 from ..package import PackageRegistry, get_package_registry
 from ..condapackage import CondaPackage, CondaPackageVersion
+from .. import executor
+from .. import purge
+from .. import remote
 from .. import util
 
 import fnmatch
 import glob
 import os
 import re
-
+import subprocess
+
+_SETTING_TUNING = "tuning"
+_SETTING_DURABILITY = "durability"
+_SETTING_MAX_CONNECTIONS = "max_connections"
+_SETTING_SHARED_BUFFERS = "shared_buffers"
+_SETTING_EFFECTIVE_CACHE_SIZE = "effective_cache_size"
+_SETTING_WORK_MEM = "work_mem"
+_SETTING_MAINTENANCE_WORK_MEM = "maintenance_work_mem"
+_SETTING_MAX_WAL_SIZE = "max_wal_size"
+_SETTING_MAX_PARALLEL_WORKERS = "max_parallel_workers"
+_SETTING_SYNCHRONOUS_COMMIT = "synchronous_commit"
 _ALL_SETTINGS = [
+    (_SETTING_TUNING, "'stock' to use PostgreSQL's default configuration, or 'auto' to size it to the machine's memory and cores"),
+    (_SETTING_DURABILITY, "'default' for crash-safe operation, or 'benchmark' to trade durability for throughput"),
+    (_SETTING_MAX_CONNECTIONS, "maximum number of concurrent connections"),
+    (_SETTING_SHARED_BUFFERS, "memory used for shared buffers (e.g., 16GB)"),
+    (_SETTING_EFFECTIVE_CACHE_SIZE, "planner's estimate of the memory available for disk caching"),
+    (_SETTING_WORK_MEM, "memory used per sort or hash operation"),
+    (_SETTING_MAINTENANCE_WORK_MEM, "memory used by maintenance operations (e.g., VACUUM, CREATE INDEX)"),
+    (_SETTING_MAX_WAL_SIZE, "WAL size at which a checkpoint is triggered"),
+    (_SETTING_MAX_PARALLEL_WORKERS, "maximum number of parallel workers"),
+    (_SETTING_SYNCHRONOUS_COMMIT, "wait for WAL to be flushed before reporting a commit ('on' or 'off')")
 ]
 
+_TUNING_STOCK = "stock"
+_TUNING_AUTO = "auto"
+_DURABILITY_DEFAULT = "default"
+_DURABILITY_BENCHMARK = "benchmark"
+
+_DEFAULT_TUNING = _TUNING_STOCK
+_DEFAULT_DURABILITY = _DURABILITY_DEFAULT
+
+# Configuration of a stock PostgreSQL 12 installation
+_STOCK_CONFIGURATION = {
+    _SETTING_MAX_CONNECTIONS: "100",
+    _SETTING_SHARED_BUFFERS: "128MB",
+    _SETTING_EFFECTIVE_CACHE_SIZE: "4GB",
+    _SETTING_WORK_MEM: "4MB",
+    _SETTING_MAINTENANCE_WORK_MEM: "64MB",
+    _SETTING_MAX_WAL_SIZE: "1GB",
+    _SETTING_MAX_PARALLEL_WORKERS: "8",
+    _SETTING_SYNCHRONOUS_COMMIT: "on"
+}
+# Settings that are plain numbers rather than sizes or flags
+_NUMERIC_SETTINGS = [_SETTING_MAX_CONNECTIONS, _SETTING_MAX_PARALLEL_WORKERS]
+_AUTO_MAX_CONNECTIONS = 200
+_PORT = 5432
+
 class PostgreSQLPackageVersion(CondaPackageVersion):
     def __init__(self, version, conda_packages = [], conda_channels = [], pip_packages = [], template_dir = ""):
         super(PostgreSQLPackageVersion, self).__init__(version, conda_packages, conda_channels, pip_packages)
@@ -27,12 +75,25 @@ class PostgreSQLPackage(CondaPackage):
     def __init__(self):
         super(PostgreSQLPackage, self).__init__("postgresql", "PostgreSQL")
 
-    def deploy_installed(self, conda_env, package_version, machines, settings, log_fn=util.log):
+    def deploy_installed(self, conda_env, package_version, machines, settings, manifest, log_fn=util.log):
         """Deploys PostgreSQL to a given master node."""
         if len(machines) < 1:
             raise util.InvalidSetupError("PostgreSQL requires at least one machine to run on.")
 
         # Extract settings
+        tuning = str(settings.pop(_SETTING_TUNING, _DEFAULT_TUNING)).lower()
+        if tuning not in [_TUNING_STOCK, _TUNING_AUTO]:
+            raise util.InvalidSetupError("Invalid value for PostgreSQL setting '%s': '%s'. Expected '%s' or '%s'." % (_SETTING_TUNING, tuning, _TUNING_STOCK, _TUNING_AUTO))
+        durability = str(settings.pop(_SETTING_DURABILITY, _DEFAULT_DURABILITY)).lower()
+        if durability not in [_DURABILITY_DEFAULT, _DURABILITY_BENCHMARK]:
+            raise util.InvalidSetupError("Invalid value for PostgreSQL setting '%s': '%s'. Expected '%s' or '%s'." % (_SETTING_DURABILITY, durability, _DURABILITY_DEFAULT, _DURABILITY_BENCHMARK))
+        overrides = {}
+        for setting_name in _STOCK_CONFIGURATION:
+            if setting_name in settings:
+                overrides[setting_name] = str(settings.pop(setting_name))
+        for setting_name in _NUMERIC_SETTINGS:
+            if setting_name in overrides and not overrides[setting_name].isdigit():
+                raise util.InvalidSetupError("Invalid value for PostgreSQL setting '%s': '%s'. Expected a number." % (setting_name, overrides[setting_name]))
         if len(settings) > 0:
             raise util.InvalidSetupError("Found unknown settings for PostgreSQL: '%s'" % "','".join(settings.keys()))
 
@@ -40,12 +101,26 @@ class PostgreSQLPackage(CondaPackage):
         master = machines[0]
         log_fn(0, "Deploying PostgreSQL on machine \"%s\"..." % master)
 
+        # Determine the server configuration
+        log_fn(1, "Determining server configuration...")
+        configuration = _STOCK_CONFIGURATION.copy()
+        if tuning == _TUNING_AUTO:
+            host_resources = remote.probe_host_resources(master)
+            log_fn(2, "Tuning for %d MB of memory and %d cores." % (host_resources.memory_mb, host_resources.cores))
+            configuration.update(_auto_tuned_configuration(host_resources))
+        if durability == _DURABILITY_BENCHMARK:
+            log_fn(2, "Disabling durability guarantees for benchmarking.")
+            configuration[_SETTING_SYNCHRONOUS_COMMIT] = "off"
+        configuration.update(overrides)
+        max_parallel_workers = int(configuration[_SETTING_MAX_PARALLEL_WORKERS])
+        benchmark_durability = durability == _DURABILITY_BENCHMARK
+
         # Define root directory of PostgreSQL files (data, metadata, config files)
         postgresql_data_root = "/local/%s/postgresql" % os.environ["USER"]
 
         # Clean up previous PostgreSQL deployments
         log_fn(1, "Removing old environment on the PostgreSQL machine...")
-        util.execute_command_quietly(["ssh", master, 'rm -rf "%s"' % postgresql_data_root])
+        executor.run(master, purge.purge_directory_command(postgresql_data_root))
         log_fn(2, "Old environment removed.")
 
         # Create empty database
@@ -66,7 +141,22 @@ class PostgreSQLPackage(CondaPackage):
             "__USER__": os.environ["USER"],
             "__HOST__": master,
             "__CONDA_ROOT__": conda_env.root,
-            "__DATA_DIR__": postgresql_data_root
+            "__DATA_DIR__": postgresql_data_root,
+            "__MAX_CONNECTIONS__": configuration[_SETTING_MAX_CONNECTIONS],
+            "__SHARED_BUFFERS__": configuration[_SETTING_SHARED_BUFFERS],
+            "__EFFECTIVE_CACHE_SIZE__": configuration[_SETTING_EFFECTIVE_CACHE_SIZE],
+            "__WORK_MEM__": configuration[_SETTING_WORK_MEM],
+            "__MAINTENANCE_WORK_MEM__": configuration[_SETTING_MAINTENANCE_WORK_MEM],
+            "__MAX_WAL_SIZE__": configuration[_SETTING_MAX_WAL_SIZE],
+            "__MAX_WORKER_PROCESSES__": str(max(8, max_parallel_workers)),
+            "__MAX_PARALLEL_WORKERS__": str(max_parallel_workers),
+            "__MAX_PARALLEL_WORKERS_PER_GATHER__": str(max(1, min(4, max_parallel_workers // 2))),
+            "__MAX_PARALLEL_MAINTENANCE_WORKERS__": str(max(1, min(4, max_parallel_workers // 2))),
+            "__SYNCHRONOUS_COMMIT__": configuration[_SETTING_SYNCHRONOUS_COMMIT],
+            "__FSYNC__": "off" if benchmark_durability else "on",
+            "__FULL_PAGE_WRITES__": "off" if benchmark_durability else "on",
+            "__WAL_LEVEL__": "minimal" if benchmark_durability else "replica",
+            "__MAX_WAL_SENDERS__": "0" if benchmark_durability else "10"
         }
         substitutions_pattern = re.compile("|".join([re.escape(k) for k in substitutions.keys()]))
         # - Iterate over template files and apply substitutions
@@ -79,7 +169,7 @@ class PostgreSQLPackage(CondaPackage):
             with open(template_file_src, "r") as template_in:
                 for line in template_in:
                     file_content.append(substitutions_pattern.sub(lambda m: substitutions[m.group(0)], line.rstrip()))
-            util.write_remote_file(master, template_file_dst, "\n".join(file_content), os.stat(template_file_src).st_mode & 0o777)
+            remote.write_file(master, template_file_dst, "\n".join(file_content), os.stat(template_file_src).st_mode & 0o777)
         log_fn(2, "Configuration files generated.")
 
         # Ensure that /var/log exists in the Conda environment
@@ -91,11 +181,41 @@ class PostgreSQLPackage(CondaPackage):
         log_fn(1, "Starting PostgreSQL daemon...")
         conda_env.remote_command(master, ["pg_ctl", "-D", postgresql_data_root, "-l", os.path.join(log_dir, "postgres"), "start"])
 
-        log_fn(1, 'PostgreSQL is now listening on "%s:5432".' % master)
+        # Record the deployment
+        manifest.record_deployment(self.identifier, package_version.version, master, [master],
+            services={"postgresql": {"host": master, "port": _PORT}},
+            properties={"data_dir": postgresql_data_root, "log_file": os.path.join(log_dir, "postgres"), "max_connections": int(configuration[_SETTING_MAX_CONNECTIONS])})
+
+        log_fn(1, 'PostgreSQL is now listening on "%s:%d".' % (master, _PORT))
 
     def get_supported_deployment_settings(self, framework_version):
         return _ALL_SETTINGS
 
+    def teardown_installed(self, conda_env, package_version, deployment, log_fn=util.log):
+        log_fn(0, "Stopping PostgreSQL on \"%s\"..." % deployment["master"])
+        try:
+            conda_env.remote_command(deployment["master"], ["pg_ctl", "-D", deployment["properties"]["data_dir"], "-m", "fast", "stop"])
+            log_fn(1, "PostgreSQL stopped.")
+        except subprocess.CalledProcessError:
+            log_fn(1, "PostgreSQL was not running.")
+
+    def get_log_locations(self, deployment):
+        return [(deployment["properties"]["log_file"], [deployment["master"]])]
+
+def _auto_tuned_configuration(host_resources):
+    """Derives memory, WAL, and parallelism settings from the resources of the database machine."""
+    memory_mb = host_resources.memory_mb
+    shared_buffers_mb = memory_mb // 4
+    return {
+        _SETTING_MAX_CONNECTIONS: str(_AUTO_MAX_CONNECTIONS),
+        _SETTING_SHARED_BUFFERS: "%dMB" % shared_buffers_mb,
+        _SETTING_EFFECTIVE_CACHE_SIZE: "%dMB" % (memory_mb * 3 // 4),
+        _SETTING_WORK_MEM: "%dMB" % max(4, (memory_mb - shared_buffers_mb) // (_AUTO_MAX_CONNECTIONS * 3)),
+        _SETTING_MAINTENANCE_WORK_MEM: "%dMB" % max(64, min(2048, memory_mb // 16)),
+        _SETTING_MAX_WAL_SIZE: "8GB" if memory_mb >= 32768 else "4GB",
+        _SETTING_MAX_PARALLEL_WORKERS: str(host_resources.cores)
+    }
+
 get_package_registry().register_package(PostgreSQLPackage())
 get_package_registry().package("postgresql").add_version(PostgreSQLPackageVersion("12.2", conda_packages=["postgresql=12.2"], conda_channels=[], template_dir="12.x"))
 
@@ -2,14 +2,45 @@
 
 from __future__ import print_function
 
-from ..package import PackageRegistry, get_package_registry
+from ..package import DeployFailedError, PackageRegistry, get_package_registry
 from ..nativepackage import NativePackage, NativePackageVersion
+from .. import executor
+from .. import purge
+from .. import remote
 from .. import util
 
 import fnmatch
 import glob
+import hashlib
+import multiprocessing
 import os.path
+import pipes
 import re
+import shutil
+import tempfile
+
+_SETTING_CUDA = "cuda"
+_SETTING_MAKE_JOBS = "make_jobs"
+_SETTING_MAKE_FLAGS = "make_flags"
+_SETTING_DAEMON_STARTUP = "daemon_startup"
+_ALL_SETTINGS = [
+    (_SETTING_CUDA, "load the CUDA toolkit module when compiling, disable for CPU-only nodes"),
+    (_SETTING_MAKE_JOBS, "number of parallel jobs to compile with (default: number of local cores)"),
+    (_SETTING_MAKE_FLAGS, "additional flags or variable assignments to pass to make"),
+    (_SETTING_DAEMON_STARTUP, "start the daemons from the deployer on all machines concurrently ('parallel') or through the resource monitor's start-all.sh ('scripts')")
+]
+
+_DEFAULT_CUDA = True
+_DEFAULT_MAKE_JOBS = multiprocessing.cpu_count()
+_DEFAULT_MAKE_FLAGS = ""
+_DEFAULT_DAEMON_STARTUP = "parallel"
+
+_DAEMON_STARTUP_MODES = ["parallel", "scripts"]
+# Seconds to wait for a daemon to write its pidfile after it has been started
+_PIDFILE_TIMEOUT = 10
+
+_CUDA_MODULE = "cuda10.1/toolkit"
+_BUILD_COMPLETE_MARKER = ".build-complete"
 
 class ResourceMonitorPackageVersion(NativePackageVersion):
     def __init__(self, version, archive_url, archive_extension, archive_root_dir, template_dir, requires_make):
@@ -29,7 +60,7 @@ class ResourceMonitorPackage(NativePackage):
     def __init__(self):
         super(ResourceMonitorPackage, self).__init__("resource-monitor", "Resource Monitor")
 
-    def deploy_installed(self, resource_monitor_home, package_version, machines, settings, log_fn=util.log):
+    def deploy_installed(self, resource_monitor_home, package_version, machines, settings, manifest, log_fn=util.log):
         """Deploys a resource monitor on every node in a cluster."""
         if len(machines) < 1:
             raise util.InvalidSetupError("Resource Monitor requires at least one machine to run on.")
@@ -37,9 +68,36 @@ class ResourceMonitorPackage(NativePackage):
         # Ensure that RESOURCE_MONITOR_HOME is an absolute path
         resource_monitor_home = os.path.realpath(resource_monitor_home)
 
-        # Resource Monitor currently has no settings
+        # Extract settings
+        cuda_str = str(settings.pop(_SETTING_CUDA, _DEFAULT_CUDA)).lower()
+        cuda = cuda_str in ['true', 't', 'yes', 'y', '1']
+        make_jobs = str(settings.pop(_SETTING_MAKE_JOBS, _DEFAULT_MAKE_JOBS))
+        make_flags = str(settings.pop(_SETTING_MAKE_FLAGS, _DEFAULT_MAKE_FLAGS))
+        daemon_startup = str(settings.pop(_SETTING_DAEMON_STARTUP, _DEFAULT_DAEMON_STARTUP)).lower()
         if len(settings) > 0:
             raise util.InvalidSetupError("Found unknown settings for Resource Monitor: '%s'" % "','".join(settings.keys()))
+        if daemon_startup not in _DAEMON_STARTUP_MODES:
+            raise util.InvalidSetupError("Invalid value for Resource Monitor setting '%s': '%s'. Expected one of '%s'." % (_SETTING_DAEMON_STARTUP, daemon_startup, "','".join(_DAEMON_STARTUP_MODES)))
+        if not make_jobs.isdigit() or int(make_jobs) < 1:
+            raise util.InvalidSetupError("Invalid value for Resource Monitor setting '%s': '%s'. Expected a positive number." % (_SETTING_MAKE_JOBS, make_jobs))
+        make_jobs = int(make_jobs)
+
+        # Build the resource monitor binary if needed, or reuse a cached build
+        if package_version.requires_make:
+            resource_monitor_home = _get_or_build_binaries(resource_monitor_home, package_version, cuda, make_jobs, make_flags, log_fn=log_fn)
+
+        # Clean up previous resource monitor deployments
+        log_fn(1, "Creating a clean environment on each machine...")
+        local_resource_monitor_dir = "/local/%s/resource-monitor/" % os.environ["USER"]
+        log_fn(2, "Purging \"%s\" on machines..." % local_resource_monitor_dir)
+        executor.run_all([(machine, purge.purge_directory_command(local_resource_monitor_dir)) for machine in machines], step="purge")
+        log_fn(2, "Creating directory structure on machines...")
+        executor.run_all([(machine, 'mkdir -p "%s/metrics" "%s/logs"' % (local_resource_monitor_dir, local_resource_monitor_dir))
+            for machine in machines], step="mkdir")
+        log_fn(2, "Clean environment set up.")
+
+        # Leave out machines that were too slow to set up, if requested
+        machines = executor.exclude_stragglers(machines, log_fn=util.create_log_fn(1, log_fn))
 
         # Generate configuration files using the included templates
         log_fn(1, "Generating configuration files...")
@@ -70,35 +128,113 @@ class ResourceMonitorPackage(NativePackage):
             os.chmod(template_file_dst, os.stat(template_file_src).st_mode)
         log_fn(2, "Configuration files generated.")
 
-        # Build the resource monitor binary if needed
-        if package_version.requires_make:
-            log_fn(1, "Compiling Resource Monitor binaries...")
-            old_dir = os.getcwd()
-            os.chdir(resource_monitor_home)
-            try:
-                util.execute_command_quietly(['module load cuda10.1/toolkit; make'], shell=True)
-            finally:
-                os.chdir(old_dir)
-
-        # Clean up previous resource monitor deployments
-        log_fn(1, "Creating a clean environment on each machine...")
-        local_resource_monitor_dir = "/local/%s/resource-monitor/" % os.environ["USER"]
-        log_fn(2, "Purging \"%s\" on machines..." % local_resource_monitor_dir)
-        for machine in machines:
-            util.execute_command_quietly(['ssh', machine, 'rm -rf "%s"' % local_resource_monitor_dir])
-        log_fn(2, "Creating directory structure on machines...")
-        for machine in machines:
-            util.execute_command_quietly(['ssh', machine, 'mkdir -p "%s/metrics" "%s/logs"' % \
-                (local_resource_monitor_dir, local_resource_monitor_dir)])
-        log_fn(2, "Clean environment set up.")
-
         # Start the resource monitor daemon on every machine
         log_fn(1, "Deploying Resource Monitor to every machine in the reservation...")
-        util.execute_command_quietly(['%s/sbin/start-all.sh' % resource_monitor_home])
+        if daemon_startup == "parallel":
+            start_times = _start_daemons(resource_monitor_home, local_resource_monitor_dir, machines, log_fn=util.create_log_fn(2, log_fn))
+        else:
+            util.execute_command_quietly(['%s/sbin/start-all.sh' % resource_monitor_home])
+            start_times = {}
         log_fn(1, "Resource Monitor is now running on all machines.")
 
+        # Record the deployment, including when each daemon started to align metrics across machines
+        manifest.record_deployment(self.identifier, package_version.version, None, machines, properties={"home": resource_monitor_home, "start_times": start_times})
+
     def get_supported_deployment_settings(self, package_version):
-        return []
+        return _ALL_SETTINGS
+
+    def teardown_installed(self, resource_monitor_home, package_version, deployment, log_fn=util.log):
+        log_fn(0, "Stopping Resource Monitor on %d machines..." % len(deployment["machines"]))
+        stop_command = util.stop_pidfile_processes_command(["/local/%s/resource-monitor/resource-monitor.pid" % os.environ["USER"]])
+        executor.run_all([(machine, stop_command) for machine in deployment["machines"]])
+        log_fn(1, "Resource Monitor stopped.")
+
+    def get_log_locations(self, deployment):
+        return [("/local/%s/resource-monitor/logs" % os.environ["USER"], deployment["machines"])]
+
+def _start_daemons(resource_monitor_home, local_resource_monitor_dir, machines, log_fn=util.log):
+    """Starts the daemon on all machines concurrently and verifies that each wrote its pidfile.
+
+    Returns the time at which each daemon was started, according to the clock of its machine, by machine."""
+    pid_file = os.path.join(local_resource_monitor_dir, "resource-monitor.pid")
+    start_time_file = os.path.join(local_resource_monitor_dir, "start-time")
+    log_fn(0, "Starting daemons on %d machines..." % len(machines))
+    # Every machine runs start-all.sh for itself only, and records when it did so
+    tasks = executor.run_all([(machine, 'date +%%s.%%N > "%s" && RESOURCE_MONITOR_MACHINES=%s "%s/sbin/start-all.sh"' %
+        (start_time_file, pipes.quote(machine), resource_monitor_home)) for machine in machines], step="start daemons", raise_errors=False)
+    failed_machines = [task.machine for task in tasks if task.error is not None]
+    for task in tasks:
+        if task.error is not None:
+            log_fn(1, "Failed to start daemon on \"%s\": %s" % (task.machine, task.error))
+
+    # Confirm that the daemons are running and collect their start times
+    log_fn(0, "Verifying pidfiles...")
+    verify_command = ('for i in $(seq %d); do [ -f "%s" ] && break; sleep 0.1; done; '
+        '[ -f "%s" ] && kill -0 $(cat "%s") 2>/dev/null && cat "%s"; true') % (_PIDFILE_TIMEOUT * 10, pid_file, pid_file, pid_file, start_time_file)
+    started_machines = [machine for machine in machines if machine not in failed_machines]
+    verify_outputs = util.run_in_parallel(remote.execute_for_output, [(machine, verify_command) for machine in started_machines])
+    start_times = {}
+    for machine, verify_output in zip(started_machines, verify_outputs):
+        try:
+            start_times[machine] = float(verify_output.strip())
+        except ValueError:
+            log_fn(1, "Daemon on \"%s\" is not running or did not write its pidfile." % machine)
+            failed_machines.append(machine)
+    if failed_machines:
+        raise DeployFailedError("Resource Monitor failed to start on machine(s) \"%s\"." % "\",\"".join(failed_machines))
+
+    # Report the skew in start times, which offsets the metric timelines of different machines
+    first_start_time = min(start_times.values())
+    last_machine = max(start_times, key=lambda machine: start_times[machine])
+    log_fn(1, "All daemons started within %.3f seconds; last on \"%s\"." % (start_times[last_machine] - first_start_time, last_machine))
+    return start_times
+
+def _build_environment_command(cuda):
+    return "module load %s; " % _CUDA_MODULE if cuda else ""
+
+def _build_cache_key(package_version, cuda, make_flags):
+    """Identifies a build by package version, compiler versions, and build flags."""
+    compiler_versions = util.execute_command_for_output(["bash", "-c",
+        _build_environment_command(cuda) + "cc --version 2>&1 | head -n 1; " + ("nvcc --version 2>&1 | tail -n 1" if cuda else "")])
+    build_description = "\n".join([package_version.version, compiler_versions.strip(), "cuda=%s" % cuda, "make_flags=%s" % make_flags])
+    return hashlib.sha1(build_description.encode("utf-8")).hexdigest()[:16]
+
+def _get_or_build_binaries(source_dir, package_version, cuda, make_jobs, make_flags, log_fn=util.log):
+    """Returns a directory containing a compiled copy of the sources, compiling only if no matching build is cached.
+
+    Builds happen in a private staging directory that is atomically renamed into the cache when complete,
+    so concurrent deployments never observe or clobber a partial build."""
+    log_fn(1, "Looking for cached Resource Monitor binaries...")
+    build_cache_dir = os.path.join(os.path.dirname(source_dir), "build-cache")
+    build_dir = os.path.join(build_cache_dir, "%s-%s" % (os.path.basename(source_dir), _build_cache_key(package_version, cuda, make_flags)))
+    if os.path.exists(os.path.join(build_dir, _BUILD_COMPLETE_MARKER)):
+        log_fn(2, "Found cached build at \"%s\". Skipping compilation." % build_dir)
+        return build_dir
+    log_fn(2, "No cached build found.")
+
+    # Compile a copy of the sources in a staging directory
+    log_fn(1, "Compiling Resource Monitor binaries with %d parallel jobs%s..." % (make_jobs, "" if cuda else " without CUDA"))
+    if not os.path.exists(build_cache_dir):
+        os.makedirs(build_cache_dir)
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=build_cache_dir)
+    try:
+        staging_build_dir = os.path.join(staging_dir, "build")
+        shutil.copytree(source_dir, staging_build_dir, symlinks=True)
+        util.execute_command_quietly(['%scd %s && make -j %d %s' % (_build_environment_command(cuda), pipes.quote(staging_build_dir), make_jobs, make_flags)], shell=True)
+        open(os.path.join(staging_build_dir, _BUILD_COMPLETE_MARKER), "w").close()
+        log_fn(2, "Compilation complete.")
+
+        # Publish the build, unless a concurrent deployment published an identical build first
+        try:
+            os.rename(staging_build_dir, build_dir)
+            log_fn(2, "Cached build at \"%s\"." % build_dir)
+        except OSError:
+            if not os.path.exists(os.path.join(build_dir, _BUILD_COMPLETE_MARKER)):
+                raise
+            log_fn(2, "Another deployment cached an identical build first. Using it instead.")
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return build_dir
 
 get_package_registry().register_package(ResourceMonitorPackage())
 get_package_registry().package('resource-monitor').add_version(ResourceMonitorPackageVersion(
@@ -2,114 +2,416 @@
 
 from __future__ import print_function
 
-from ..package import PackageRegistry, get_package_registry
+from ..package import DeployFailedError, PackageRegistry, get_package_registry, parse_version, select_template_dirs
 from ..nativepackage import NativePackage, NativePackageVersion
+from .. import executor
+from .. import filelock
+from .. import interconnect
+from .. import jvm
+from .. import purge
 from .. import util
+from . import hadoop
 
 import glob
-import os.path
+import json
+import os
 import re
+import tempfile
+import time
+import urllib2
+import zipfile
 
 _SETTING_WORKER_INSTANCES = "worker_instances"
 _SETTING_WORKER_CORES = "worker_cores"
 _SETTING_WORKER_MEMORY = "worker_memory"
 _SETTING_PRELOAD_SCRIPT = "preload_script"
+_SETTING_DAEMON_STARTUP = "daemon_startup"
+_SETTING_INTERCONNECT = "interconnect"
+_SETTING_LOCAL_DIRS = "local_dirs"
+_SETTING_OFFHEAP_MEMORY = "offheap_memory"
+_SETTING_CLUSTER_MANAGER = "cluster_manager"
 _ALL_SETTINGS = [
-    (_SETTING_WORKER_INSTANCES, "worker instances to launch per node"),
-    (_SETTING_WORKER_CORES, "cores available per worker instance to Spark"),
-    (_SETTING_WORKER_MEMORY, "memory available per worker instance to Spark"),
-    (_SETTING_PRELOAD_SCRIPT, "script to run before any Spark command to set up environment")
-]
+    (_SETTING_CLUSTER_MANAGER, "run Spark's own master and workers ('standalone') or run applications on the YARN cluster of the Hadoop deployment ('yarn')"),
+    (_SETTING_WORKER_INSTANCES, "worker instances to launch per node (on YARN: executors to allocate per node at most)"),
+    (_SETTING_WORKER_CORES, "cores available per worker instance to Spark (on YARN: per executor)"),
+    (_SETTING_WORKER_MEMORY, "memory available per worker instance to Spark (on YARN: per executor)"),
+    (_SETTING_PRELOAD_SCRIPT, "script to run before any Spark command to set up environment"),
+    (_SETTING_DAEMON_STARTUP, "start worker instances from the deployer on all workers concurrently ('parallel') or through Spark's start-all.sh ('scripts') (standalone only)"),
+    (_SETTING_INTERCONNECT, interconnect.SETTING_DESCRIPTION),
+    (_SETTING_LOCAL_DIRS, "where to store shuffle and spill files: 'local' (local disk), 'tmpfs' (memory), or a comma-separated list of directories"),
+    (_SETTING_OFFHEAP_MEMORY, "off-heap memory per executor, taken from worker_memory, e.g., '4g' or '0' to disable (Spark 3 only, default: a fifth of worker_memory)")
+] + jvm.supported_settings(["master", "worker"])
 
 _DEFAULT_WORKER_INSTANCES = 1
 _DEFAULT_WORKER_CORES = 1
 _DEFAULT_WORKER_MEMORY = "1g"
 _DEFAULT_PRELOAD_SCRIPT = ""
+_DEFAULT_DAEMON_STARTUP = "parallel"
+_DEFAULT_LOCAL_DIRS = "local"
+_DEFAULT_CLUSTER_MANAGER = "standalone"
+
+# Configuration templates by the first Spark version they support
+_TEMPLATE_DIRS = [("2.4.0", "2.4.x"), ("3.0.0", "3.x")]
+_LOCAL_DIRS_LOCAL = "local"
+_LOCAL_DIRS_TMPFS = "tmpfs"
+_TMPFS_DIR = "/dev/shm"
+_OFFHEAP_FRACTION = 0.2
+_CLUSTER_MANAGER_STANDALONE = "standalone"
+_CLUSTER_MANAGER_YARN = "yarn"
+_CLUSTER_MANAGERS = [_CLUSTER_MANAGER_STANDALONE, _CLUSTER_MANAGER_YARN]
+# Spark's external shuffle service, run as an auxiliary service of the YARN nodemanagers
+_YARN_SHUFFLE_SERVICE = "spark_shuffle"
+_YARN_SHUFFLE_SERVICE_CLASS = "org.apache.spark.network.yarn.YarnShuffleService"
+_YARN_SHUFFLE_SERVICE_PORT = 7337
+_YARN_SHUFFLE_JAR_PATTERN = "spark-*-yarn-shuffle.jar"
+# HDFS directory to upload the archive of Spark's jars to
+_YARN_ARCHIVE_DIR = "/spark"
+# Number of tasks per core to split jobs and shuffles into, to even out differences in task durations
+_TASKS_PER_CORE = 2
+
+_DAEMON_STARTUP_MODES = ["parallel", "scripts"]
+_MASTER_PORT = 7077
+_MASTER_WEBUI_PORT = 12345
+_WORKER_WEBUI_PORT = 8081
+_REGISTRATION_TIMEOUT = 120.0
+_REGISTRATION_POLL_INTERVAL = 0.5
+_IP_ADDRESS_PATTERN = re.compile(r"^\d+\.\d+\.\d+\.\d+$")
 
 class SparkPackageVersion(NativePackageVersion):
-    def __init__(self, version, archive_url, archive_extension, archive_root_dir, template_dir):
+    def __init__(self, version, archive_url, archive_extension, archive_root_dir):
         super(SparkPackageVersion, self).__init__(version, archive_url, archive_extension, archive_root_dir)
-        self.__template_dir = template_dir
+        self.__template_dirs = select_template_dirs(version, _TEMPLATE_DIRS)
 
     @property
     def template_dir(self):
-        return self.__template_dir
+        return self.__template_dirs[0]
+
+    @property
+    def template_dirs(self):
+        """Directories to take templates from, latest version range first; templates in earlier ranges are shared with later ones."""
+        return list(self.__template_dirs)
 
 class SparkPackage(NativePackage):
     def __init__(self):
         super(SparkPackage, self).__init__("spark", "Spark")
 
-    def deploy_installed(self, spark_home, package_version, machines, settings, log_fn=util.log):
+    def deploy_installed(self, spark_home, package_version, machines, settings, manifest, log_fn=util.log):
         """Deploys Spark to a given set of workers and a master node."""
-        if len(machines) < 2:
-            raise util.InvalidSetupError("Spark requires at least two machines: a master and at least one worker.")
-
         # Extract settings
+        cluster_manager = str(settings.pop(_SETTING_CLUSTER_MANAGER, _DEFAULT_CLUSTER_MANAGER)).lower()
         worker_instances = str(settings.pop(_SETTING_WORKER_INSTANCES, _DEFAULT_WORKER_INSTANCES))
         worker_cores = str(settings.pop(_SETTING_WORKER_CORES, _DEFAULT_WORKER_CORES))
         worker_memory = str(settings.pop(_SETTING_WORKER_MEMORY, _DEFAULT_WORKER_MEMORY))
         preload_script = str(settings.pop(_SETTING_PRELOAD_SCRIPT, _DEFAULT_PRELOAD_SCRIPT))
+        daemon_startup = settings.pop(_SETTING_DAEMON_STARTUP, None)
+        network = settings.pop(_SETTING_INTERCONNECT, None)
+        local_dirs_setting = str(settings.pop(_SETTING_LOCAL_DIRS, _DEFAULT_LOCAL_DIRS))
+        offheap_memory = settings.pop(_SETTING_OFFHEAP_MEMORY, None)
+        jvm_overrides = jvm.pop_overrides(settings, ["master", "worker"])
         if len(settings) > 0:
             raise util.InvalidSetupError("Found unknown settings for Spark: '%s'" % "','".join(settings.keys()))
+        is_spark_3 = parse_version(package_version.version) >= (3,)
+        if offheap_memory is not None and not is_spark_3:
+            raise util.InvalidSetupError("Spark setting '%s' requires Spark 3 or later." % _SETTING_OFFHEAP_MEMORY)
+        if cluster_manager not in _CLUSTER_MANAGERS:
+            raise util.InvalidSetupError("Invalid value for Spark setting '%s': '%s'. Expected one of '%s'." % (_SETTING_CLUSTER_MANAGER, cluster_manager, "','".join(_CLUSTER_MANAGERS)))
+        on_yarn = cluster_manager == _CLUSTER_MANAGER_YARN
+        if on_yarn and (daemon_startup is not None or any(jvm_overrides.values())):
+            raise util.InvalidSetupError("Spark setting '%s' and the JVM settings of the master and workers only apply to the '%s' cluster manager." %
+                (_SETTING_DAEMON_STARTUP, _CLUSTER_MANAGER_STANDALONE))
+        daemon_startup = str(daemon_startup or _DEFAULT_DAEMON_STARTUP).lower()
+        if daemon_startup not in _DAEMON_STARTUP_MODES:
+            raise util.InvalidSetupError("Invalid value for Spark setting '%s': '%s'. Expected one of '%s'." % (_SETTING_DAEMON_STARTUP, daemon_startup, "','".join(_DAEMON_STARTUP_MODES)))
 
-        # Select master and workers
-        master = machines[0]
-        workers = machines[1:]
-        log_fn(0, "Deploying Spark driver on \"%s\", with %d workers." % (master, len(workers)))
+        # Select master and workers; on YARN, the driver runs on the Hadoop master and executors in containers on its workers
+        if on_yarn:
+            hadoop_deployment = manifest.deployment("hadoop")
+            if not hadoop_deployment or not hadoop_deployment["properties"]["yarn_enable"] or not hadoop_deployment["properties"]["hdfs_enable"]:
+                raise util.InvalidSetupError("Spark on YARN requires Hadoop to be deployed with YARN and HDFS in the same reservation first.")
+            master = hadoop_deployment["master"]
+            workers = [machine for machine in hadoop_deployment["machines"] if machine != master]
+            network = interconnect.parse_interconnect(network or hadoop_deployment["properties"].get("interconnect", interconnect.DEFAULT_INTERCONNECT))
+            log_fn(0, "Deploying Spark on the YARN cluster of Hadoop master \"%s\", with %d workers." % (master, len(workers)))
+        else:
+            if len(machines) < 2:
+                raise util.InvalidSetupError("Spark requires at least two machines: a master and at least one worker.")
+            master = machines[0]
+            workers = machines[1:]
+            network = interconnect.parse_interconnect(network or interconnect.DEFAULT_INTERCONNECT)
+            log_fn(0, "Deploying Spark driver on \"%s\", with %d workers." % (master, len(workers)))
 
         # Ensure that SPARK_HOME is an absolute path
         spark_home = os.path.realpath(spark_home)
 
-        # Generate configuration files using the included templates
-        template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "conf", "spark", package_version.template_dir)
+        # Select where to store shuffle and spill files
+        local_spark_dir = "/local/%s/spark/" % os.environ["USER"]
+        tmpfs_spark_dir = os.path.join(_TMPFS_DIR, os.environ["USER"], "spark")
+        if local_dirs_setting == _LOCAL_DIRS_LOCAL:
+            local_dirs = [local_spark_dir]
+        elif local_dirs_setting == _LOCAL_DIRS_TMPFS:
+            local_dirs = [tmpfs_spark_dir]
+        else:
+            local_dirs = [local_dir.strip() for local_dir in local_dirs_setting.split(",") if local_dir.strip()]
+            if not local_dirs or not all([os.path.isabs(local_dir) for local_dir in local_dirs]):
+                raise util.InvalidSetupError("Invalid value for Spark setting '%s': '%s'. Expected '%s', '%s', or a comma-separated list of absolute paths." %
+                    (_SETTING_LOCAL_DIRS, local_dirs_setting, _LOCAL_DIRS_LOCAL, _LOCAL_DIRS_TMPFS))
+
+        # Clean up previous Spark deployments; directories given by the user are created, but never purged.
+        # On YARN, only the driver uses these directories, as executors use those of the nodemanagers.
+        spark_machines = [master] if on_yarn else [master] + workers
+        log_fn(1, "Creating a clean environment on the %s..." % ("master" if on_yarn else "master and workers"))
+        purge_dirs = [local_spark_dir] + ([tmpfs_spark_dir] if tmpfs_spark_dir in local_dirs else [])
+        log_fn(2, "Purging \"%s\"..." % "\",\"".join(purge_dirs))
+        executor.run_all([(machine, purge.purge_directory_command(purge_dir)) for machine in spark_machines for purge_dir in purge_dirs], step="purge")
+        log_fn(2, "Creating directory structure...")
+        executor.run_all([(machine, 'mkdir -p %s' % " ".join(['"%s"' % local_dir for local_dir in [local_spark_dir] + local_dirs])) for machine in spark_machines], step="mkdir")
+        log_fn(2, "Clean environment set up.")
+
+        # Leave out workers that were too slow to set up, if requested
+        if not on_yarn:
+            workers = executor.exclude_stragglers(workers, log_fn=util.create_log_fn(1, log_fn))
+
+        # Resolve the addresses to bind and advertise services on
+        addresses = interconnect.resolve_addresses([master] + workers, network, log_fn=util.create_log_fn(1, log_fn))
+        master_hostname = addresses[master].hostname
+
+        # Size the JVMs of the master and worker daemons; executors are sized by the worker_memory setting instead
+        if not on_yarn:
+            log_fn(1, "Computing JVM profiles...")
+            daemon_machines = {"master": [master], "worker": workers * int(worker_instances)}
+            jvm_profiles = jvm.compute_profiles({"master": jvm.ROLE_AUXILIARY, "worker": jvm.ROLE_WORKER}, daemon_machines, jvm_overrides,
+                reserved_heaps=jvm.reserved_heaps(manifest, self.identifier), log_fn=util.create_log_fn(2, log_fn))
+
+        # Derive parallelism from the cores of all worker instances, and carve off-heap memory out of the worker memory
+        total_cores = int(worker_cores) * int(worker_instances) * len(workers)
+        parallelism = max(_TASKS_PER_CORE * total_cores, 1)
+        worker_memory_mb = jvm.parse_heap_mb(worker_memory) if is_spark_3 else 0
+        if not is_spark_3:
+            offheap_mb = 0
+        elif offheap_memory is None:
+            offheap_mb = int(worker_memory_mb * _OFFHEAP_FRACTION)
+        else:
+            offheap_mb = jvm.parse_heap_mb(offheap_memory)
+        if offheap_mb >= worker_memory_mb > 0:
+            raise util.InvalidSetupError("Spark setting '%s' (%d MB) must be smaller than %s (%d MB)." % (_SETTING_OFFHEAP_MEMORY, offheap_mb, _SETTING_WORKER_MEMORY, worker_memory_mb))
+
+        # Applications on YARN fetch Spark's jars from HDFS, uploaded once per deployment
+        if on_yarn:
+            namenode = hadoop_deployment["services"]["namenode"]
+            yarn_archive = "hdfs://%s:%d%s/spark-%s-jars.zip" % (namenode["host"], namenode["port"], _YARN_ARCHIVE_DIR, package_version.version)
+
+        # Generate configuration files using the included templates; on YARN, only the client configuration is needed
+        # - Templates of later version ranges replace those of earlier ranges
+        template_files = {}
+        for template_dir in reversed(package_version.template_dirs):
+            template_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "conf", "spark", template_dir + ("-yarn" if on_yarn else ""))
+            for template_file in glob.glob(os.path.join(template_path, "*.template")):
+                template_files[os.path.basename(template_file)] = template_file
         config_dir = os.path.join(spark_home, "conf")
+        address_file = os.path.join(config_dir, interconnect.ADDRESS_FILENAME)
         substitutions = {
             "__USER__": os.environ["USER"],
-            "__MASTER__": master,
+            "__MASTER__": master_hostname,
+            "__LOCAL_IP_COMMAND__": interconnect.local_address_command(address_file, "ip_address"),
+            "__LOCAL_HOSTNAME_COMMAND__": interconnect.local_address_command(address_file, "hostname"),
             "__WORKER_INSTANCES__": worker_instances,
             "__WORKER_CORES__": worker_cores,
             "__WORKER_MEMORY__": worker_memory,
+            "__EXECUTOR_HEAP__": "%dm" % (worker_memory_mb - offheap_mb),
+            "__OFFHEAP_ENABLED__": "true" if offheap_mb > 0 else "false",
+            "__OFFHEAP_SIZE__": "%dm" % offheap_mb,
+            "__LOCAL_DIRS__": ",".join(local_dirs),
+            "__DEFAULT_PARALLELISM__": str(parallelism),
+            "__SHUFFLE_PARTITIONS__": str(parallelism),
             "__PRELOAD_CMD__": ". %s" % preload_script if preload_script else ""
         }
+        if on_yarn:
+            substitutions.update({
+                "__HADOOP_CONF_DIR__": os.path.join(hadoop_deployment["properties"]["home"], "etc", "hadoop"),
+                "__YARN_ARCHIVE__": yarn_archive,
+                "__MAX_EXECUTORS__": str(int(worker_instances) * len(workers)),
+                "__SHUFFLE_SERVICE_PORT__": str(_YARN_SHUFFLE_SERVICE_PORT)
+            })
+        else:
+            substitutions.update({
+                "__MASTER_SHORT_HOSTNAME__": interconnect.short_hostname(master),
+                "__MASTER_JAVA_OPTS__": jvm_profiles["master"].java_opts(),
+                "__MASTER_HEAP__": "%dm" % jvm_profiles["master"].heap_mb,
+                "__WORKER_JAVA_OPTS__": jvm_profiles["worker"].java_opts(),
+                "__WORKER_HEAP__": "%dm" % jvm_profiles["worker"].heap_mb
+            })
         substitutions_pattern = re.compile("|".join([re.escape(k) for k in substitutions.keys()]))
         # Iterate over template files and apply substitutions
         log_fn(1, "Generating configuration files...")
-        for template_file in glob.glob(os.path.join(template_dir, "*.template")):
+        for _, template_file in sorted(template_files.items()):
             template_filename = os.path.basename(template_file)[:-len(".template")]
             log_fn(2, "Generating file \"%s\"..." % template_filename)
             with open(template_file, "r") as template_in, open(os.path.join(config_dir, template_filename), "w") as config_out:
                 for line in template_in:
                     print(substitutions_pattern.sub(lambda m: substitutions[m.group(0)], line.rstrip()), file=config_out)
-        log_fn(2, "Generating file \"master\"...")
-        with open(os.path.join(config_dir, "master"), "w") as master_file:
-            print(master, file=master_file)
-        log_fn(2, "Generating file \"slaves\"...")
-        with open(os.path.join(config_dir, "slaves"), "w") as slaves_file:
-            for worker in workers:
-                print(worker, file=slaves_file)
+        log_fn(2, "Generating file \"%s\"..." % interconnect.ADDRESS_FILENAME)
+        with open(address_file, "w") as address_out:
+            address_out.write(interconnect.address_file_contents(addresses))
+        if not on_yarn:
+            log_fn(2, "Generating file \"master\"...")
+            with open(os.path.join(config_dir, "master"), "w") as master_file:
+                print(master, file=master_file)
+            log_fn(2, "Generating file \"slaves\"...")
+            with open(os.path.join(config_dir, "slaves"), "w") as slaves_file:
+                for worker in workers:
+                    print(worker, file=slaves_file)
         log_fn(2, "Configuration files generated.")
 
-        # Clean up previous Spark deployments
-        log_fn(1, "Creating a clean environment on the master and workers...")
-        local_spark_dir = "/local/%s/spark/" % substitutions["__USER__"]
-        log_fn(2, "Purging \"%s\" on master..." % local_spark_dir)
-        util.execute_command_quietly(["ssh", master, 'rm -rf "%s"' % local_spark_dir])
-        log_fn(2, "Purging \"%s\" on workers..." % local_spark_dir)
-        for worker in workers:
-            util.execute_command_quietly(['ssh', worker, 'rm -rf "%s"' % local_spark_dir])
-        log_fn(2, "Creating directory structure on master...")
-        util.execute_command_quietly(['ssh', master, 'mkdir -p "%s"' % local_spark_dir])
-        log_fn(2, "Creating directory structure on workers...")
-        for worker in workers:
-            util.execute_command_quietly(['ssh', worker, 'mkdir -p "%s"' % local_spark_dir])
-        log_fn(2, "Clean environment set up.")
+        if on_yarn:
+            # Let the nodemanagers serve shuffle data, so dynamic allocation can release idle executors
+            shuffle_jars = glob.glob(os.path.join(spark_home, "yarn", _YARN_SHUFFLE_JAR_PATTERN))
+            if not shuffle_jars:
+                raise DeployFailedError("Cannot find Spark's YARN shuffle service in \"%s\"." % os.path.join(spark_home, "yarn"))
+            hadoop.add_yarn_aux_service(manifest, _YARN_SHUFFLE_SERVICE, _YARN_SHUFFLE_SERVICE_CLASS, shuffle_jars[0], _YARN_SHUFFLE_SERVICE_PORT,
+                replaces_pattern=_YARN_SHUFFLE_JAR_PATTERN, log_fn=util.create_log_fn(1, log_fn))
+            _upload_jars_archive(spark_home, hadoop_deployment["properties"]["home"], master, yarn_archive, log_fn=util.create_log_fn(1, log_fn))
+
+            manifest.record_deployment(self.identifier, package_version.version, master, [master] + workers, properties={"home": spark_home,
+                "cluster_manager": cluster_manager, "worker_instances": int(worker_instances), "interconnect": network, "local_dirs": local_dirs, "yarn_archive": yarn_archive})
+            log_fn(1, "Spark deployed on YARN.")
+            return
 
         # Start Spark
         log_fn(1, "Deploying Spark...")
-        util.execute_command_quietly(['ssh', master, '%s/sbin/start-all.sh' % spark_home])
+        if daemon_startup == "parallel":
+            log_fn(2, "Starting Spark master...")
+            executor.run(master, '"%s/sbin/start-master.sh"' % spark_home)
+            _start_workers(spark_home, master_hostname, workers, addresses, int(worker_instances), log_fn=util.create_log_fn(2, log_fn))
+        else:
+            executor.run(master, '%s/sbin/start-all.sh' % spark_home)
+
+        # Record the deployment
+        services = {"master": {"host": master_hostname, "port": _MASTER_PORT}, "master-webui": {"host": master_hostname, "port": _MASTER_WEBUI_PORT}}
+        for worker in workers:
+            for instance in range(1, int(worker_instances) + 1):
+                services["worker-%d@%s" % (instance, interconnect.short_hostname(worker))] = {"host": addresses[worker].hostname, "port": _WORKER_WEBUI_PORT + instance - 1}
+        manifest.record_deployment(self.identifier, package_version.version, master, [master] + workers, services=services,
+            properties={"home": spark_home, "cluster_manager": cluster_manager, "worker_instances": int(worker_instances), "interconnect": network, "local_dirs": local_dirs,
+                "jvm_heaps": jvm.machine_heaps(jvm_profiles, daemon_machines)})
 
         log_fn(1, "Spark cluster deployed.")
 
+    def get_supported_deployment_settings(self, package_version):
+        return _ALL_SETTINGS
+
+    def teardown_installed(self, spark_home, package_version, deployment, log_fn=util.log):
+        """Stops the Spark master and all worker instances concurrently."""
+        spark_home = os.path.realpath(spark_home)
+        master = deployment["master"]
+        workers = [machine for machine in deployment["machines"] if machine != master]
+        # Shuffle files in memory would hold on to it after the deployment
+        tmpfs_dirs = [local_dir for local_dir in deployment["properties"].get("local_dirs", []) if local_dir.startswith(_TMPFS_DIR + "/")]
+        remove_tmpfs_dirs_command = "rm -rf %s" % " ".join(['"%s"' % tmpfs_dir for tmpfs_dir in tmpfs_dirs])
+        if deployment["properties"].get("cluster_manager") == _CLUSTER_MANAGER_YARN:
+            # Applications run in YARN containers, which stop with Hadoop; the shuffle service stays with the nodemanagers
+            log_fn(0, "Spark runs on YARN, no Spark daemons to stop.")
+            if tmpfs_dirs:
+                executor.run(master, remove_tmpfs_dirs_command)
+            return
+        stop_workers_command = "; ".join([_worker_command(spark_home, master, instance, "stop")
+            for instance in range(1, deployment["properties"]["worker_instances"] + 1)])
+        if tmpfs_dirs:
+            stop_workers_command += "; " + remove_tmpfs_dirs_command
+        log_fn(0, "Stopping Spark master \"%s\" and %d workers..." % (master, len(workers)))
+        executor.run_all([(master, '"%s/sbin/stop-master.sh"' % spark_home)] +
+            [(worker, stop_workers_command) for worker in workers])
+        log_fn(1, "Spark daemons stopped.")
+
+    def get_log_locations(self, deployment):
+        if deployment["properties"].get("cluster_manager") == _CLUSTER_MANAGER_YARN:
+            # Executor logs are YARN container logs, collected with Hadoop
+            return []
+        return [
+            (os.path.join(deployment["properties"]["home"], "logs"), [deployment["master"]]),
+            ("/local/%s/spark/app-*" % os.environ["USER"], deployment["machines"])
+        ]
+
+def _upload_jars_archive(spark_home, hadoop_home, master, yarn_archive, log_fn=util.log):
+    """Uploads an archive of Spark's jars to HDFS for spark.yarn.archive, unless the file system already holds it.
+
+    The archive is built once per Spark installation, stored uncompressed as the jars are compressed already."""
+    archive_file = os.path.join(spark_home, os.path.basename(yarn_archive))
+    if not os.path.exists(archive_file):
+        with filelock.FileLock(archive_file + ".lock", log_fn=log_fn):
+            if not os.path.exists(archive_file):
+                log_fn(0, "Building archive of Spark's jars...")
+                # Build the archive under a temporary name, so an interrupted build is never mistaken for a complete archive
+                tmp_fd, tmp_file = tempfile.mkstemp(dir=spark_home, prefix=".jars-", suffix=".zip")
+                os.close(tmp_fd)
+                with zipfile.ZipFile(tmp_file, "w", zipfile.ZIP_STORED) as archive_out:
+                    for jar_file in sorted(glob.glob(os.path.join(spark_home, "jars", "*.jar"))):
+                        archive_out.write(jar_file, os.path.basename(jar_file))
+                os.chmod(tmp_file, 0o644)
+                os.rename(tmp_file, archive_file)
+    log_fn(0, "Uploading archive of Spark's jars to \"%s\"..." % yarn_archive)
+    hdfs = '"%s/bin/hdfs"' % hadoop_home
+    executor.run(master, '%s dfs -test -e "%s" || { %s dfs -mkdir -p "%s" && %s dfs -put -f "%s" "%s"; }' % (
+        hdfs, yarn_archive, hdfs, os.path.dirname(yarn_archive), hdfs, archive_file, yarn_archive))
+
+def _worker_command(spark_home, master, instance, action):
+    """Returns a shell command to start or stop a single Spark worker instance, numbered from 1, on the local machine."""
+    if action == "start":
+        # Mirror start-slave.sh, which gives every instance on a machine its own web UI port
+        return '"%s/sbin/spark-daemon.sh" start org.apache.spark.deploy.worker.Worker %d --webui-port %d spark://%s:%d' % (
+            spark_home, instance, _WORKER_WEBUI_PORT + instance - 1, master, _MASTER_PORT)
+    return '"%s/sbin/spark-daemon.sh" %s org.apache.spark.deploy.worker.Worker %d' % (spark_home, action, instance)
+
+def _start_workers(spark_home, master, workers, addresses, worker_instances, log_fn=util.log):
+    """Starts all worker instances on all workers concurrently and waits until each has registered with the master.
+
+    Workers are recognized by their short hostname or by their IP address on the interconnect, as a worker
+    registers with its IP address unless its hostname has been set explicitly."""
+    log_fn(0, "Starting %d worker instance(s) on %d workers..." % (worker_instances, len(workers)))
+    start_time = time.time()
+    tasks = executor.run_all([(worker, _worker_command(spark_home, master, instance, "start")) for worker in workers for instance in range(1, worker_instances + 1)],
+        step="start workers", raise_errors=False)
+    failed_workers = sorted(set([task.machine for task in tasks if task.error is not None]))
+    for task in tasks:
+        if task.error is not None:
+            log_fn(1, "Failed to start a worker instance on \"%s\": %s" % (task.machine, task.error))
+    if failed_workers:
+        raise DeployFailedError("Failed to start Spark worker instances on worker(s) \"%s\"." % "\",\"".join(failed_workers))
+
+    # Poll the master until all instances of all workers have registered
+    log_fn(0, "Waiting for workers to register with the master...")
+    registered_at = {}
+    deadline = start_time + _REGISTRATION_TIMEOUT
+    while len(registered_at) < len(workers) and time.time() < deadline:
+        registered_instances = _registered_worker_instances(master)
+        for worker in workers:
+            worker_registrations = registered_instances.get(interconnect.short_hostname(worker), 0) + registered_instances.get(addresses[worker].ip_address, 0)
+            if worker not in registered_at and worker_registrations >= worker_instances:
+                registered_at[worker] = time.time()
+        if len(registered_at) < len(workers):
+            time.sleep(_REGISTRATION_POLL_INTERVAL)
+    for worker in sorted(registered_at, key=lambda worker: registered_at[worker]):
+        log_fn(1, "Worker \"%s\" registered after %.1f seconds." % (worker, registered_at[worker] - start_time))
+    missing_workers = [worker for worker in workers if worker not in registered_at]
+    if missing_workers:
+        raise DeployFailedError("Worker(s) \"%s\" did not register with the Spark master within %d seconds." % ("\",\"".join(missing_workers), _REGISTRATION_TIMEOUT))
+    log_fn(1, "All %d worker instance(s) registered in %.1f seconds." % (len(workers) * worker_instances, time.time() - start_time))
+
+def _registered_worker_instances(master):
+    """Returns the number of live worker instances registered with the master, by IP address or short hostname."""
+    try:
+        master_status = json.load(urllib2.urlopen("http://%s:%d/json/" % (master, _MASTER_WEBUI_PORT), timeout=5))
+    except (urllib2.URLError, IOError, ValueError):
+        # The master may not be serving its web UI yet
+        return {}
+    registered_instances = {}
+    for worker_status in master_status.get("workers", []):
+        if worker_status.get("state") == "ALIVE":
+            host = worker_status["host"]
+            if not _IP_ADDRESS_PATTERN.match(host):
+                host = interconnect.short_hostname(host)
+            registered_instances[host] = registered_instances.get(host, 0) + 1
+    return registered_instances
+
 get_package_registry().register_package(SparkPackage())
-get_package_registry().package("spark").add_version(SparkPackageVersion("2.4.0", "https://archive.apache.org/dist/spark/spark-2.4.0/spark-2.4.0-bin-hadoop2.6.tgz", "tgz", "spark-2.4.0-bin-hadoop2.6", "2.4.x"))
-get_package_registry().package("spark").add_version(SparkPackageVersion("3.1.1", "https://archive.apache.org/dist/spark/spark-3.1.1/spark-3.1.1-bin-hadoop3.2.tgz", "tgz", "spark-3.1.1-bin-hadoop3.2", "2.4.x"))
+get_package_registry().package("spark").add_version(SparkPackageVersion("2.4.0", "https://archive.apache.org/dist/spark/spark-2.4.0/spark-2.4.0-bin-hadoop2.6.tgz", "tgz", "spark-2.4.0-bin-hadoop2.6"))
+get_package_registry().package("spark").add_version(SparkPackageVersion("3.1.1", "https://archive.apache.org/dist/spark/spark-3.1.1/spark-3.1.1-bin-hadoop3.2.tgz", "tgz", "spark-3.1.1-bin-hadoop3.2"))
@@ -4,6 +4,9 @@ from __future__ import print_function
 
 from ..package import PackageRegistry, get_package_registry
 from ..nativepackage import NativePackage, NativePackageVersion
+from .. import executor
+from .. import jvm
+from .. import purge
 from .. import util
 
 import glob
@@ -23,7 +26,7 @@ class ZookeeperPackage(NativePackage):
     def __init__(self):
         super(ZookeeperPackage, self).__init__("zookeeper", "ZooKeeper")
 
-    def deploy_installed(self, zookeeper_home, package_version, machines, settings, log_fn=util.log):
+    def deploy_installed(self, zookeeper_home, package_version, machines, settings, manifest, log_fn=util.log):
         """Deploys ZooKeeper to a given master node."""
         if len(machines) < 1:
             raise util.InvalidSetupError("ZooKeeper requires at least one machine to run on.")
@@ -34,7 +37,8 @@ class ZookeeperPackage(NativePackage):
         # Ensure that ZOOKEEPER_HOME is an absolute path
         zookeeper_home = os.path.realpath(zookeeper_home)
 
-        # ZooKeeper currently has no settings
+        # Extract settings
+        jvm_overrides = jvm.pop_overrides(settings, ["server"])
         if len(settings) > 0:
             raise util.InvalidSetupError("Found unknown settings for ZooKeeper: '%s'" % "','".join(settings.keys()))
 
@@ -59,19 +63,37 @@ class ZookeeperPackage(NativePackage):
         log_fn(1, "Creating a clean environment on the ZooKeeper machine...")
         local_zookeeper_dir = "/local/%s/zookeeper/" % substitutions["__USER__"]
         log_fn(2, "Purging \"%s\"..." % local_zookeeper_dir)
-        util.execute_command_quietly(["ssh", master, 'rm -rf "%s"' % local_zookeeper_dir])
+        executor.run(master, purge.purge_directory_command(local_zookeeper_dir))
         log_fn(2, "Creating directory structure...")
-        util.execute_command_quietly(['ssh', master, 'mkdir -p "%s"' % local_zookeeper_dir])
+        executor.run(master, 'mkdir -p "%s"' % local_zookeeper_dir)
         log_fn(2, "Clean environment set up.")
 
+        # Size the JVM for the ZooKeeper machine
+        log_fn(1, "Computing JVM profile...")
+        jvm_profiles = jvm.compute_profiles({"server": jvm.ROLE_COORDINATOR}, {"server": [master]}, jvm_overrides,
+            reserved_heaps=jvm.reserved_heaps(manifest, self.identifier), log_fn=util.create_log_fn(2, log_fn))
+        jvm_profile = jvm_profiles["server"]
+
         # Start YARN
         log_fn(1, "Deploying ZooKeeper...")
-        util.execute_command_quietly(['ssh', master, '"%s/bin/zkServer.sh" start' % zookeeper_home])
+        executor.run(master, 'ZOO_LOG_DIR="%s" JVMFLAGS="%s" "%s/bin/zkServer.sh" start' % (local_zookeeper_dir, jvm_profile.java_opts(), zookeeper_home))
+
+        # Record the deployment
+        manifest.record_deployment(self.identifier, package_version.version, master, [master],
+            services={"client": {"host": master, "port": 2181}}, properties={"home": zookeeper_home, "jvm_heaps": jvm.machine_heaps(jvm_profiles, {"server": [master]})})
 
         log_fn(1, 'ZooKeeper is now listening on "%s:2181".' % master)
 
     def get_supported_deployment_settings(self, package_version):
-        return []
+        return jvm.supported_settings(["server"])
+
+    def teardown_installed(self, zookeeper_home, package_version, deployment, log_fn=util.log):
+        log_fn(0, "Stopping ZooKeeper on \"%s\"..." % deployment["master"])
+        executor.run(deployment["master"], 'ZOO_LOG_DIR="/local/%s/zookeeper/" "%s/bin/zkServer.sh" stop || true' % (os.environ["USER"], os.path.realpath(zookeeper_home)))
+        log_fn(1, "ZooKeeper stopped.")
+
+    def get_log_locations(self, deployment):
+        return [("/local/%s/zookeeper/zookeeper.out" % os.environ["USER"], [deployment["master"]])]
 
 get_package_registry().register_package(ZookeeperPackage())
 get_package_registry().package("zookeeper").add_version(ZookeeperPackageVersion("3.4.8", "https://archive.apache.org/dist/zookeeper/zookeeper-3.4.8/zookeeper-3.4.8.tar.gz", "tar.gz", "zookeeper-3.4.8", "3.4.x"))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+PURGE_MODE_ASYNC = "async"
+PURGE_MODE_SYNC = "sync"
+PURGE_MODES = [PURGE_MODE_ASYNC, PURGE_MODE_SYNC]
+
+# Trash lives next to the deployment directories, so moving a directory to it is a rename on the same file system
+_TRASH_DIR = "/local/$USER/.trash"
+_REAPER_LOCK = "/local/$USER/.trash.lock"
+
+# Deletes everything in the trash at the lowest CPU and I/O priority. The lock keeps a single reaper per machine;
+# the reaper makes further passes to remove directories trashed while it runs, but stops after a pass that deletes
+# nothing (e.g., because of an entry it is not allowed to remove) so it never holds the lock indefinitely.
+_REAP_MAX_PASSES = 10
+_REAP_COMMAND = ('mkdir -p "%(trash)s" && nohup flock -n "%(lock)s" sh -c \''
+    'count() { find "%(trash)s" -mindepth 1 -maxdepth 1 | wc -l; }; '
+    'left=$(count); passes=0; '
+    'while [ "$left" -gt 0 ] && [ "$passes" -lt %(max_passes)d ]; do '
+    'nice -n 19 $(command -v ionice >/dev/null && echo ionice -c 3) find "%(trash)s" -mindepth 1 -maxdepth 1 -exec rm -rf {} +; '
+    'passes=$((passes + 1)); before=$left; left=$(count); '
+    '[ "$left" -lt "$before" ] || break; '
+    'done\' >/dev/null 2>&1 </dev/null &') % {"trash": _TRASH_DIR, "lock": _REAPER_LOCK, "max_passes": _REAP_MAX_PASSES}
+
+__purge_mode = PURGE_MODE_ASYNC
+
+def get_purge_mode():
+    return __purge_mode
+
+def set_purge_mode(purge_mode):
+    global __purge_mode
+    if purge_mode not in PURGE_MODES:
+        raise ValueError("Unknown purge mode: '%s'. Expected one of '%s'." % (purge_mode, "','".join(PURGE_MODES)))
+    __purge_mode = purge_mode
+
+def purge_directory_command(directory):
+    """Returns a shell command that removes a directory on a machine, or moves it out of the way.
+
+    In asynchronous mode, directories under /local/$USER are renamed to a trash directory and deleted by
+    a low-priority background process, so the command returns as soon as the directory is gone from its
+    original location. Other directories, and all directories in synchronous mode, are removed in place."""
+    directory = directory.rstrip("/")
+    if __purge_mode == PURGE_MODE_SYNC or not _is_local_directory(directory):
+        return 'rm -rf "%s"' % directory
+    return ('if [ -e "%(dir)s" ]; then mkdir -p "%(trash)s" && mv "%(dir)s" "%(trash)s/$(basename "%(dir)s").$(date +%%s).$$"; fi; %(reap)s' %
+        {"dir": directory, "trash": _TRASH_DIR, "reap": _REAP_COMMAND})
+
+def reap_trash_command():
+    """Returns a shell command that starts deleting directories left in the trash by earlier purges in the background."""
+    return 'if [ -d "%s" ]; then %s fi; true' % (_TRASH_DIR, _REAP_COMMAND)
+
+def _is_local_directory(directory):
+    return directory.startswith("/local/") and directory.count("/") >= 3
@@ -0,0 +1,453 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from . import util
+
+import atexit
+import base64
+import json
+import os
+import pipes
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+_AGENT_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "agent.py")
+_AGENT_IDLE_TIMEOUT = 6 * 60 * 60
+_AGENT_STARTUP_TIMEOUT = 15.0
+_POLL_INTERVAL = 0.05
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+class AgentError(Exception): pass
+class CommandTimeoutError(Exception): pass
+class CommandCancelledError(Exception): pass
+class SshConnectionError(subprocess.CalledProcessError): pass
+
+# Exit code used by ssh itself when it fails to connect or loses the connection
+_SSH_CONNECTION_FAILED = 255
+
+# Runs a command in its own process group on the remote machine and kills that group once the ssh connection's
+# standard input closes, so closing it or killing the local ssh client on a timeout or cancellation also stops the
+# remote command. Commands that ignore SIGTERM are killed after the given number of seconds.
+_KILL_ON_HANGUP_WRAPPER = ('exec 3<&0; setsid "${SHELL:-sh}" -c %s </dev/null 3<&- & command_pid=$!; '
+    '(cat <&3 >/dev/null; kill -TERM -$command_pid; sleep %d; kill -KILL -$command_pid) >/dev/null 2>&1 & watcher_pid=$!; '
+    'wait $command_pid; exit_code=$?; kill $watcher_pid 2>/dev/null; exit $exit_code')
+_REMOTE_KILL_DELAY = 5
+# Time to wait for a remote command to stop after a timeout or cancellation before giving up on confirming it
+_STOP_GRACE_PERIOD = 10.0
+
+class HostResources(object):
+    def __init__(self, memory_mb, cores):
+        self.__memory_mb = memory_mb
+        self.__cores = cores
+
+    @property
+    def memory_mb(self):
+        return self.__memory_mb
+
+    @property
+    def cores(self):
+        return self.__cores
+
+    def __repr__(self):
+        return "HostResources{memory_mb=%d,cores=%d}" % (self.memory_mb, self.cores)
+
+class AgentConnection:
+    """Client side of a connection to a deployer agent. Safe to use from multiple threads; requests run concurrently."""
+    def __init__(self, socket_path):
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.connect(socket_path)
+        self.__send_lock = threading.Lock()
+        self.__pending_lock = threading.Lock()
+        self.__pending = {}
+        self.__next_id = 0
+        self.__closed_reason = None
+        self.__closed = False
+        reader = threading.Thread(target=self.__read_responses)
+        reader.daemon = True
+        reader.start()
+
+    @property
+    def closed(self):
+        return self.__closed or self.__closed_reason is not None
+
+    def execute(self, command_line, stdin=None, output_fn=None, timeout=None, cancel_event=None):
+        """Executes a shell command on the agent's machine. Output is passed to output_fn(stream, data) as it arrives.
+
+        The command is killed if it runs longer than the timeout (in seconds) or when cancel_event is set, raising
+        a CommandTimeoutError or CommandCancelledError. Otherwise, returns the exit code of the command."""
+        request = {"op": "exec", "command": command_line, "timeout": timeout}
+        if stdin is not None:
+            request["stdin"] = _encode(stdin)
+        response = self.__request(request, output_fn, cancel_event)
+        if response.get("timed_out"):
+            raise CommandTimeoutError("Command did not complete within %s seconds: %s" % (timeout, command_line))
+        if cancel_event is not None and cancel_event.is_set():
+            raise CommandCancelledError("Command was cancelled: %s" % command_line)
+        return response["exit_code"]
+
+    def write_file(self, filename, file_contents, file_permissions=None):
+        self.__request({"op": "write_file", "path": filename, "content": _encode(file_contents), "mode": file_permissions})
+
+    def probe(self):
+        """Returns the hostname, memory (in MB), available memory (in MB), cores, and load average of the agent's machine."""
+        return self.__request({"op": "probe"})
+
+    def ping(self):
+        return self.__request({"op": "ping"})
+
+    def close(self):
+        self.__closed = True
+        self.__socket.close()
+
+    def __request(self, request, output_fn=None, cancel_event=None):
+        responses = queue.Queue()
+        with self.__pending_lock:
+            if self.__closed_reason:
+                raise AgentError(self.__closed_reason)
+            self.__next_id += 1
+            request["id"] = self.__next_id
+            self.__pending[request["id"]] = responses
+        try:
+            self.__send(request)
+            cancel_sent = False
+            while True:
+                if cancel_event is None:
+                    response = responses.get()
+                else:
+                    # Poll for cancellation while waiting; the agent still answers a cancelled request once it is killed
+                    try:
+                        response = responses.get(timeout=_POLL_INTERVAL)
+                    except queue.Empty:
+                        if cancel_event.is_set() and not cancel_sent:
+                            self.__send({"op": "cancel", "target": request["id"], "id": None})
+                            cancel_sent = True
+                        continue
+                if "output" in response:
+                    if output_fn:
+                        output_fn(response["output"], _decode(response["data"]))
+                elif "error" in response:
+                    raise AgentError(response["error"])
+                else:
+                    return response
+        except socket.error as e:
+            raise AgentError("Lost connection to agent: %s" % e)
+        finally:
+            with self.__pending_lock:
+                self.__pending.pop(request["id"], None)
+
+    def __send(self, request):
+        with self.__send_lock:
+            self.__socket.sendall((json.dumps(request) + "\n").encode("utf-8"))
+
+    def __read_responses(self):
+        try:
+            for line in self.__socket.makefile("rb"):
+                response = json.loads(line.decode("utf-8"))
+                with self.__pending_lock:
+                    responses = self.__pending.get(response.get("id"))
+                if responses:
+                    responses.put(response)
+            reason = "Agent closed the connection."
+        except (socket.error, ValueError) as e:
+            reason = "Lost connection to agent: %s" % e
+        # Fail all requests still waiting for a response
+        with self.__pending_lock:
+            self.__closed_reason = reason
+            for responses in self.__pending.values():
+                responses.put({"done": True, "error": reason})
+
+class AgentManager:
+    """Starts deployer agents on machines on first use and keeps a connection to each, tunneled over ssh.
+
+    Machines registered as local agents are connected to directly, which allows agents on localhost to stand
+    in for remote machines. Machines on which an agent cannot be started fall back to plain ssh."""
+    def __init__(self, log_fn=util.log):
+        self.__log_fn = log_fn
+        self.__lock = threading.Lock()
+        self.__machine_locks = {}
+        self.__connections = {}
+        self.__local_sockets = {}
+        self.__tunnels = []
+        self.__tunnel_dir = None
+
+    def register_local_agent(self, machine, socket_path):
+        """Directs all requests for a machine to an agent listening on a local socket, starting the agent if needed."""
+        with self.__lock:
+            self.__local_sockets[machine] = socket_path
+
+    def connection(self, machine):
+        """Returns a connection to the agent of a machine, or None if no agent could be started on it."""
+        with self.__lock:
+            if machine in self.__connections and not _is_broken(self.__connections[machine]):
+                return self.__connections[machine]
+            machine_lock = self.__machine_locks.setdefault(machine, threading.Lock())
+        with machine_lock:
+            with self.__lock:
+                # Reconnect if the previous connection to the agent was lost
+                if machine in self.__connections and not _is_broken(self.__connections[machine]):
+                    return self.__connections[machine]
+                local_socket = self.__local_sockets.get(machine)
+            try:
+                if local_socket:
+                    connection = self.__connect_local(local_socket)
+                else:
+                    connection = self.__connect_remote(machine)
+            except (AgentError, OSError, socket.error, subprocess.CalledProcessError) as e:
+                self.__log_fn(1, "Failed to start agent on machine \"%s\", falling back to ssh: %s" % (machine, e))
+                connection = None
+            with self.__lock:
+                self.__connections[machine] = connection
+            return connection
+
+    def close(self):
+        with self.__lock:
+            for connection in self.__connections.values():
+                if connection:
+                    connection.close()
+            self.__connections = {}
+            for tunnel_proc in self.__tunnels:
+                # Tunnels may have exited already, e.g., when their connection was lost
+                if tunnel_proc.poll() is None:
+                    tunnel_proc.terminate()
+                tunnel_proc.wait()
+            self.__tunnels = []
+            if self.__tunnel_dir:
+                shutil.rmtree(self.__tunnel_dir, ignore_errors=True)
+                self.__tunnel_dir = None
+
+    def __connect_local(self, socket_path):
+        util.execute_command_quietly([sys.executable, _AGENT_SCRIPT, "--socket", socket_path, "--daemon", "--idle-timeout", str(_AGENT_IDLE_TIMEOUT)])
+        return _wait_for_agent(socket_path, lambda: True)
+
+    def __connect_remote(self, machine):
+        # Start the agent on the machine; the deployer's directory is shared with the machines, so the agent runs in place
+        remote_socket = _remote_agent_socket()
+        start_command = 'PYTHON="$(command -v python3 || command -v python)" && "$PYTHON" %s --socket %s --daemon --idle-timeout %d' % (
+            pipes.quote(_AGENT_SCRIPT), pipes.quote(remote_socket), _AGENT_IDLE_TIMEOUT)
+        util.execute_command_quietly(["ssh", machine, start_command])
+
+        # Forward a local socket to the agent's socket
+        with self.__lock:
+            if not self.__tunnel_dir:
+                self.__tunnel_dir = tempfile.mkdtemp(prefix="big-data-deployer-agents-")
+            local_socket = os.path.join(self.__tunnel_dir, "%s.sock" % machine)
+        with open(os.devnull, "wb") as devnull:
+            tunnel_proc = subprocess.Popen(["ssh", "-N", "-o", "ExitOnForwardFailure=yes", "-L", "%s:%s" % (local_socket, remote_socket), machine],
+                stdin=devnull, stdout=devnull, stderr=devnull)
+        with self.__lock:
+            self.__tunnels.append(tunnel_proc)
+        return _wait_for_agent(local_socket, lambda: tunnel_proc.poll() is None)
+
+def _is_broken(connection):
+    return connection is not None and connection.closed
+
+def _encode(data):
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return base64.b64encode(data).decode("ascii")
+
+def _decode(data):
+    return base64.b64decode(data.encode("ascii"))
+
+def _remote_agent_socket():
+    return "/local/%s/.big-data-deployer/agent.sock" % os.environ["USER"]
+
+def _wait_for_agent(socket_path, is_alive_fn):
+    """Connects to an agent socket, retrying until the agent is up or the startup timeout expires."""
+    deadline = time.time() + _AGENT_STARTUP_TIMEOUT
+    while True:
+        try:
+            connection = AgentConnection(socket_path)
+            connection.ping()
+            return connection
+        except (socket.error, AgentError) as e:
+            if not is_alive_fn() or time.time() >= deadline:
+                raise AgentError("Agent at \"%s\" did not respond: %s" % (socket_path, e))
+            time.sleep(0.1)
+
+__agent_manager = None
+
+def enable_agents(log_fn=util.log):
+    """Routes subsequent remote commands, file writes, and probes through per-machine agents. Returns the AgentManager."""
+    global __agent_manager
+    if __agent_manager is None:
+        __agent_manager = AgentManager(log_fn)
+        atexit.register(disable_agents)
+    return __agent_manager
+
+def disable_agents():
+    """Closes all agent connections and tunnels. Agents exit on their own once idle."""
+    global __agent_manager
+    if __agent_manager is not None:
+        __agent_manager.close()
+        __agent_manager = None
+
+def __agent(machine):
+    return __agent_manager.connection(machine) if __agent_manager is not None else None
+
+def _start_ssh(machine, command_line, killable, stdout=None, stderr=None):
+    """Starts a command on a machine over ssh. If killable, the remote command is stopped when the ssh client is killed."""
+    if not killable:
+        return subprocess.Popen(["ssh", machine, command_line], stdout=stdout, stderr=stderr)
+    # Hold the connection's standard input open until the process is waited for, see _KILL_ON_HANGUP_WRAPPER
+    return subprocess.Popen(["ssh", machine, _KILL_ON_HANGUP_WRAPPER % (pipes.quote(command_line), _REMOTE_KILL_DELAY)],
+        stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
+
+def _stop_process(process):
+    """Kills a local process. Processes started by _start_ssh as killable first get to stop their remote command,
+    so it has exited by the time this returns, unless it could not be stopped within the grace period."""
+    if process.stdin:
+        process.stdin.close()
+        deadline = time.time() + _STOP_GRACE_PERIOD
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(_POLL_INTERVAL)
+    if process.poll() is None:
+        process.kill()
+    process.wait()
+
+def _wait_for_process(process, timeout, cancel_event, command_line):
+    """Waits for a local process to exit, killing it if the timeout expires or cancel_event is set."""
+    deadline = time.time() + timeout if timeout else None
+    try:
+        while process.poll() is None:
+            if deadline is not None and time.time() >= deadline:
+                _stop_process(process)
+                raise CommandTimeoutError("Command did not complete within %s seconds: %s" % (timeout, command_line))
+            if cancel_event is not None and cancel_event.is_set():
+                _stop_process(process)
+                raise CommandCancelledError("Command was cancelled: %s" % command_line)
+            time.sleep(_POLL_INTERVAL)
+    finally:
+        if process.stdin:
+            process.stdin.close()
+    return process.returncode
+
+def execute(machine, command_line, verbose=False, timeout=None, cancel_event=None):
+    """Executes a shell command on a machine, raising a CalledProcessError if it fails.
+
+    The command is killed if it runs longer than the timeout (in seconds) or when cancel_event is set, raising a
+    CommandTimeoutError or CommandCancelledError. Without an agent, the remote command is stopped through the ssh
+    connection before either error is raised. Failed ssh connections raise an SshConnectionError."""
+    agent = __agent(machine)
+    if agent is None:
+        with open(os.devnull, "wb") as devnull:
+            ssh_proc = _start_ssh(machine, command_line, timeout is not None or cancel_event is not None,
+                stdout=None if verbose else devnull, stderr=None if verbose else subprocess.STDOUT)
+            exit_code = _wait_for_process(ssh_proc, timeout, cancel_event, command_line)
+        if exit_code == _SSH_CONNECTION_FAILED:
+            raise SshConnectionError(exit_code, ["ssh", machine, command_line])
+    else:
+        output_fn = None
+        if verbose:
+            def output_fn(stream_name, data):
+                stream = sys.stdout if stream_name == "stdout" else sys.stderr
+                stream.write(data.decode("utf-8", "replace"))
+                stream.flush()
+        exit_code = agent.execute(command_line, output_fn=output_fn, timeout=timeout, cancel_event=cancel_event)
+    if exit_code != 0:
+        raise subprocess.CalledProcessError(exit_code, ["ssh", machine, command_line])
+
+def execute_for_output(machine, command_line, timeout=None):
+    """Executes a shell command on a machine and returns its standard output.
+
+    The command is killed if it runs longer than the timeout (in seconds), raising a CommandTimeoutError."""
+    agent = __agent(machine)
+    if agent is None:
+        if timeout is None:
+            return util.execute_command_for_output(["ssh", machine, command_line])
+        # Buffer the output in a file, so the process cannot block on a full pipe while waiting for it
+        with tempfile.TemporaryFile() as output_file:
+            ssh_proc = _start_ssh(machine, command_line, True, stdout=output_file)
+            _wait_for_process(ssh_proc, timeout, None, command_line)
+            output_file.seek(0)
+            return output_file.read().decode("utf-8")
+    output = []
+    agent.execute(command_line, output_fn=lambda stream_name, data: output.append(data) if stream_name == "stdout" else None, timeout=timeout)
+    return b"".join(output).decode("utf-8")
+
+def execute_streaming(machine, command_line, output_fn, timeout=None):
+    """Executes a shell command on a machine, passing its standard output to output_fn(data) in chunks as it arrives.
+
+    Raises a CalledProcessError if the command fails, or a CommandTimeoutError if it runs longer than the timeout."""
+    agent = __agent(machine)
+    if agent is None:
+        # Read the output in a separate thread, so the timeout is enforced even while output_fn blocks
+        reader_errors = []
+        def read_output():
+            try:
+                while True:
+                    chunk = ssh_proc.stdout.read(_STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    output_fn(chunk)
+            except Exception as e:
+                reader_errors.append(e)
+                if ssh_proc.poll() is None:
+                    ssh_proc.kill()
+        with open(os.devnull, "wb") as devnull:
+            ssh_proc = _start_ssh(machine, command_line, timeout is not None, stdout=subprocess.PIPE, stderr=devnull)
+            reader = threading.Thread(target=read_output)
+            reader.daemon = True
+            reader.start()
+            try:
+                exit_code = _wait_for_process(ssh_proc, timeout, None, command_line)
+            finally:
+                reader.join()
+                ssh_proc.stdout.close()
+        if reader_errors:
+            raise reader_errors[0]
+    else:
+        exit_code = agent.execute(command_line, output_fn=lambda stream_name, data: output_fn(data) if stream_name == "stdout" else None, timeout=timeout)
+    if exit_code != 0:
+        raise subprocess.CalledProcessError(exit_code, ["ssh", machine, command_line])
+
+def execute_to_file(machine, command_line, output_file, timeout=None):
+    """Executes a shell command on a machine, writing its standard output to a binary file object as it arrives.
+
+    Raises a CalledProcessError if the command fails, or a CommandTimeoutError if it runs longer than the timeout."""
+    execute_streaming(machine, command_line, output_file.write, timeout)
+
+def write_file(machine, filename, file_contents, file_permissions=None):
+    agent = __agent(machine)
+    if agent is not None:
+        agent.write_file(filename, file_contents, file_permissions)
+        return
+    ssh_command = ["ssh", machine, "mkdir -p %s; cat > %s" % (pipes.quote(os.path.dirname(filename)), pipes.quote(filename))]
+    with open(os.devnull, "w") as devnull:
+        cat_proc = subprocess.Popen(ssh_command, stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
+        cat_proc.stdin.write(file_contents)
+        cat_proc.stdin.close()
+        cat_proc.wait()
+    if file_permissions is not None:
+        file_permissions_str = oct(file_permissions).zfill(4)
+        util.execute_command(["ssh", machine, "chmod %s %s" % (file_permissions_str, pipes.quote(filename))])
+
+def probe_host_resources(machine):
+    """Retrieves the total memory and the number of cores of a remote machine."""
+    agent = __agent(machine)
+    if agent is not None:
+        probe = agent.probe()
+        return HostResources(probe["memory_mb"], probe["cores"])
+    probe_output = util.execute_command_for_output(["ssh", machine, "grep MemTotal /proc/meminfo; nproc"])
+    memory_mb = None
+    cores = None
+    for line in probe_output.split("\n"):
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == "MemTotal:":
+            memory_mb = int(parts[1]) // 1024
+        elif len(parts) == 1 and parts[0].isdigit():
+            cores = int(parts[0])
+    if memory_mb is None or cores is None:
+        raise util.InvalidSetupError("Failed to determine memory and core count of machine \"%s\". Output:\n%s" % (machine, probe_output))
+    return HostResources(memory_mb, cores)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+
+from . import logs
+from . import metrics
+from . import preserve
+from . import remote
+from . import status
+from . import util
+from .manifest import get_deployment_manifest
+from .package import PackageManager, get_package_registry
+
+import os.path
+
+def _quiet_log(indentation, message):
+    pass
+
+class Session:
+    """Deploys, tears down, and inspects frameworks in a single reservation from a long-running Python process.
+
+    The reservation is looked up once, when the session is created, and remote commands run through a deployer
+    agent on every machine (unless use_agents is disabled), so repeated operations reuse the same connections.
+    Hardware probes and interconnect addresses are likewise cached for the lifetime of the process. Methods
+    return their results rather than printing them; pass log_fn (e.g., util.log) to follow their progress.
+
+    Close the session, or use it as a context manager, to close the agent connections:
+
+        with Session(reservation_id) as session:
+            session.deploy("hadoop", "3.2.2", {"yarn_cores": "16"})
+            session.deploy("spark", "3.1.1", {"cluster_manager": "yarn"})
+            if not all([service_status.reachable for service_status in session.status()]):
+                ...
+            session.teardown()
+    """
+    def __init__(self, reservation_id="LAST", framework_dir=util.DEFAULT_FRAMEWORK_DIR, use_agents=True, package_registry=None, log_fn=_quiet_log):
+        self.__framework_dir = framework_dir
+        self.__package_manager = PackageManager(package_registry or get_package_registry(), framework_dir)
+        self.__reservation = preserve.get_PreserveManager().fetch_reservation(reservation_id)
+        self.__log_fn = log_fn
+        self.__agent_manager = remote.enable_agents(log_fn=log_fn) if use_agents else None
+
+    @property
+    def reservation(self):
+        return self.__reservation
+
+    @property
+    def reservation_id(self):
+        return self.__reservation.reservation_id
+
+    @property
+    def machines(self):
+        return list(self.__reservation.assigned_machines)
+
+    @property
+    def framework_dir(self):
+        return self.__framework_dir
+
+    @property
+    def package_manager(self):
+        return self.__package_manager
+
+    def manifest(self):
+        """Returns the deployment manifest of the reservation, read anew to include changes made by other processes."""
+        return get_deployment_manifest(self.framework_dir, self.reservation_id)
+
+    def deploy(self, framework, version, settings={}, machines=None, health_check=True, drop_unhealthy=True, select_master=True):
+        """Deploys a framework to the machines of the reservation (or a subset of them) and returns the deployment as recorded in
+        the manifest, including its "master", "machines", "services" (with the "host", "port", and "pid" of each service), and "timings".
+
+        Settings are given as a dictionary of the same settings the deploy command accepts; the dictionary is not modified."""
+        return self.__package_manager.deploy(framework, version, self.reservation_id, machines or self.machines, dict(settings),
+            health_check=health_check, drop_unhealthy=drop_unhealthy, select_master=select_master, log_fn=self.__log_fn)
+
+    def teardown(self, framework=None):
+        """Tears down a framework, or all frameworks deployed to the reservation, and returns the removed deployments by framework."""
+        if framework is None:
+            return self.__package_manager.teardown_all(self.reservation_id, log_fn=self.__log_fn)
+        return {framework: self.__package_manager.teardown(framework, self.reservation_id, log_fn=self.__log_fn)}
+
+    def status(self, frameworks=None, timeout=1.0):
+        """Checks whether the services of all (or the given) deployed frameworks are reachable, and returns a ServiceStatus for each."""
+        return status.check_status(self.manifest(), frameworks=frameworks, timeout=timeout)
+
+    def collect(self, store_file=None):
+        """Collects resource-monitor metrics from the machines it was deployed to (default: all machines of the reservation).
+
+        Returns the MetricsStore the metrics were written to, which the caller should close."""
+        deployment = self.manifest().deployment("resource-monitor")
+        machines = deployment["machines"] if deployment else self.machines
+        store_file = store_file or os.path.join(self.framework_dir, "metrics", "reservation-%s.metrics" % self.reservation_id)
+        return metrics.collect_metrics(machines, store_file, log_fn=self.__log_fn)
+
+    def collect_logs(self, archive_dir=None, frameworks=None, bandwidth_limit=None):
+        """Collects the logs of all (or the given) deployed frameworks into an archive directory and returns its index.
+
+        The bandwidth limit is given in bytes per second."""
+        archive_dir = archive_dir or os.path.join(self.framework_dir, "logs", "reservation-%s" % self.reservation_id)
+        return logs.collect_logs(self.manifest(), archive_dir, frameworks=frameworks, bandwidth_limit=bandwidth_limit,
+            package_registry=self.__package_manager.package_registry, log_fn=self.__log_fn)
+
+    def close(self):
+        """Closes the connections to the deployer agents, which are shared by all sessions in the process."""
+        if self.__agent_manager is not None:
+            remote.disable_agents()
+            self.__agent_manager = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "Session{reservation_id=%s,machines=%d,framework_dir=%s}" % (self.reservation_id, len(self.machines), self.framework_dir)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from . import executor
+from . import preserve
+from . import remote
+from . import util
+from .manifest import get_deployment_manifest
+
+import os
+import pipes
+import posixpath
+import threading
+import time
+
+_DEFAULT_CHUNK_SIZE_MB = 1024
+_DEFAULT_STREAMS_PER_WORKER = 2
+_DEFAULT_RETRIES = 2
+
+class StagingFailedError(Exception): pass
+
+class StagingChunk:
+    """A group of files written into the same HDFS directory by a single "hdfs dfs -put" command."""
+    def __init__(self, destination_dir):
+        self.__destination_dir = destination_dir
+        self.__files = []
+        self.__size = 0
+
+    @property
+    def destination_dir(self):
+        return self.__destination_dir
+
+    @property
+    def files(self):
+        return list(self.__files)
+
+    @property
+    def size(self):
+        return self.__size
+
+    def add_file(self, source_file, size):
+        self.__files.append(source_file)
+        self.__size += size
+
+    def put_command(self, hadoop_home):
+        hdfs = pipes.quote(os.path.join(hadoop_home, "bin", "hdfs"))
+        destination_dir = pipes.quote(self.destination_dir)
+        return "%s dfs -mkdir -p %s && %s dfs -put -f %s %s" % (hdfs, destination_dir, hdfs, " ".join([pipes.quote(source_file) for source_file in self.files]), destination_dir)
+
+    def __repr__(self):
+        return "StagingChunk{destination_dir=%s,files=%d,size=%d}" % (self.destination_dir, len(self.__files), self.size)
+
+def _list_source_files(sources, destination):
+    """Returns (source file, size, HDFS path) tuples for all files in the given source files and directories.
+
+    Every source ends up in the destination directory under its own name, like "hdfs dfs -put" would put it."""
+    source_files = []
+    for source in sources:
+        source = os.path.abspath(source)
+        if os.path.isfile(source):
+            source_files.append((source, os.path.getsize(source), posixpath.join(destination, os.path.basename(source))))
+        elif os.path.isdir(source):
+            for source_dir, _, filenames in os.walk(source):
+                relative_dir = os.path.relpath(source_dir, os.path.dirname(source))
+                for filename in sorted(filenames):
+                    source_file = os.path.join(source_dir, filename)
+                    source_files.append((source_file, os.path.getsize(source_file), posixpath.join(destination, relative_dir, filename)))
+        else:
+            raise util.InvalidSetupError("Source \"%s\" does not exist." % source)
+    return source_files
+
+def _list_staged_files(master, hadoop_home, destination):
+    """Returns the sizes of all files already present in HDFS under the destination directory, by path."""
+    ls_output = remote.execute_for_output(master, "%s dfs -ls -R %s 2>/dev/null; true" % (pipes.quote(os.path.join(hadoop_home, "bin", "hdfs")), pipes.quote(destination)))
+    staged_files = {}
+    for line in ls_output.split("\n"):
+        parts = line.split(None, 7)
+        if len(parts) == 8 and parts[0].startswith("-") and parts[4].isdigit():
+            staged_files[parts[7]] = int(parts[4])
+    return staged_files
+
+def _plan_chunks(source_files, workers, chunk_size):
+    """Spreads files over workers to balance the number of bytes each worker writes, then groups each worker's files into chunks.
+
+    Returns a list of chunks per worker, in the order of the workers."""
+    # Assign the largest files first, each to the worker with the fewest bytes assigned so far
+    assigned_bytes = [0] * len(workers)
+    assigned_files = [[] for _ in workers]
+    for source_file, size, hdfs_path in sorted(source_files, key=lambda source_file: -source_file[1]):
+        worker_index = assigned_bytes.index(min(assigned_bytes))
+        assigned_bytes[worker_index] += size
+        assigned_files[worker_index].append((source_file, size, hdfs_path))
+    # Files can only be put into a single directory per command, so chunks never span directories
+    worker_chunks = []
+    for files in assigned_files:
+        chunks = []
+        open_chunks = {}
+        for source_file, size, hdfs_path in sorted(files):
+            destination_dir = posixpath.dirname(hdfs_path)
+            chunk = open_chunks.get(destination_dir)
+            if chunk is None or chunk.size + size > chunk_size:
+                chunk = StagingChunk(destination_dir)
+                open_chunks[destination_dir] = chunk
+                chunks.append(chunk)
+            chunk.add_file(source_file, size)
+        worker_chunks.append(chunks)
+    return worker_chunks
+
+def _put_chunks(hadoop_home, worker_chunks, workers, streams_per_worker, log_fn):
+    """Writes the chunks assigned to each worker from that worker, using several streams per worker.
+
+    Returns the number of bytes written per worker and the chunks that failed."""
+    lock = threading.Lock()
+    queues = [list(chunks) for chunks in worker_chunks]
+    written_bytes = [0] * len(workers)
+    failed_chunks = []
+    def stream(worker_index):
+        worker = workers[worker_index]
+        while True:
+            with lock:
+                if not queues[worker_index]:
+                    return
+                chunk = queues[worker_index].pop(0)
+            try:
+                executor.run(worker, chunk.put_command(hadoop_home), step="stage", timeout=0)
+                with lock:
+                    written_bytes[worker_index] += chunk.size
+            except Exception as e:
+                log_fn(1, "Failed to write %d file(s) to \"%s\" from machine \"%s\": %s" % (len(chunk.files), chunk.destination_dir, worker, e))
+                with lock:
+                    failed_chunks.append(chunk)
+    util.run_in_parallel(stream, [(worker_index,) for worker_index in range(len(workers)) for _ in range(streams_per_worker)])
+    return written_bytes, failed_chunks
+
+def stage_data(manifest, sources, destination, chunk_size=_DEFAULT_CHUNK_SIZE_MB * 1024 * 1024, streams_per_worker=_DEFAULT_STREAMS_PER_WORKER,
+        retries=_DEFAULT_RETRIES, log_fn=util.log):
+    """Copies files from a shared file system into the HDFS cluster of a Hadoop deployment, from all workers in parallel.
+
+    Files are spread over the workers, so every worker writes its share and holds the first replica of it.
+    Files already present in HDFS with the same size are skipped, so staging the same sources again resumes
+    an interrupted or partially failed run. Failed chunks are retried up to retries times on other workers."""
+    hadoop_deployment = manifest.deployment("hadoop")
+    if not hadoop_deployment or not hadoop_deployment["properties"]["hdfs_enable"]:
+        raise util.InvalidSetupError("Staging data requires Hadoop to be deployed with HDFS in the same reservation first.")
+    hadoop_home = hadoop_deployment["properties"]["home"]
+    master = hadoop_deployment["master"]
+    workers = [machine for machine in hadoop_deployment["machines"] if machine != master] or [master]
+    destination = posixpath.normpath(destination)
+
+    log_fn(0, "Staging data into HDFS directory \"%s\" from %d worker(s)..." % (destination, len(workers)))
+    log_fn(1, "Listing source files...")
+    source_files = _list_source_files(sources, destination)
+    staged_files = _list_staged_files(master, hadoop_home, destination)
+    remaining_files = [source_file for source_file in source_files if staged_files.get(source_file[2]) != source_file[1]]
+    total_bytes = sum([size for _, size, _ in remaining_files])
+    log_fn(2, "Found %d file(s), %d of which (%.1f MB) still need to be staged." % (len(source_files), len(remaining_files), total_bytes / 1e6))
+    if not remaining_files:
+        return
+
+    worker_chunks = _plan_chunks(remaining_files, workers, chunk_size)
+    written_bytes = [0] * len(workers)
+    start_time = time.time()
+    for attempt in range(retries + 1):
+        if attempt == 0:
+            log_fn(1, "Writing %d chunk(s)..." % sum([len(chunks) for chunks in worker_chunks]))
+        else:
+            log_fn(1, "Retrying %d failed chunk(s) (attempt %d of %d)..." % (len(failed_chunks), attempt, retries))
+            # Move failed chunks to another worker, in case the failure was caused by the worker itself
+            worker_chunks = [[] for _ in workers]
+            for chunk_index, chunk in enumerate(failed_chunks):
+                worker_chunks[(chunk_index + attempt) % len(workers)].append(chunk)
+        attempt_bytes, failed_chunks = _put_chunks(hadoop_home, worker_chunks, workers, streams_per_worker, util.create_log_fn(1, log_fn))
+        written_bytes = [total + written for total, written in zip(written_bytes, attempt_bytes)]
+        if not failed_chunks:
+            break
+    elapsed = max(time.time() - start_time, 1e-3)
+
+    # Report throughput, overall and per worker
+    log_fn(1, "Staged %.1f MB in %.1f seconds (%.1f MB/s)." % (sum(written_bytes) / 1e6, elapsed, sum(written_bytes) / 1e6 / elapsed))
+    for worker, worker_bytes in zip(workers, written_bytes):
+        log_fn(2, "Machine \"%s\" wrote %.1f MB (%.1f MB/s)." % (worker, worker_bytes / 1e6, worker_bytes / 1e6 / elapsed))
+    if failed_chunks:
+        raise StagingFailedError("Failed to stage %d file(s) in %d chunk(s). Run the same command again to retry them." %
+            (sum([len(chunk.files) for chunk in failed_chunks]), len(failed_chunks)))
+
+def add_stage_data_subparser(parser):
+    stage_data_parser = parser.add_parser("stage-data", help="copy input data into the HDFS cluster of a Hadoop deployment from all workers in parallel")
+    stage_data_parser.add_argument("-f", "--framework-dir", help="installation directory for Big Data frameworks", action="store", default=util.DEFAULT_FRAMEWORK_DIR)
+    stage_data_parser.add_argument("--preserve-id", help="preserve reservation id Hadoop was deployed to, or 'LAST' for the last reservation made by the user", action="store", default="LAST")
+    stage_data_parser.add_argument("-d", "--destination", help="HDFS directory to copy the sources into (default: /)", action="store", default="/")
+    stage_data_parser.add_argument("--chunk-size", metavar="MB", help="maximum amount of data written by a single command (default: %d)" % _DEFAULT_CHUNK_SIZE_MB, action="store", type=int, default=_DEFAULT_CHUNK_SIZE_MB)
+    stage_data_parser.add_argument("--streams-per-worker", metavar="N", help="number of concurrent writes per worker (default: %d)" % _DEFAULT_STREAMS_PER_WORKER, action="store", type=int, default=_DEFAULT_STREAMS_PER_WORKER)
+    stage_data_parser.add_argument("--retries", metavar="N", help="retry failed chunks up to N times (default: %d)" % _DEFAULT_RETRIES, action="store", type=int, default=_DEFAULT_RETRIES)
+    stage_data_parser.add_argument("SOURCE", help="file or directory on a shared file system (e.g., home or scratch) to copy into HDFS", nargs="+")
+    stage_data_parser.set_defaults(func=__stage_data)
+
+def __stage_data(args):
+    reservation = preserve.get_PreserveManager().fetch_reservation(args.preserve_id)
+    manifest = get_deployment_manifest(args.framework_dir, reservation.reservation_id)
+    stage_data(manifest, args.SOURCE, args.destination, chunk_size=args.chunk_size * 1024 * 1024,
+        streams_per_worker=args.streams_per_worker, retries=args.retries)
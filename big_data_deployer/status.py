@@ -0,0 +1,130 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+from . import preserve
+from . import remote
+from . import util
+from .manifest import get_deployment_manifest
+
+import re
+import sys
+import time
+
+_DEFAULT_CHECK_TIMEOUT = 1.0
+_PID_LOOKUP_TIMEOUT = 10.0
+_LISTENING_PID_PATTERN = re.compile(r":(\d+)\s.*pid=(\d+)")
+
+class ServiceStatus:
+    """Result of checking a service recorded in the deployment manifest."""
+    def __init__(self, framework, service, host, port, pid, reachable):
+        self.__framework = framework
+        self.__service = service
+        self.__host = host
+        self.__port = port
+        self.__pid = pid
+        self.__reachable = reachable
+
+    @property
+    def framework(self):
+        return self.__framework
+
+    @property
+    def service(self):
+        return self.__service
+
+    @property
+    def host(self):
+        return self.__host
+
+    @property
+    def port(self):
+        return self.__port
+
+    @property
+    def pid(self):
+        return self.__pid
+
+    @property
+    def reachable(self):
+        return self.__reachable
+
+    def __repr__(self):
+        return "ServiceStatus{framework=%s,service=%s,host=%s,port=%s,pid=%s,reachable=%s}" % (
+            self.framework, self.service, self.host, self.port, self.pid, self.reachable)
+
+def find_service_pids(services):
+    """Looks up the processes listening on the ports of the given services, contacting every host once, concurrently.
+
+    Returns the pid of each service by name, or None if no process was found listening on its port."""
+    ports_by_host = {}
+    for name, service in services.items():
+        ports_by_host.setdefault(service["host"], {})[int(service["port"])] = name
+    hosts = sorted(ports_by_host)
+    def listening_pids(host):
+        try:
+            ss_output = remote.execute_for_output(host, "ss -ltnp 2>/dev/null; true", timeout=_PID_LOOKUP_TIMEOUT)
+        except Exception:
+            return {}
+        return dict((int(port), int(pid)) for port, pid in _LISTENING_PID_PATTERN.findall(ss_output))
+    pids = dict((name, None) for name in services)
+    for host, host_pids in zip(hosts, util.run_in_parallel(listening_pids, [(host,) for host in hosts])):
+        for port, name in ports_by_host[host].items():
+            pids[name] = host_pids.get(port)
+    return pids
+
+def check_status(manifest, frameworks=None, timeout=_DEFAULT_CHECK_TIMEOUT):
+    """Checks all services recorded in the deployment manifest concurrently and returns their status.
+
+    Every check is a TCP connection attempt limited by the timeout (in seconds), so checking any number of
+    services takes about as long as the timeout at most."""
+    checks = []
+    for framework, deployment in sorted(manifest.deployments.items()):
+        if frameworks and framework not in frameworks:
+            continue
+        for service_name, service in sorted(deployment["services"].items()):
+            checks.append((framework, service_name, service))
+    reachable = util.run_in_parallel(util.is_port_open, [(service["host"], service["port"], timeout) for _, _, service in checks])
+    return [ServiceStatus(framework, service_name, service["host"], service["port"], service.get("pid"), is_reachable)
+        for (framework, service_name, service), is_reachable in zip(checks, reachable)]
+
+def print_status(manifest, service_statuses, frameworks=None, out=sys.stdout):
+    """Prints a summary of every deployment (or of the given frameworks) and a table with the status of its services."""
+    deployments = manifest.deployments
+    for framework in sorted(set(frameworks or deployments)):
+        deployment = deployments[framework]
+        timings = deployment.get("timings", {})
+        print("%s %s on %d machine(s), master %s, deployed %s%s" % (framework, deployment["version"], len(deployment["machines"]), deployment["master"] or "-",
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(deployment["deployed_at"])),
+            " in %.1f seconds" % timings["total"] if "total" in timings else ""), file=out)
+    rows = [("FRAMEWORK", "SERVICE", "ENDPOINT", "PID", "STATUS")]
+    for service_status in service_statuses:
+        rows.append((service_status.framework, service_status.service, "%s:%s" % (service_status.host, service_status.port),
+            str(service_status.pid) if service_status.pid is not None else "-", "up" if service_status.reachable else "DOWN"))
+    if len(rows) > 1:
+        print("", file=out)
+        widths = [max([len(row[column]) for row in rows]) for column in range(len(rows[0]))]
+        for row in rows:
+            print("  ".join([value.ljust(width) for value, width in zip(row, widths)]).rstrip(), file=out)
+
+def add_status_subparser(parser):
+    status_parser = parser.add_parser("status", help="show deployed frameworks and check whether their services are reachable")
+    status_parser.add_argument("-f", "--framework-dir", help="installation directory for Big Data frameworks", action="store", default=util.DEFAULT_FRAMEWORK_DIR)
+    status_parser.add_argument("--preserve-id", help="preserve reservation id to show the status of, or 'LAST' for the last reservation made by the user", action="store", default="LAST")
+    status_parser.add_argument("--timeout", metavar="SECONDS", help="time to wait for each service to accept a connection (default: %.0f)" % _DEFAULT_CHECK_TIMEOUT, action="store", type=float, default=_DEFAULT_CHECK_TIMEOUT)
+    status_parser.add_argument("FRAMEWORK", help="framework to show the status of (default: all deployed frameworks)", nargs="*")
+    status_parser.set_defaults(func=__status)
+
+def __status(args):
+    reservation = preserve.get_PreserveManager().fetch_reservation(args.preserve_id)
+    manifest = get_deployment_manifest(args.framework_dir, reservation.reservation_id)
+    if not manifest.deployments:
+        print("No frameworks have been deployed to reservation %s." % reservation.reservation_id)
+        return
+    unknown_frameworks = [framework for framework in args.FRAMEWORK if framework not in manifest.deployments]
+    if unknown_frameworks:
+        raise util.InvalidSetupError("No deployment has been recorded for framework(s): '%s'" % "','".join(unknown_frameworks))
+    service_statuses = check_status(manifest, frameworks=args.FRAMEWORK, timeout=args.timeout)
+    print_status(manifest, service_statuses, frameworks=args.FRAMEWORK)
+    if not all([service_status.reachable for service_status in service_statuses]):
+        sys.exit(1)
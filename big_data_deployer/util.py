@@ -2,8 +2,10 @@
 
 from __future__ import print_function
 import os
-import pipes
+import socket
 import subprocess
+import threading
+import time
 
 DEFAULT_FRAMEWORK_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "frameworks")
 
@@ -39,14 +41,45 @@ def execute_command_quietly(command_line_list, shell=False):
 def execute_command_for_output(command_line_list):
     return subprocess.Popen(command_line_list, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
 
-def write_remote_file(machine, filename, file_contents, file_permissions=None):
-    ssh_command = ["ssh", machine, "mkdir -p %s; cat > %s" % (pipes.quote(os.path.dirname(filename)), pipes.quote(filename))]
-    with open(os.devnull, "w") as devnull:
-        cat_proc = subprocess.Popen(ssh_command, stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
-        cat_proc.stdin.write(file_contents)
-        cat_proc.stdin.close()
-        cat_proc.wait()
-    if file_permissions is not None:
-        file_permissions_str = oct(file_permissions).zfill(4)
-        execute_command(["ssh", machine, "chmod %s %s" % (file_permissions_str, pipes.quote(filename))])
+def run_in_parallel(function, arguments_list):
+    """Calls a function once for every tuple of arguments, each in a separate thread.
 
+    Returns the results in the order of the arguments. If any call raised an exception,
+    the first such exception is re-raised after all calls have completed."""
+    results = [None] * len(arguments_list)
+    errors = [None] * len(arguments_list)
+    def run(index, arguments):
+        try:
+            results[index] = function(*arguments)
+        except Exception as e:
+            errors[index] = e
+    threads = [threading.Thread(target=run, args=(index, arguments)) for index, arguments in enumerate(arguments_list)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+def stop_pidfile_processes_command(pidfiles):
+    """Returns a shell command that terminates the processes listed in the given pidfiles, skipping missing pidfiles."""
+    return 'for pidfile in %s; do [ -f "$pidfile" ] && kill $(cat "$pidfile") 2>/dev/null; rm -f "$pidfile"; done; true' % " ".join(pidfiles)
+
+def is_port_open(host, port, timeout=1.0):
+    """Checks if a process accepts TCP connections on the given host and port."""
+    try:
+        socket.create_connection((host, int(port)), timeout).close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+def wait_for_port_closed(host, port, timeout=30.0, poll_interval=0.2):
+    """Waits until no process accepts connections on a port. Returns False if the port is still open after the timeout."""
+    deadline = time.time() + timeout
+    while is_port_open(host, port):
+        if time.time() >= deadline:
+            return False
+        time.sleep(poll_interval)
+    return True